@@ -1,18 +1,49 @@
 import os
 import io
 import time
+import threading
+started = time.perf_counter()
 import streamlit as st
-from openai import OpenAI
+from src.control_followup import ChatMemory, compact_history, related_assessments, stream_followup
+from src.control_store import FIELDS, get_store
+from src.control_cancellation import CancelToken
+from src.control_batch import write_workbook
+from src.control_jobs import JobFailed, follow_job, get_queue, jobs_enabled
+from src.control_pipeline import SECTIONS, iter_pipeline_stream
+from src.control_session import SessionMemory, memory_gauges
+from src.control_timing import ScriptTimer
 import warnings
 warnings.filterwarnings("ignore")
 
+# Startup/rerun timing of this session, see src/control_timing.py
+timer = ScriptTimer(st.session_state, started)
+timer.mark("imports")
+
+
+@st.cache_resource
+def warm_up() -> None:
+    # Once per server process: import the OpenAI/LangChain packages and open the shared
+    # clients in the background while the page renders
+    from src.control_clients import preload
+    threading.Thread(target=preload, name="control-preload", daemon=True).start()
+
+
+@st.cache_data
+def stage_rows(metrics: dict) -> list:
+    # Rows of the stage metrics panel; recomputed only when the metrics change
+    from src.control_metrics import stage_table
+    return [{"stage": row["stage"], "seconds": round(row["mean_seconds"], 2),
+             "first token (s)": round(row["mean_time_to_first_token"], 2) if row["mean_time_to_first_token"] is not None else None,
+             "input": row["input_tokens"], "cached": row["cached_tokens"], "output": row["output_tokens"],
+             "reasoning": row["reasoning_tokens"], "retries": row["retries"], "cost (USD)": round(row["cost_usd"], 5)}
+            for row in stage_table([{"stages": metrics}])]
+
+
 # -----------------------------------------------------------------------------
-# INITIAL SETUP: Initialize the OpenAI client and conversation history in session state
+# INITIAL SETUP: Initialize the conversation history in session state
+# (OpenAI clients and chains are shared by all sessions, see src/control_clients.py)
 # -----------------------------------------------------------------------------
 st.set_page_config(layout="wide", page_title="Control Assessment Demo")
-# Instantiate the OpenAI client with your API key on first run
-if 'model' not in st.session_state:
-    st.session_state['model'] = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
 
 # Setup conversation history
 if 'conversation' not in st.session_state:
@@ -26,16 +57,98 @@ if 'download_buffer' not in st.session_state:
     st.session_state['download_buffer'] = None
 if 'download_available' not in st.session_state:
     st.session_state['download_available'] = False
+if 'metrics' not in st.session_state:
+    st.session_state['metrics'] = None
+# Assessment results and the compacted chat history used to build follow-up requests
+if 'assessment' not in st.session_state:
+    st.session_state['assessment'] = None
+if 'chat_memory' not in st.session_state:
+    st.session_state['chat_memory'] = ChatMemory()
+# ID of the assessment's record in the assessment store, see src/control_store.py
+if 'assessment_id' not in st.session_state:
+    st.session_state['assessment_id'] = None
+# Cancels the assessment of this session that is still running, see src/control_cancellation.py
+if 'cancel_token' not in st.session_state:
+    st.session_state['cancel_token'] = None
+# Bounded working set: older turns and the workbook export spill to disk (src/control_session.py)
+if 'session_memory' not in st.session_state:
+    st.session_state['session_memory'] = SessionMemory()
+session = st.session_state['session_memory']
+
+
+def cancel_assessment(reason: str) -> None:
+    # Stop paying for an assessment nobody will read: the in-process run of an interrupted
+    # script run, or the followed job
+    token = st.session_state['cancel_token']
+    if token is not None:
+        token.cancel(reason)
+        st.session_state['cancel_token'] = None
+    if st.query_params.get("job") and jobs_enabled():
+        get_queue().cancel(st.query_params["job"])
+
+
+def combined_message(assessment: dict) -> str:
+    # All sections of an assessment as one chat message
+    return "\n".join(f"## {title}: \n {assessment[key]}" for title, key in SECTIONS)
+
+
+def open_assessment(record: dict) -> None:
+    # Continue the chat on a stored assessment instead of running the pipeline again
+    cancel_assessment("opened a past assessment")
+    st.session_state['conversation'] = [
+        st.session_state['conversation'][0],
+        {"role": "user", "content": record["original_input"]},
+        {"role": "assistant", "content": combined_message(record), "assessment": True},
+    ]
+    st.session_state['assessment'] = {key: record.get(key) for key in FIELDS}
+    st.session_state['assessment_id'] = record["id"]
+    st.session_state['chat_memory'] = ChatMemory()
+    st.session_state['metrics'] = None
+    st.session_state['download_buffer'] = session.keep_buffer("workbook", write_workbook([record], io.BytesIO()))
+    st.session_state['download_available'] = False
+    st.query_params.clear()
+
 
 # =============================================================================
 # SIDEBAR CONTROLS
 # =============================================================================
 st.sidebar.title('Control Assessment Options')
 if st.sidebar.button("New Conversation"):
+    cancel_assessment("new conversation")  # Stop the running assessment, if any
     # Clear conversation but retain system prompt
     st.session_state['conversation'] = [st.session_state['conversation'][0]]
     st.session_state['download_buffer'] = None
     st.session_state['download_available'] = False
+    st.session_state['metrics'] = None
+    st.session_state['assessment'] = None
+    st.session_state['assessment_id'] = None
+    st.session_state['chat_memory'] = ChatMemory()
+    session.clear()
+    st.query_params.clear()  # Forget the followed job
+
+# Per-stage time, token and cost panel, see src/control_metrics.py
+show_metrics = st.sidebar.toggle("Show stage metrics")
+show_timings = st.sidebar.toggle("Show startup/rerun timings")
+show_memory = st.sidebar.toggle("Show memory")
+
+# Past assessments: searched by words, classification and score in the assessment store
+# (src/control_store.py) and reopened without running the pipeline again
+store = get_store()
+if store is not None:
+    from src.control_prompts import CLASSIFICATION_LABELS, SCORE_VALUES
+    with st.sidebar.expander("Past Assessments"):
+        query = st.text_input("Search", placeholder="e.g. OFAC screening of beneficiaries")
+        label = st.selectbox("Classification", ("Any",) + CLASSIFICATION_LABELS)
+        score = st.selectbox("Score", ("Any",) + SCORE_VALUES)
+        label, score = (None if label == "Any" else label), (None if score == "Any" else score)
+        records = store.search(query, label, score, 10) if query.strip() else store.find(label, score, 10)
+        for record in records:
+            st.markdown(f"**{record['control_classification']} / {record['control_score']}**: "
+                        f"{record.get('snippet') or record['original_input'][:200]}")
+            if st.button("Open", key=f"open-{record['id']}"):
+                open_assessment(record)
+        if not records:
+            st.caption("No stored assessments match.")
 
 # -----------------------------------------------------------------------------
 # PAGE TITLE
@@ -45,12 +158,29 @@ st.title("Control Assessment Chat")
 # Display previous conversation
 for msg in st.session_state['conversation'][1:]:
     with st.chat_message(msg['role']):
-        st.markdown(msg['content'])
+        st.markdown(session.content(msg))
+
+timer.mark("first render")
+warm_up()
 
 # -----------------------------------------------------------------------------
 # USER INPUT AND RESPONSE HANDLING
 # -----------------------------------------------------------------------------
 user_input = st.chat_input("Ask me about the control or provide a new description...")
+
+# After a refresh, reattach to the assessment job of the page (see src/control_jobs.py) and replay it
+job_id = None
+if not user_input and st.query_params.get("job") and len(st.session_state['conversation']) == 1:
+    job = get_queue().get(st.query_params["job"]) if jobs_enabled() else None
+    if job is not None:
+        job_id, user_input = job["id"], job["original_input"]
+
+if user_input and job_id is None and st.session_state['cancel_token'] is not None:
+    # The assessment of the previous description was interrupted by this input: replace it
+    cancel_assessment("new input")
+    if st.session_state['conversation'][-1]["role"] == "user":
+        st.session_state['conversation'].pop()
+
 if user_input:
     # Append user message
     st.session_state['conversation'].append({"role": "user", "content": user_input})
@@ -60,66 +190,75 @@ if user_input:
     # Generate assistant response
     if len(st.session_state['conversation']) == 2:
         # First query: run full control pipeline
-        from src.control_classification import classify
-        from src.control_summary import summary
-        from src.control_risks import risks
-        from src.control_dependencies import dependencies
-        from src.control_gaps import gaps
-        from src.control_industry_practices import industry_practices
-        from src.control_score import score
-        from src.control_score_reasoning import score_reasoning
-
         buffer = io.BytesIO()
         state = {"openai_api_key": st.secrets["OPENAI_API_KEY"], "original_input": user_input}
+        state["cancel_token"] = st.session_state['cancel_token'] = CancelToken()
+        # on_idle touches the page while waiting, so a rerun (new input, New Conversation)
+        # interrupts this script run promptly and the run is cancelled
+        on_idle = lambda: heading.write("***Running full control assessment pipeline...***")
+        if jobs_enabled():
+            # Run in a worker process and follow the job; the page URL keeps its ID
+            job_id = job_id or get_queue().submit(user_input)
+            st.query_params["job"] = job_id
+            events = follow_job(get_queue(), job_id, state, on_idle=on_idle)
+        else:
+            events = iter_pipeline_stream(state, on_idle=on_idle)
         with st.chat_message("assistant"):
-            st.write("***Running full control assessment pipeline...***")
-
-            state = classify(state)
-            st.markdown(f"## **Classification:** \n {state['control_classification']}")
-
-            state = summary(state)
-            st.markdown(f"## **Summary:** \n {state['control_summary']}")
+            heading = st.empty()
+            heading.write("***Running full control assessment pipeline...***")
 
-            state = risks(state)
-            st.markdown(f"## **Risks:** \n {state['control_risk']}")
+            # Lay out every section in order; the stages run concurrently and stream their
+            # tokens into their section, which is finalised as soon as the stage completes.
+            sections = {key: st.empty() for _, key in SECTIONS}
+            titles = {key: title for title, key in SECTIONS}
+            streamed = {}
+            try:
+                for stage, token in events:
+                    if stage is None:
+                        # The job was requeued and starts over (src/control_jobs.RESTARTED)
+                        streamed.clear()
+                        for placeholder in sections.values():
+                            placeholder.empty()
+                    elif token is not None:
+                        key = stage.outputs[0]
+                        streamed[key] = streamed.get(key, "") + token
+                        sections[key].markdown(f"## **{titles[key]}:** \n {streamed[key]}▌")
+                    else:
+                        for key in stage.outputs:
+                            sections[key].markdown(f"## **{titles[key]}:** \n {state[key]}")
+            except JobFailed as error:
+                # Start over on the next input
+                st.session_state['conversation'].pop()
+                st.session_state['cancel_token'] = None
+                st.error(str(error))
+                st.stop()
+        st.session_state['cancel_token'] = None
 
-            state = dependencies(state)
-            st.markdown(f"## **Dependencies:** \n {state['control_dependencies']}")
+        # Store combined message after pipeline; marked, so that follow-ups send the
+        # relevant sections instead of the whole message
+        st.session_state['conversation'].append({"role": "assistant", "content": combined_message(state),
+                                                 "assessment": True})
+        st.session_state['assessment'] = {key: state.get(key) for key in ["original_input", *titles]}
+        # Keep the record for later searches and follow-ups about other controls
+        if store is not None:
+            st.session_state['assessment_id'] = store.save(state, "job" if jobs_enabled() else "interactive")
 
-            state = gaps(state)
-            st.markdown(f"## **Gaps:** \n {state['control_gaps']}")
-
-            state = industry_practices(state)
-            st.markdown(f"## **Industry Practices:** \n {state['control_industry_practices']}")
-
-            state = score(state)
-            st.markdown(f"## **Score:** \n {state['control_score']}")
-
-            state = score_reasoning(state)
-            st.markdown(f"## **Score Reasoning:** \n {state['control_score_reasoning']}")
-
-        # Store combined message after pipeline
-        combined = (
-            f"## Classification: \n {state['control_classification']}\n"+
-            f"## Summary: \n {state['control_summary']}\n"+
-            f"## Risks: \n {state['control_risk']}\n"+
-            f"## Dependencies: \n {state['control_dependencies']}\n"+
-            f"## Gaps: \n {state['control_gaps']}\n"+
-            f"## Industry Practices: \n {state['control_industry_practices']}\n"+
-            f"## Score: \n {state['control_score']}\n"+
-            f"## Score Reasoning: \n {state['control_score_reasoning']}"
-        )
-        st.session_state['conversation'].append({"role": "assistant", "content": combined})
+        # Keep the results as an Excel workbook for download
+        st.session_state['download_buffer'] = session.keep_buffer("workbook", write_workbook([state], buffer))
+        st.session_state['metrics'] = state.get("metrics")
     else:
-        # Follow-up: stream responses using chat model
+        # Follow-up: stream responses using chat model, from a token-bounded context of the
+        # relevant sections, a summary of older turns and the recent ones (src/control_followup.py),
+        # plus the stored assessments of other controls the question asks about
+        related = related_assessments(user_input, store, st.session_state['assessment_id'])
         with st.chat_message("assistant"):
-            stream = st.session_state['model'].chat.completions.create(
-                model="gpt-4o-mini",
-                messages=st.session_state['conversation'],
-                stream=True
-            )
+            stream = stream_followup(st.session_state['conversation'], st.session_state['assessment'],
+                                     st.session_state['chat_memory'], st.secrets["OPENAI_API_KEY"], related)
             response = st.write_stream(stream)
         st.session_state.conversation.append({"role": "assistant", "content": response})
+        # Fold turns that left the recent window into the rolling summary, after the answer is shown
+        compact_history(st.session_state['conversation'], st.session_state['chat_memory'],
+                        st.secrets["OPENAI_API_KEY"])
 
         # --------------------------------------------
         # DOWNLOAD OPTION
@@ -132,3 +271,37 @@ if user_input:
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
         st.session_state['download_available'] = True
+
+# -----------------------------------------------------------------------------
+# STAGE METRICS PANEL (optional): time, tokens and estimated cost of the last assessment
+# -----------------------------------------------------------------------------
+if show_metrics and st.session_state.get('metrics'):
+    from src.control_metrics import assessment_summary
+    totals = assessment_summary({"metrics": st.session_state['metrics']})
+    st.sidebar.subheader("Stage Metrics")
+    st.sidebar.metric("Estimated cost (USD)", f"{totals['cost_usd']:.4f}")
+    st.sidebar.metric("Tokens in / cached / out", f"{totals['input_tokens']} / {totals['cached_tokens']} / {totals['output_tokens']}")
+    st.sidebar.dataframe(stage_rows(st.session_state['metrics']), hide_index=True)
+
+# -----------------------------------------------------------------------------
+# SESSION MEMORY: spill what follow-ups no longer send (the combined assessment message and
+# the turns folded into the summary) once the chat outgrows its budget, then measure
+# -----------------------------------------------------------------------------
+chat_memory = st.session_state['chat_memory']
+session.bound(st.session_state['conversation'],
+              lambda index, message: index == 0 or (index >= chat_memory.summarized and not message.get("assessment")))
+session_bytes = session.measure(st.session_state)
+if show_memory:
+    gauges = memory_gauges()
+    st.sidebar.subheader("Memory")
+    st.sidebar.metric("This session in memory / spilled (KiB)",
+                      f"{session_bytes / 1024:.1f} / {session.spilled_bytes / 1024:.1f}")
+    st.sidebar.dataframe([{"gauge": name, "value": value} for name, value in gauges.items()], hide_index=True)
+
+# -----------------------------------------------------------------------------
+# TIMINGS PANEL (optional): import, first-render and total time of each script run
+# -----------------------------------------------------------------------------
+timer.finish()
+if show_timings:
+    st.sidebar.subheader("Script Runs (s)")
+    st.sidebar.dataframe(timer.runs()[::-1], hide_index=True)
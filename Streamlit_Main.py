@@ -1,29 +1,61 @@
 import os
 import io
 import time
+import threading
+started = time.perf_counter()
 
 import streamlit as st
 st. set_page_config(layout="wide")
-from openai import OpenAI
-import asyncio
-from src.control_classification import *
-from src.control_summary import *
-from src.control_risks import *
-from src.control_dependencies import *
-from src.control_gaps import *
-from src.control_industry_practices import *
-from src.control_score import *
-from src.control_score_reasoning import *
+# Light imports only: the OpenAI/LangChain packages are loaded by preload() below or on
+# the first stage call, and the workbook writer when there is a workbook to write
+from src.control_pipeline import SECTIONS, iter_pipeline_stream
+from src.control_jobs import JobFailed, follow_job, get_queue, jobs_enabled
+from src.control_cancellation import CancelToken
+from src.control_session import SessionMemory, memory_gauges
+from src.control_timing import ScriptTimer
 import warnings
 warnings.filterwarnings("ignore")
 
+# Startup/rerun timing of this session, see src/control_timing.py
+timer = ScriptTimer(st.session_state, started)
+timer.mark("imports")
+
+
+@st.cache_resource
+def warm_up() -> None:
+    # Once per server process: import the OpenAI/LangChain packages and open the shared
+    # clients in the background while the page renders
+    from src.control_clients import preload
+    threading.Thread(target=preload, name="control-preload", daemon=True).start()
+
+
+@st.cache_data
+def stage_rows(metrics: dict) -> list:
+    # Rows of the stage metrics panel; recomputed only when the metrics change
+    from src.control_metrics import stage_table
+    return [{"stage": row["stage"], "seconds": round(row["mean_seconds"], 2),
+             "first token (s)": round(row["mean_time_to_first_token"], 2) if row["mean_time_to_first_token"] is not None else None,
+             "input": row["input_tokens"], "cached": row["cached_tokens"], "output": row["output_tokens"],
+             "reasoning": row["reasoning_tokens"], "retries": row["retries"], "cost (USD)": round(row["cost_usd"], 5)}
+            for row in stage_table([{"stages": metrics}])]
+
+
+# Label shown above each section of the assessment
+SECTION_LABELS = {
+    "control_classification": "Classifying Control",
+    "control_summary": "Creating Control Summary",
+    "control_risk": "Control Risks",
+    "control_dependencies": "Control Dependencies",
+    "control_gaps": "Control Gaps",
+    "control_industry_practices": "Control Industry Best Practices",
+    "control_score": "Control Score",
+    "control_score_reasoning": "Control Score Reasoning",
+}
+
 # -----------------------------------------------------------------------------
-# INITIAL SETUP: Initialize the OpenAI client and conversation history in session state
+# INITIAL SETUP: Initialize the conversation history in session state
+# (OpenAI clients and chains are shared by all sessions, see src/control_clients.py)
 # -----------------------------------------------------------------------------
-if 'model' not in st.session_state:
-    # Instantiate the OpenAI client with your API key.
-    st.session_state['model'] = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-
 if 'conversation' not in st.session_state:
     # This list will hold the conversation messages.
     st.session_state['conversation'] = []
@@ -36,6 +68,27 @@ if 'download_buffer' not in st.session_state:
     st.session_state['download_buffer'] = None
 if 'download_available' not in st.session_state:
     st.session_state['download_available'] = False
+if 'metrics' not in st.session_state:
+    st.session_state['metrics'] = None
+# Cancels the assessment of this session that is still running, see src/control_cancellation.py
+if 'cancel_token' not in st.session_state:
+    st.session_state['cancel_token'] = None
+# Bounded working set: older messages and the workbook export spill to disk (src/control_session.py)
+if 'session_memory' not in st.session_state:
+    st.session_state['session_memory'] = SessionMemory()
+session = st.session_state['session_memory']
+
+
+def cancel_assessment(reason: str) -> None:
+    # Stop paying for an assessment nobody will read: the in-process run of an interrupted
+    # script run, or the followed job
+    token = st.session_state['cancel_token']
+    if token is not None:
+        token.cancel(reason)
+        st.session_state['cancel_token'] = None
+    if jobs_enabled() and st.query_params.get("job"):
+        get_queue().cancel(st.query_params["job"])
+
 
 # =============================================================================
 # SIDEBAR CONTROLS
@@ -44,10 +97,19 @@ st.sidebar.title('Control Assessment Options')
 
 # Button to start a new conversation
 if st.sidebar.button("New Conversation"):
+    cancel_assessment("new conversation")           # Stop the running assessment, if any
     st.session_state['conversation'] = []         # Clear conversation history
     st.session_state['new_conversation_flag'] = 0    # Reset flag
     st.session_state['download_buffer'] = None       # Clear stored download data
     st.session_state['download_available'] = False   # Reset download availability
+    st.session_state['metrics'] = None               # Clear stage metrics
+    session.clear()                                  # Delete spilled messages and exports
+    st.query_params.clear()                          # Forget the followed job
+
+# Per-stage time, token and cost panel, see src/control_metrics.py
+show_metrics = st.sidebar.toggle("Show stage metrics")
+show_timings = st.sidebar.toggle("Show startup/rerun timings")
+show_memory = st.sidebar.toggle("Show memory")
 
 # -----------------------------------------------------------------------------
 # PAGE TITLE
@@ -57,15 +119,27 @@ st.title("Control Assessment")
 # Display all previous conversation messages in order (rendered as Markdown)
 for msg in st.session_state['conversation']:
     with st.chat_message(msg['role']):
-        st.markdown(msg['content'])
+        st.markdown(session.content(msg))
 
 # -----------------------------------------------------------------------------
 # USER INPUT AND RESPONSE HANDLING
 # -----------------------------------------------------------------------------
+timer.mark("first render")
+warm_up()
+
 # Get the user's legal query.
 user_input = st.chat_input("Hello! Please provide the Control Description:")
 
+# After a refresh, reattach to the job of the page (see src/control_jobs.py) and replay it
+job_id = None
+if not user_input and jobs_enabled() and st.query_params.get("job") and not st.session_state['conversation']:
+    job = get_queue().get(st.query_params["job"])
+    if job is not None:
+        job_id, user_input = job["id"], job["original_input"]
+
 if user_input:
+    if job_id is None:
+        cancel_assessment("new input")              # A newer description replaces the running one
     # Append the user's message to the conversation history.
     st.session_state['conversation'].append({"role": "user", "content": user_input})
     with st.chat_message("user"):
@@ -77,55 +151,96 @@ if user_input:
         buffer = io.BytesIO()
         # Create the response
         state = {"openai_api_key": st.secrets["OPENAI_API_KEY"], "original_input": user_input}
-        with st.status("Running analysis..."):
-            ### Validating Documents
-            st.write("***Classifying Control...*** \n")
-            state = classify(state)
-            st.markdown(f"{state['control_classification']}", unsafe_allow_html=True)
-            st.markdown("\n")
-
-            ### Creating Control 1 Line Summary
-            st.write("***Creating Control Summary...*** \n")
-            state = summary(state)
-            st.markdown(f"{state['control_summary']}", unsafe_allow_html=True)
-            st.markdown("\n")
-
-            ### Control Risks
-            st.write("***Control Risks...*** \n")
-            state = risks(state)
-            st.markdown(f"{state['control_risk']}", unsafe_allow_html=True)
-            st.markdown("\n")
-
-            ## Control Dependencies
-            st.write("***Control Dependencies...*** \n")
-            state = dependencies(state)
-            st.markdown(f"{state['control_dependencies']}", unsafe_allow_html=True)
-            st.markdown("\n")
-
-            # Control Gaps
-            st.write("***Control Gaps...*** \n")
-            state = gaps(state)
-            st.markdown(f"{state['control_gaps']}", unsafe_allow_html=True)
-            st.markdown("\n")
-
-            # Control Industry Best Practices
-            st.write("***Control Industry Best Practices...*** \n")
-            state = industry_practices(state)
-            st.markdown(f"{state['control_industry_practices']}", unsafe_allow_html=True)
-            st.markdown("\n")
-
-            # Control Scores
-            st.write("***Control Score...*** \n")
-            state = score(state)
-            st.markdown(f"{state['control_score']}", unsafe_allow_html=True)
-            st.markdown("\n")
-
-            # Control Score Reasoning
-            st.write("***Control Score Reasoning...*** \n")
-            state = score_reasoning(state)
-            st.markdown(f"{state['control_score_reasoning']}", unsafe_allow_html=True)
-            st.markdown("\n")
-
+        state["cancel_token"] = st.session_state['cancel_token'] = CancelToken()
+        if jobs_enabled():
+            # Run in a worker process and follow the job; the page URL keeps its ID
+            job_id = job_id or get_queue().submit(user_input)
+            st.query_params["job"] = job_id
+            events = follow_job(get_queue(), job_id, state, on_idle=lambda: status.update(label="Running analysis..."))
+        else:
+            # on_idle touches the page while waiting, so a rerun (new input, New Conversation)
+            # interrupts this script run promptly and the run is cancelled
+            events = iter_pipeline_stream(state, on_idle=lambda: status.update(label="Running analysis..."))
+        with st.status("Running analysis...") as status:
+            # Lay out every section up front; the stages run concurrently and stream their
+            # tokens into their section, which is finalised as soon as the stage completes.
+            sections = {}
+            for _, key in SECTIONS:
+                st.write(f"***{SECTION_LABELS[key]}...*** \n")
+                sections[key] = st.empty()
+                st.markdown("\n")
+
+            streamed = {}
+            try:
+                for stage, token in events:
+                    if stage is None:
+                        # The job was requeued and starts over (src/control_jobs.RESTARTED)
+                        streamed.clear()
+                        for placeholder in sections.values():
+                            placeholder.empty()
+                    elif token is not None:
+                        key = stage.outputs[0]
+                        streamed[key] = streamed.get(key, "") + token
+                        sections[key].markdown(streamed[key] + "▌", unsafe_allow_html=True)
+                    else:
+                        for key in stage.outputs:
+                            sections[key].markdown(f"{state[key]}", unsafe_allow_html=True)
+            except JobFailed as error:
+                st.session_state['cancel_token'] = None
+                st.error(str(error))
+                st.stop()
+        st.session_state['cancel_token'] = None
+
+        # Keep the record for searches and follow-up questions, see src/control_store.py
+        from src.control_store import get_store
+        if get_store() is not None:
+            get_store().save(state, "job" if jobs_enabled() else "interactive")
+
+        # Keep the results as an Excel workbook for download
+        from src.control_batch import write_workbook
+        st.session_state['download_buffer'] = session.keep_buffer("workbook", write_workbook([state], buffer))
+        st.session_state['metrics'] = state.get("metrics")
+
+    # -----------------------------------------------------------------------------
+    # DOWNLOAD OPTION
+    # -----------------------------------------------------------------------------
+    if st.session_state['download_buffer'] is not None and not st.session_state['download_available']:
+        st.download_button(
+            label="Download Excel Results",
+            data=st.session_state['download_buffer'],
+            file_name="control_assessment.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+        st.session_state['download_available'] = True
 
+# -----------------------------------------------------------------------------
+# STAGE METRICS PANEL (optional): time, tokens and estimated cost of the last assessment
+# -----------------------------------------------------------------------------
+if show_metrics and st.session_state.get('metrics'):
+    from src.control_metrics import assessment_summary
+    totals = assessment_summary({"metrics": st.session_state['metrics']})
+    st.sidebar.subheader("Stage Metrics")
+    st.sidebar.metric("Estimated cost (USD)", f"{totals['cost_usd']:.4f}")
+    st.sidebar.metric("Tokens in / cached / out", f"{totals['input_tokens']} / {totals['cached_tokens']} / {totals['output_tokens']}")
+    st.sidebar.dataframe(stage_rows(st.session_state['metrics']), hide_index=True)
 
+# -----------------------------------------------------------------------------
+# SESSION MEMORY: spill the oldest messages once the session outgrows its budget, then measure
+# -----------------------------------------------------------------------------
+conversation = st.session_state['conversation']
+session.bound(conversation, lambda index, message: index == len(conversation) - 1)
+session_bytes = session.measure(st.session_state)
+if show_memory:
+    gauges = memory_gauges()
+    st.sidebar.subheader("Memory")
+    st.sidebar.metric("This session in memory / spilled (KiB)",
+                      f"{session_bytes / 1024:.1f} / {session.spilled_bytes / 1024:.1f}")
+    st.sidebar.dataframe([{"gauge": name, "value": value} for name, value in gauges.items()], hide_index=True)
 
+# -----------------------------------------------------------------------------
+# TIMINGS PANEL (optional): import, first-render and total time of each script run
+# -----------------------------------------------------------------------------
+timer.finish()
+if show_timings:
+    st.sidebar.subheader("Script Runs (s)")
+    st.sidebar.dataframe(timer.runs()[::-1], hide_index=True)
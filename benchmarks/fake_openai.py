@@ -0,0 +1,484 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, for measuring the orchestration
+code without paying for (or waiting on) real model calls.
+
+Point ``ChatOpenAI``/``OpenAI`` at it with ``OPENAI_BASE_URL=http://127.0.0.1:<port>/v1``.
+It answers ``POST /v1/chat/completions`` with plausible content for each stage (a label
+for classify, a score for score, bullet points otherwise, and a schema-conforming JSON
+object for ``response_format`` requests), streams server-sent events when asked, reports
+token usage (with reasoning tokens for o-series models and prefix-cached tokens for
+repeated system prompts) and ``x-ratelimit-*`` headers, and can inject 429 and 5xx errors.
+Answers that do not fit the request's ``max_completion_tokens`` (reasoning tokens
+included) are cut off with the finish reason "length", like the real API's.
+
+It also serves the Batch API (``/v1/files`` and ``/v1/batches``): a submitted batch is
+"in_progress" for ``batch_delay`` seconds, then completes with an output file answering
+each request like the chat completions endpoint (requests drawn as server errors go to
+the error file).
+
+Latencies are drawn from a distribution given as ``<kind>:<parameters>``:
+
+- ``fixed:0.5``: always 0.5 s
+- ``uniform:0.2,1.5``: uniform between 0.2 and 1.5 s
+- ``lognormal:1.0,0.5``: log-normal with a median of 1.0 s and sigma 0.5
+
+Usage::
+
+    python -m benchmarks.fake_openai --port 8000 --latency lognormal:1.0,0.5 --rate-limit 0.05
+"""
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+CLASSIFICATION_LABELS = ("Validation", "Duplicates", "Sanctions", "Fraud", "Insufficient Funds",
+                         "High Dollar Escalation", "Completed Fields", "Travel Rules")
+
+BULLETS = (
+    "Payments could be released without an independent review of the instruction",
+    "The control relies on the accuracy of the upstream reference data",
+    "Manual overrides are not logged with a reason code",
+    "Thresholds are not reviewed after changes in payment volumes",
+    "Exceptions queue ownership is not defined outside business hours",
+    "Industry practice is to apply a four-eyes check with role separation, as large banks do for wires",
+)
+
+RUBRIC_SUB_CATEGORIES = ("Risk Coverage", "Control Design", "Documentation", "Transaction Coverage", "Execution",
+                         "Ownership", "Dependencies", "Testing", "Reporting and KPIs", "Governance")
+
+# Reasoning tokens generated per call by o-series models, by reasoning_effort
+REASONING_TOKENS = {"low": 64, "medium": 256, "high": 1024}
+
+# Provider prefix caching: prompts of at least this many tokens are cached in these increments
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+
+# Per-minute limits reported in the rate-limit headers when no request limit is set
+REPORTED_LIMITS = {"requests": 30_000, "tokens": 150_000_000}
+
+
+class Latency:
+    """
+    A latency distribution parsed from ``<kind>:<parameters>`` (see the module docstring).
+    """
+
+    def __init__(self, spec: str):
+        kind, _, parameters = spec.partition(":")
+        self.kind = kind
+        self.parameters = [float(value) for value in parameters.split(",") if value]
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2}
+        if expected.get(kind) != len(self.parameters):
+            raise ValueError(f"Invalid latency {spec!r}; expected fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+        self.spec = spec
+
+    def sample(self, generator: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.parameters[0]
+        if self.kind == "uniform":
+            return generator.uniform(*self.parameters)
+        median, sigma = self.parameters
+        return generator.lognormvariate(math.log(median), sigma)
+
+
+def count_tokens(text: str) -> int:
+    # About four characters per token for English text
+    return max(1, len(text) // 4)
+
+
+def schema_instance(schema: Dict[str, Any], generator: random.Random) -> Any:
+    """
+    A value conforming to a (strict, OpenAI-subset) JSON schema.
+    """
+    if "enum" in schema:
+        return generator.choice(schema["enum"])
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((item for item in kind if item != "null"), "null")
+    if kind == "object":
+        return {name: schema_instance(child, generator) for name, child in schema.get("properties", {}).items()}
+    if kind == "array":
+        count = max(schema.get("minItems", 3), min(schema.get("maxItems", 5), 5))
+        return [schema_instance(schema.get("items", {"type": "string"}), generator) for _ in range(count)]
+    if kind == "integer":
+        return generator.randint(schema.get("minimum", 0), schema.get("maximum", 10))
+    if kind == "number":
+        return round(generator.uniform(schema.get("minimum", 0), schema.get("maximum", 1)), 3)
+    if kind == "boolean":
+        return generator.random() < 0.5
+    if kind == "null":
+        return None
+    return generator.choice(BULLETS)
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    """
+    The stand-in server. Start it with :meth:`start`; the settings may be changed while it runs.
+
+    :ivar latency: Time to the first token.
+    :ivar token_delay: Seconds between streamed chunks.
+    :ivar rate_limit: Probability of answering 429 Too Many Requests.
+    :ivar server_errors: Probability of answering 500.
+    :ivar requests_per_minute: Answer 429 above this request rate (None: unlimited).
+    :ivar batch_delay: Seconds a submitted batch stays in progress.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: str = "fixed:0.2",
+                 token_delay: float = 0.005, rate_limit: float = 0.0, server_errors: float = 0.0,
+                 requests_per_minute: Optional[int] = None, seed: int = 0, batch_delay: float = 1.0):
+        super().__init__((host, port), _Handler)
+        self.latency = Latency(latency)
+        self.token_delay = token_delay
+        self.rate_limit = rate_limit
+        self.server_errors = server_errors
+        self.requests_per_minute = requests_per_minute
+        self.batch_delay = batch_delay
+        self.generator = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "rate_limited": 0, "server_errors": 0, "in_flight": 0, "max_in_flight": 0,
+                      "disconnected": 0, "batches": 0, "batch_requests": 0}
+        self.files: Dict[str, Tuple[Dict[str, Any], bytes]] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self._recent: List[float] = []
+        self._cached_prefixes = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def start(self) -> "FakeOpenAI":
+        threading.Thread(target=self.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def admit(self) -> Tuple[Optional[int], float]:
+        # -> (error status or None, latency; for a 429 the delay until a retry may succeed)
+        with self.lock:
+            self.stats["requests"] += 1
+            now = time.monotonic()
+            self._recent = [moment for moment in self._recent if now - moment < 60]
+            roll = self.generator.random()
+            latency = self.latency.sample(self.generator)
+            if self.requests_per_minute is not None and len(self._recent) >= self.requests_per_minute:
+                self.stats["rate_limited"] += 1
+                return 429, 60 - (now - self._recent[0])
+            if roll < self.rate_limit:
+                self.stats["rate_limited"] += 1
+                return 429, 0.05
+            if roll < self.rate_limit + self.server_errors:
+                self.stats["server_errors"] += 1
+                return 500, 0.0
+            self._recent.append(now)
+            return None, latency
+
+    def rate_limit_headers(self) -> Dict[str, str]:
+        """
+        The ``x-ratelimit-*`` headers the API sends with every response: the configured request
+        rate, or the generous ``REPORTED_LIMITS`` when it is unlimited. Tokens are not limited.
+        """
+        limit = self.requests_per_minute or REPORTED_LIMITS["requests"]
+        with self.lock:
+            now = time.monotonic()
+            reset = 60 - (now - self._recent[0]) if self._recent else 0.0
+            used = len(self._recent)
+        return {"x-ratelimit-limit-requests": str(limit),
+                "x-ratelimit-remaining-requests": str(max(0, limit - used)),
+                "x-ratelimit-reset-requests": f"{reset:.3f}s",
+                "x-ratelimit-limit-tokens": str(REPORTED_LIMITS["tokens"]),
+                "x-ratelimit-remaining-tokens": str(REPORTED_LIMITS["tokens"])}
+
+    def cached_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        # The system message is the shared, cacheable prefix
+        system = "".join(str(message.get("content")) for message in messages if message.get("role") in ("system", "developer"))
+        tokens = count_tokens(system)
+        if tokens < CACHE_MIN_TOKENS:
+            return 0
+        digest = hashlib.sha256(system.encode("utf-8")).hexdigest()
+        with self.lock:
+            seen = digest in self._cached_prefixes
+            self._cached_prefixes.add(digest)
+        return tokens // CACHE_INCREMENT * CACHE_INCREMENT if seen else 0
+
+    def content(self, body: Dict[str, Any]) -> str:
+        with self.lock:
+            generator = random.Random(self.generator.random())
+        response_format = body.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            return json.dumps(schema_instance(response_format["json_schema"]["schema"], generator))
+        prompt = json.dumps(body.get("messages", []))
+        if "classify the input control" in prompt:
+            return generator.choice(CLASSIFICATION_LABELS)
+        if "Return only the score" in prompt:
+            return generator.choice(("Low", "Medium", "High"))
+        if "reasoning behind the score" in prompt:
+            # A positive and a negative point per rubric row
+            return "\n".join(f"**{row}**\n- Positive: {positive}\n- Negative: {negative}" for row in RUBRIC_SUB_CATEGORIES
+                             for positive, negative in [generator.sample(BULLETS, 2)])
+        return "\n".join(f"- {bullet}" for bullet in generator.sample(BULLETS, 4))
+
+    def completion(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        The ``chat.completion`` object answering a request body.
+        """
+        model = body.get("model", "gpt-4o-mini")
+        content = self.content(body)
+        messages = body.get("messages", [])
+        prompt_tokens = sum(count_tokens(str(message.get("content"))) for message in messages)
+        reasoning_tokens = REASONING_TOKENS.get(body.get("reasoning_effort") or "medium", 0) if model.startswith("o") else 0
+        finish_reason = "stop"
+        budget = body.get("max_completion_tokens") or body.get("max_tokens")
+        if budget and count_tokens(content) + reasoning_tokens > budget:
+            # Reasoning comes first and may leave no room for the answer at all
+            reasoning_tokens = min(reasoning_tokens, budget)
+            content = content[:(budget - reasoning_tokens) * 4]
+            finish_reason = "length"
+        content_tokens = count_tokens(content) if content else 0
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": content_tokens + reasoning_tokens,
+            "total_tokens": prompt_tokens + content_tokens + reasoning_tokens,
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens(messages)},
+            "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
+        }
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": usage,
+        }
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> Dict[str, Any]:
+        """
+        Store an uploaded or generated file and return its ``file`` object.
+        """
+        file = {"id": f"file-{uuid.uuid4().hex}", "object": "file", "bytes": len(content),
+                "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"}
+        with self.lock:
+            self.files[file["id"]] = (file, content)
+        return file
+
+    def create_batch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Queue a batch over an uploaded input file and return its ``batch`` object.
+        """
+        batch = {"id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": request["endpoint"],
+                 "input_file_id": request["input_file_id"], "completion_window": request.get("completion_window", "24h"),
+                 "status": "validating", "created_at": int(time.time()), "output_file_id": None, "error_file_id": None,
+                 "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": request.get("metadata")}
+        with self.lock:
+            self.batches[batch["id"]] = batch
+            self.stats["batches"] += 1
+        threading.Thread(target=self._run_batch, args=(batch,), name="fake-openai-batch", daemon=True).start()
+        return batch
+
+    def _run_batch(self, batch: Dict[str, Any]) -> None:
+        lines = [json.loads(line) for line in self.files[batch["input_file_id"]][1].decode("utf-8").splitlines()
+                 if line.strip()]
+        with self.lock:
+            batch.update(status="in_progress", in_progress_at=int(time.time()))
+            batch["request_counts"]["total"] = len(lines)
+        time.sleep(self.batch_delay)
+        outputs, errors = [], []
+        for line in lines:
+            with self.lock:
+                self.stats["batch_requests"] += 1
+                failed = self.generator.random() < self.server_errors
+            if failed:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": line["custom_id"],
+                               "response": {"status_code": 500, "body": {"error": {
+                                   "message": "The server had an error", "type": "server_error"}}}, "error": None})
+            else:
+                outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": line["custom_id"],
+                                "response": {"status_code": 200, "body": self.completion(line["body"])}, "error": None})
+        output = self.add_file("".join(json.dumps(item) + "\n" for item in outputs).encode("utf-8"),
+                               "batch_output.jsonl", "batch_output") if outputs else None
+        error = self.add_file("".join(json.dumps(item) + "\n" for item in errors).encode("utf-8"),
+                              "batch_errors.jsonl", "batch_output") if errors else None
+        with self.lock:
+            if batch["status"] == "cancelling":
+                batch.update(status="cancelled", cancelled_at=int(time.time()))
+                return
+            batch.update(status="completed", completed_at=int(time.time()),
+                         output_file_id=output["id"] if output else None, error_file_id=error["id"] if error else None)
+            batch["request_counts"].update(completed=len(outputs), failed=len(errors))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeOpenAI
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self) -> None:
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_GET(self) -> None:
+        parts = self.path.split("?")[0].strip("/").split("/")
+        server = self.server
+        if parts[:2] == ["v1", "files"] and len(parts) in (3, 4) and parts[2] in server.files:
+            file, content = server.files[parts[2]]
+            if len(parts) == 3:
+                self._send_json(200, file)
+                return
+            if parts[3] == "content":
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                return
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in server.batches:
+            with server.lock:
+                batch = dict(server.batches[parts[2]])
+            self._send_json(200, batch)
+            return
+        self._not_found()
+
+    def do_POST(self) -> None:
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.rstrip("/")
+        server = self.server
+        if path == "/v1/files":
+            # multipart/form-data with the "file" and its "purpose"
+            message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+                f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode("utf-8") + data)
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+            upload = fields["file"]
+            self._send_json(200, server.add_file(upload.get_payload(decode=True), upload.get_filename() or "upload",
+                                                 fields["purpose"].get_content().strip()))
+            return
+        body = json.loads(data or b"{}")
+        if path == "/v1/batches":
+            if body.get("input_file_id") not in server.files:
+                self._send_json(400, {"error": {"message": "Unknown input file", "type": "invalid_request_error"}})
+                return
+            self._send_json(200, server.create_batch(body))
+            return
+        if path.startswith("/v1/batches/") and path.endswith("/cancel"):
+            batch = server.batches.get(path.split("/")[3])
+            if batch is None:
+                self._not_found()
+                return
+            with server.lock:
+                if batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+                    batch["status"] = "cancelling"
+                payload = dict(batch)
+            self._send_json(200, payload)
+            return
+        if path != "/v1/chat/completions":
+            self._not_found()
+            return
+
+        server = self.server
+        status, latency = server.admit()
+        if status == 429:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                            {"retry-after-ms": str(int(latency * 1000)), "x-ratelimit-remaining-requests": "0"})
+            return
+        if status is not None:
+            self._send_json(status, {"error": {"message": "The server had an error", "type": "server_error"}})
+            return
+
+        with server.lock:
+            server.stats["in_flight"] += 1
+            server.stats["max_in_flight"] = max(server.stats["max_in_flight"], server.stats["in_flight"])
+        try:
+            time.sleep(latency)
+            self._complete(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client aborted the call, e.g. a cancelled assessment
+            with server.lock:
+                server.stats["disconnected"] += 1
+            self.close_connection = True
+        finally:
+            with server.lock:
+                server.stats["in_flight"] -= 1
+
+    def _complete(self, body: Dict[str, Any]) -> None:
+        server = self.server
+        completion = server.completion(body)
+        if not body.get("stream"):
+            self._send_json(200, completion, server.rate_limit_headers())
+            return
+        completion_id, created, model = completion["id"], completion["created"], completion["model"]
+        choice, usage = completion["choices"][0], completion["usage"]
+        content = choice["message"]["content"]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        for name, value in server.rate_limit_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta: Dict[str, Any], finish_reason: Optional[str] = None, with_usage: bool = False) -> None:
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [] if with_usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            if with_usage:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        event({"role": "assistant", "content": ""})
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            event({"content": word if index == len(words) - 1 else word + " "})
+            time.sleep(server.token_delay)
+        event({}, choice["finish_reason"])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            event({}, with_usage=True)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the OpenAI chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="lognormal:1.0,0.5", help="time to first token distribution")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="probability of a 429 response")
+    parser.add_argument("--server-errors", type=float, default=0.0, help="probability of a 500 response")
+    parser.add_argument("--rpm", type=int, help="answer 429 above this many requests per minute")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="seconds a submitted batch stays in progress")
+    args = parser.parse_args()
+
+    server = FakeOpenAI(args.host, args.port, args.latency, args.token_delay, args.rate_limit,
+                        args.server_errors, args.rpm, args.seed, args.batch_delay)
+    print(f"Serving on {server.base_url} (set OPENAI_BASE_URL to use it)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Compare the four per-stage section calls (risks, dependencies, gaps, industry_practices)
+with the fused structured-output call, in tokens and latency.
+
+Both modes bypass the response cache. Per-stage mode runs the four calls concurrently, as
+the pipeline does, so its latency is that of the slowest of the four.
+
+Usage::
+
+    python -m benchmarks.fused_sections controls.csv --column "Control Description" --limit 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import Any, Dict, List
+from langchain_core.callbacks import BaseCallbackHandler
+from tabulate import tabulate
+from src.control_batch import read_controls
+from src.control_risks import arisks
+from src.control_dependencies import adependencies
+from src.control_gaps import agaps
+from src.control_industry_practices import aindustry_practices
+from src.control_sections import asections
+
+SAMPLE_CONTROLS = [
+    "Outgoing wires above $20 million are held in a queue and released only after a second approver in "
+    "Treasury Operations reviews the payment details against the original client instruction.",
+    "All beneficiary names and banks on cross-border payments are screened in real time against the "
+    "OFAC SDN list; potential matches are routed to the sanctions team for disposition within 2 hours.",
+    "The payment hub rejects any ACH file in which a payment with the same amount, beneficiary account "
+    "and value date was already submitted within the last 5 business days.",
+]
+
+
+class UsageCollector(BaseCallbackHandler):
+    """Sums the token usage reported by every LLM call it observes."""
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.reasoning_tokens = 0
+
+    def on_llm_end(self, response, **kwargs: Any) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                self.calls += 1
+                self.input_tokens += usage.get("input_tokens", 0)
+                self.output_tokens += usage.get("output_tokens", 0)
+                self.reasoning_tokens += usage.get("output_token_details", {}).get("reasoning", 0)
+
+
+async def per_stage(state: Dict[str, Any]) -> None:
+    await asyncio.gather(arisks(dict(state)), adependencies(dict(state)), agaps(dict(state)),
+                         aindustry_practices(dict(state)))
+
+
+async def fused(state: Dict[str, Any]) -> None:
+    await asections(state)
+
+
+async def benchmark(controls: List[str], api_key: str) -> List[List[Any]]:
+    rows = []
+    for name, mode in (("per-stage", per_stage), ("fused", fused)):
+        usage = UsageCollector()
+        latencies = []
+        for control in controls:
+            state = {"openai_api_key": api_key, "original_input": control, "use_cache": False, "callbacks": [usage]}
+            started = time.perf_counter()
+            await mode(state)
+            latencies.append(time.perf_counter() - started)
+        count = len(controls)
+        rows.append([name, usage.calls / count, usage.input_tokens / count, usage.output_tokens / count,
+                     usage.reasoning_tokens / count, statistics.mean(latencies), statistics.median(latencies),
+                     max(latencies)])
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark fused vs per-stage section generation.")
+    parser.add_argument("input", nargs="?", help="CSV or XLSX of control descriptions (default: built-in samples)")
+    parser.add_argument("--column", help="header of the control description column")
+    parser.add_argument("--limit", type=int, default=5, help="number of controls to run")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"))
+    args = parser.parse_args()
+
+    if not args.api_key:
+        parser.error("an OpenAI API key is required (--api-key or $OPENAI_API_KEY)")
+    if args.input:
+        controls = [text for _, text in read_controls(args.input, args.column)][:args.limit]
+    else:
+        controls = SAMPLE_CONTROLS[:args.limit]
+
+    rows = asyncio.run(benchmark(controls, args.api_key))
+    print(f"Per-control averages over {len(controls)} controls")
+    print(tabulate(rows, headers=["mode", "calls", "input tokens", "output tokens", "reasoning tokens",
+                                  "mean s", "p50 s", "max s"], floatfmt=".2f"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Check provider-side prompt prefix caching: runs every stage twice on the same control,
+bypassing the local response cache, and reports input, cached and output tokens and the
+latency of each call. On the second round the shared prompt prefix should be served from
+the provider cache (cached tokens > 0, lower latency).
+
+Usage::
+
+    python -m benchmarks.prefix_cache "Outgoing wires above $20 million require a second approver."
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Any, List
+from tabulate import tabulate
+from src.control_pipeline import pipeline_stages
+
+
+async def benchmark(control: str, api_key: str, rounds: int) -> List[List[Any]]:
+    rows = []
+    for number in range(1, rounds + 1):
+        state = {"openai_api_key": api_key, "original_input": control, "use_cache": False}
+        # Stages run one at a time so each latency is attributable to its own call
+        for stage in pipeline_stages():
+            started = time.perf_counter()
+            await stage.arun(state)
+            elapsed = time.perf_counter() - started
+            metrics = state["metrics"].pop(stage.name, {})
+            rows.append([number, stage.name, metrics.get("input_tokens", 0), metrics.get("cached_tokens", 0),
+                         metrics.get("output_tokens", 0), elapsed])
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure prompt prefix cache hits per stage.")
+    parser.add_argument("control", help="control description to assess")
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"))
+    args = parser.parse_args()
+
+    if not args.api_key:
+        parser.error("an OpenAI API key is required (--api-key or $OPENAI_API_KEY)")
+    rows = asyncio.run(benchmark(args.control, args.api_key, args.rounds))
+    print(tabulate(rows, headers=["round", "stage", "input tokens", "cached tokens", "output tokens", "seconds"],
+                   floatfmt=".2f"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Compare a routing policy (see src/control_routing.py) with the unrouted baseline, in which
+every stage runs with its own settings (o3-mini at "high" effort for most of them).
+
+Each control is assessed twice, first unrouted, then routed. Both runs bypass the
+response cache. For every stage the script reports the mean stage latency of both runs,
+the saving, the cost, and how often the routed answer agrees with the baseline: exact
+agreement for the label stages (classify, score), mean word overlap (Jaccard) for the
+text stages. With ``--label-column`` it also reports the accuracy of both runs' scores
+against the labelled sample. The rules the policy applied are counted per stage.
+
+Usage::
+
+    python -m benchmarks.routing_eval labelled.csv --column "Control Description" --label-column "Score" \\
+        --stages score,gaps --policy routing.json --limit 50
+"""
+import argparse
+import asyncio
+import os
+import re
+import statistics
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from tabulate import tabulate
+from src.control_batch import read_controls
+from src.control_pipeline import Stage, arun_pipeline, pipeline_stages
+from src.control_routing import EXAMPLE_POLICY, RoutingPolicy, get_policy
+
+SAMPLE_CONTROLS = [
+    ("Second approver for wires above $20m.", None),
+    ("Duplicate ACH payments within 5 days are rejected.", None),
+    ("All beneficiary names and banks on cross-border payments are screened in real time against the OFAC SDN "
+     "list; potential matches are routed to the sanctions team for disposition within 2 hours, and the "
+     "disposition with its evidence is retained for seven years. The screening rules are tuned quarterly by "
+     "the Financial Crimes Compliance team and tested against a sample of known true positives.", None),
+]
+
+# Stages answering with a label, compared exactly
+LABEL_STAGES = ("classify", "score")
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def overlap(first: Any, second: Any) -> float:
+    """
+    Jaccard similarity of the word sets of two answers.
+
+    :rtype: float
+    """
+    words = set(WORD.findall(str(first or "").lower())), set(WORD.findall(str(second or "").lower()))
+    union = words[0] | words[1]
+    return len(words[0] & words[1]) / len(union) if union else 1.0
+
+
+def with_prerequisites(names: Sequence[str]) -> List[Stage]:
+    """
+    The named stages of the pipeline, plus the stages producing their inputs.
+
+    :raises ValueError: On an unknown stage name.
+    """
+    stages = pipeline_stages()
+    by_output = {key: stage for stage in stages for key in stage.outputs}
+    by_name = {stage.name: stage for stage in stages}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown stages {', '.join(unknown)}; expected some of {', '.join(by_name)}")
+    selected, pending = set(), list(names)
+    while pending:
+        stage = by_name[pending.pop()]
+        if stage.name not in selected:
+            selected.add(stage.name)
+            pending.extend(by_output[key].name for key in stage.inputs if key in by_output)
+    return [stage for stage in stages if stage.name in selected]
+
+
+async def assess(control: str, api_key: str, stages: Sequence[Stage],
+                 policy: Optional[RoutingPolicy]) -> Dict[str, Any]:
+    state = {"openai_api_key": api_key, "original_input": control, "use_cache": False, "routing_policy": policy}
+    async for _ in arun_pipeline(state, stages):
+        pass
+    return state
+
+
+async def evaluate(controls: List[Tuple[str, Optional[str]]], api_key: str, names: Sequence[str],
+                   policy: RoutingPolicy) -> Tuple[List[List[Any]], Dict[str, Counter], Dict[str, List[float]]]:
+    stages = with_prerequisites(names)
+    runs = []
+    for control, label in controls:
+        baseline = await assess(control, api_key, stages, None)
+        routed = await assess(control, api_key, stages, policy)
+        runs.append((label, baseline, routed))
+
+    rows, rules = [], {}
+    accuracy = {"baseline": [], "routed": []}
+    for stage in stages:
+        if stage.name not in names:
+            continue
+        key = stage.outputs[0]
+        records = [(baseline["metrics"][stage.name], routed["metrics"][stage.name]) for _, baseline, routed in runs]
+        baseline_seconds = statistics.mean(first["wall_seconds"] for first, _ in records)
+        routed_seconds = statistics.mean(second["wall_seconds"] for _, second in records)
+        if stage.name in LABEL_STAGES:
+            agreement = statistics.mean(float(baseline[key] == routed[key]) for _, baseline, routed in runs)
+        else:
+            agreement = statistics.mean(overlap(baseline[key], routed[key]) for _, baseline, routed in runs)
+        rows.append([stage.name, baseline_seconds, routed_seconds,
+                     100 * (1 - routed_seconds / baseline_seconds) if baseline_seconds else 0.0,
+                     statistics.mean(first["cost_usd"] for first, _ in records),
+                     statistics.mean(second["cost_usd"] for _, second in records), agreement])
+        rules[stage.name] = Counter((routed.get("routing") or {}).get(stage.name, {}).get("rule", "(own settings)")
+                                    for _, _, routed in runs)
+        if stage.name == "score":
+            for label, baseline, routed in runs:
+                if label is not None:
+                    accuracy["baseline"].append(float(baseline[key].lower() == label.strip().lower()))
+                    accuracy["routed"].append(float(routed[key].lower() == label.strip().lower()))
+    return rows, rules, accuracy
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare a routing policy with the unrouted baseline.")
+    parser.add_argument("input", nargs="?", help="CSV or XLSX of control descriptions (default: built-in samples)")
+    parser.add_argument("--column", help="header of the control description column")
+    parser.add_argument("--label-column", help="header of a column with the expected score (Low/Medium/High)")
+    parser.add_argument("--stages", default="score,dependencies,gaps,industry_practices,score_reasoning",
+                        help="comma-separated stages to compare")
+    parser.add_argument("--policy",
+                        help="routing policy JSON file (default: $CONTROL_ROUTING_POLICY or the example policy)")
+    parser.add_argument("--limit", type=int, default=20, help="number of controls to run")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"))
+    args = parser.parse_args()
+
+    if not args.api_key:
+        parser.error("an OpenAI API key is required (--api-key or $OPENAI_API_KEY)")
+    if args.input:
+        texts = [text for _, text in read_controls(args.input, args.column)]
+        labels = [text for _, text in read_controls(args.input, args.label_column)] if args.label_column else None
+        controls = list(zip(texts, labels or [None] * len(texts)))[:args.limit]
+    else:
+        controls = SAMPLE_CONTROLS[:args.limit]
+    policy = RoutingPolicy.from_file(args.policy) if args.policy else get_policy() or RoutingPolicy(EXAMPLE_POLICY)
+    names = [name.strip() for name in args.stages.split(",") if name.strip()]
+
+    rows, rules, accuracy = asyncio.run(evaluate(controls, args.api_key, names, policy))
+    print(f"Per-control stage averages over {len(controls)} controls")
+    print(tabulate(rows, headers=["stage", "baseline s", "routed s", "saving %", "baseline $", "routed $",
+                                  "agreement"], floatfmt=".3f"))
+    print()
+    print(tabulate([[stage, ", ".join(f"{rule}: {count}" for rule, count in counts.most_common())]
+                    for stage, counts in rules.items()], headers=["stage", "rules applied"]))
+    if accuracy["baseline"]:
+        print()
+        print(f"Score accuracy on {len(accuracy['baseline'])} labelled controls: "
+              f"baseline {statistics.mean(accuracy['baseline']):.1%}, routed {statistics.mean(accuracy['routed']):.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Throughput and latency of the orchestration code against the local OpenAI stand-in
+(:mod:`benchmarks.fake_openai`), without real API calls.
+
+Scenarios, each run for every selected pipeline mode (sections per_stage/fused x score
+two_step/combined):
+
+- ``stages``: every stage function alone, one call at a time
+- ``sequential``: ``run_pipeline``, one stage after another
+- ``concurrent``: ``arun_pipeline``, independent stages at the same time
+- ``batch``: ``assess_controls`` over the whole set with ``--concurrency`` controls in flight
+
+Reports p50/p95/p99 latency per control (per call for ``stages``), controls per minute and
+the peak resident set size of each scenario; ``--trace-memory`` adds the peak of Python heap
+allocations (``tracemalloc``), which slows the run down considerably.
+The response cache, local classifier and near-duplicate index are disabled, so every call
+reaches the stand-in. ``--save`` writes the results as JSON; ``--baseline`` compares a run
+with saved results and exits with status 1 when p95 latency or throughput regress by
+more than ``--tolerance``. ``--rate-limit`` and ``--rpm`` make the stand-in answer 429s, to
+exercise the retries and admission control of :mod:`src.control_ratelimit`.
+
+Usage::
+
+    python -m benchmarks.throughput --controls 40 --latency lognormal:0.3,0.4 --save before.json
+    python -m benchmarks.throughput --controls 40 --latency lognormal:0.3,0.4 --baseline before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+# Every call must reach the stand-in; set before the src modules read their configuration
+os.environ["CONTROL_CACHE_DISABLED"] = "1"
+os.environ["CONTROL_CLASSIFIER_DISABLED"] = "1"
+os.environ["CONTROL_SIMILARITY_DISABLED"] = "1"
+
+from tabulate import tabulate
+from benchmarks.fake_openai import FakeOpenAI
+from src.control_ratelimit import get_scheduler
+
+SCENARIOS = ("stages", "sequential", "concurrent", "batch")
+MODES = {
+    "per_stage/two_step": ("per_stage", "two_step"),
+    "fused/two_step": ("fused", "two_step"),
+    "per_stage/combined": ("per_stage", "combined"),
+    "fused/combined": ("fused", "combined"),
+}
+
+SAMPLE_CONTROL = ("Outgoing wires above $20 million are held in a queue and released only after a second "
+                  "approver in Treasury Operations reviews the payment details against the original client "
+                  "instruction (control {number}).")
+
+
+def percentile(values: Sequence[float], share: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * share
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def rss_mb() -> float:
+    """
+    The current resident set size; the lifetime peak where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+class PeakRSS:
+    """
+    Samples the resident set size on a thread while a scenario runs.
+    """
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak = 0.0
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+
+    def _sample(self) -> None:
+        while True:
+            self.peak = max(self.peak, rss_mb())
+            if self._done.wait(self.interval):
+                return
+
+    def __enter__(self) -> "PeakRSS":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._done.set()
+        self._thread.join()
+
+
+def measure(name: str, mode: str, run: Callable[[], List[float]], controls: int,
+            trace_memory: bool = False) -> Dict[str, Any]:
+    if trace_memory:
+        tracemalloc.start()
+    with PeakRSS() as memory:
+        started = time.perf_counter()
+        latencies = run()
+        elapsed = time.perf_counter() - started
+    result = {
+        "scenario": name, "mode": mode, "samples": len(latencies),
+        "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95), "p99": percentile(latencies, 0.99),
+        "controls_per_minute": 60 * controls / elapsed if elapsed else 0.0,
+        "peak_rss_mb": memory.peak,
+    }
+    if trace_memory:
+        result["peak_heap_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result
+
+
+def new_state(number: int) -> Dict[str, Any]:
+    return {"openai_api_key": "sk-benchmark", "original_input": SAMPLE_CONTROL.format(number=number)}
+
+
+def run_stages(stages: Sequence[Any], controls: int) -> List[float]:
+    async def calls() -> List[float]:
+        latencies = []
+        for number in range(controls):
+            state = new_state(number)
+            for stage in stages:
+                started = time.perf_counter()
+                await stage.arun(state)
+                latencies.append(time.perf_counter() - started)
+        return latencies
+    return asyncio.run(calls())
+
+
+def run_sequential(stages: Sequence[Any], controls: int) -> List[float]:
+    from src.control_pipeline import run_pipeline
+    latencies = []
+    for number in range(controls):
+        started = time.perf_counter()
+        run_pipeline(new_state(number), stages)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run_concurrent(stages: Sequence[Any], controls: int) -> List[float]:
+    from src.control_pipeline import arun_pipeline
+
+    async def assessments() -> List[float]:
+        latencies = []
+        for number in range(controls):
+            started = time.perf_counter()
+            async for _ in arun_pipeline(new_state(number), stages):
+                pass
+            latencies.append(time.perf_counter() - started)
+        return latencies
+    return asyncio.run(assessments())
+
+
+def run_assess_batch(controls: int, concurrency: int) -> List[float]:
+    from src.control_batch import assess_controls
+    started: Dict[str, float] = {}
+    latencies: List[float] = []
+
+    def rows():
+        for number in range(controls):
+            # Pulled only when a slot frees up, i.e. when the control starts
+            started[str(number)] = time.perf_counter()
+            yield str(number), new_state(number)["original_input"]
+
+    def on_result(row_id: str, state: Dict[str, Any]) -> None:
+        latencies.append(time.perf_counter() - started[row_id])
+
+    asyncio.run(assess_controls(rows(), "sk-benchmark", concurrency, on_result))
+    return latencies
+
+
+def benchmark(scenarios: Sequence[str], modes: Sequence[str], controls: int, concurrency: int,
+              trace_memory: bool = False) -> List[Dict[str, Any]]:
+    from src.control_pipeline import pipeline_stages
+    results = []
+    for mode in modes:
+        sections_mode, score_mode = MODES[mode]
+        # assess_controls reads the mode from the environment
+        os.environ["CONTROL_SECTIONS_MODE"], os.environ["CONTROL_SCORE_MODE"] = sections_mode, score_mode
+        stages = pipeline_stages(sections_mode, score_mode)
+        runs = {
+            "stages": lambda: run_stages(stages, controls),
+            "sequential": lambda: run_sequential(stages, controls),
+            "concurrent": lambda: run_concurrent(stages, controls),
+            "batch": lambda: run_assess_batch(controls, concurrency),
+        }
+        for scenario in scenarios:
+            results.append(measure(scenario, mode, runs[scenario], controls, trace_memory))
+    return results
+
+
+def regressions(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """
+    Scenarios whose p95 latency grew, or whose throughput fell, by more than ``tolerance``.
+    """
+    previous = {(row["scenario"], row["mode"]): row for row in baseline}
+    found = []
+    for row in results:
+        before = previous.get((row["scenario"], row["mode"]))
+        if before is None:
+            continue
+        if row["p95"] > before["p95"] * (1 + tolerance):
+            found.append(f"{row['scenario']} {row['mode']}: p95 {before['p95']:.3f}s -> {row['p95']:.3f}s")
+        if row["controls_per_minute"] < before["controls_per_minute"] * (1 - tolerance):
+            found.append(f"{row['scenario']} {row['mode']}: {before['controls_per_minute']:.1f} -> "
+                         f"{row['controls_per_minute']:.1f} controls/min")
+    return found
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark pipeline throughput against a local OpenAI stand-in.")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=["per_stage/two_step", "fused/combined"])
+    parser.add_argument("--controls", type=int, default=20, help="controls per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="controls in flight in the batch scenario")
+    parser.add_argument("--latency", default="lognormal:0.3,0.4", help="stand-in time to first token distribution")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="stand-in seconds between streamed chunks")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="stand-in probability of a 429 response")
+    parser.add_argument("--rpm", type=int, help="stand-in answers 429 above this many requests per minute")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true", help="also report the Python heap peak (slow)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    server = FakeOpenAI(latency=args.latency, token_delay=args.token_delay, rate_limit=args.rate_limit,
+                        requests_per_minute=args.rpm, seed=args.seed).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    try:
+        results = benchmark(args.scenarios, args.modes, args.controls, args.concurrency, args.trace_memory)
+    finally:
+        server.stop()
+
+    print(f"{args.controls} controls per scenario, stand-in latency {args.latency}, "
+          f"{server.stats['requests']} requests ({server.stats['rate_limited']} rate limited), "
+          f"max {server.stats['max_in_flight']} in flight")
+    scheduler = get_scheduler().stats
+    print(f"rate-limit scheduler: {scheduler['retries']} retries, "
+          f"{scheduler['throttled_seconds']:.1f}s waited for admission")
+    print(tabulate(results, headers="keys", floatfmt=".3f"))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as handle:
+            json.dump(results, handle, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as handle:
+            found = regressions(results, json.load(handle), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+"""
+Headless bulk assessment of a control inventory.
+
+Reads control descriptions from a CSV or Excel file, runs the assessment pipeline on
+each of them under a concurrency limit and writes the results to an Excel workbook.
+Finished rows are appended to a JSON-lines checkpoint, so an interrupted run picks up
+where it stopped when started again with the same arguments. Each assessed control is
+also saved to the assessment store (:mod:`src.control_store`), where the apps find it.
+
+With ``--dedupe`` each description is first looked up in the near-duplicate index
+(:mod:`src.control_similarity`): ``flag`` only marks near-duplicates in the workbook,
+``seed`` copies the classification and score of the nearest assessed control and runs the
+remaining stages, and ``reuse`` copies all of its results without calling the LLM.
+
+With ``--cassette`` the LLM calls of the run are recorded to, or replayed offline from, a
+cassette file (:mod:`src.control_cassette`); ``--cassette-mode check`` reports the stages
+whose calls no longer match the recording, e.g. after a prompt edit.
+
+After a prompt edit, ``python -m src.control_incremental run`` re-assesses the stored
+controls re-running only the stages whose inputs or prompts changed.
+
+Runs where latency does not matter, such as the nightly re-assessment of the whole
+inventory, can go through the cheaper Batch API instead (:mod:`src.control_batch_api`).
+
+Usage::
+
+    python -m src.control_batch controls.xlsx --column "Control Description" --concurrency 4 --dedupe reuse
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Set, Tuple, Union, IO
+import xlsxwriter
+from tqdm import tqdm
+from src.control_cassette import LATENCIES, MODES as CASSETTE_MODES, use_cassette
+from src.control_pipeline import SECTIONS, arun_pipeline, pipeline_stages
+from src.control_similarity import SimilarityIndex, get_index, similarity
+from src.control_store import get_store
+
+logger = logging.getLogger(__name__)
+
+# Workbook columns: (header, state key)
+OUTPUT_COLUMNS = (("Control Description", "original_input"),) + SECTIONS
+
+# Extra columns of a deduplicated batch
+DEDUPE_COLUMNS = (("Near Duplicate Of", "near_duplicate_of"), ("Similarity", "near_duplicate_similarity"))
+
+DEDUPE_MODES = ("off", "flag", "seed", "reuse")
+
+# State keys copied from the nearest assessed control in "seed" mode
+SEED_KEYS = ("control_classification", "control_score")
+
+
+def read_controls(path: str, column: Optional[str] = None,
+                  id_column: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    """
+    Stream ``(row_id, description)`` pairs from a CSV or Excel file without loading it whole.
+
+    :param path: Path to a .csv or .xlsx file whose first row holds the column headers.
+    :type path: str
+    :param column: Header of the control description column; defaults to the first column.
+    :type column: Optional[str]
+    :param id_column: Header of a column holding a stable row identifier; defaults to the
+                      1-based data row number.
+    :type id_column: Optional[str]
+    :return: An iterator over the non-empty rows.
+    :rtype: Iterator[Tuple[str, str]]
+    :raises ValueError: If a requested column is not in the header row.
+    """
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+    else:
+        workbook = None
+        handle = open(path, newline="", encoding="utf-8-sig")
+        rows = csv.reader(handle)
+
+    try:
+        header = [str(cell).strip() if cell is not None else "" for cell in next(rows, [])]
+        for name in (column, id_column):
+            if name is not None and name not in header:
+                raise ValueError(f"Column {name!r} not found in {path}; available: {header}")
+        description_index = header.index(column) if column else 0
+        id_index = header.index(id_column) if id_column else None
+
+        for number, row in enumerate(rows, start=1):
+            description = row[description_index] if description_index < len(row) else None
+            if description is None or not str(description).strip():
+                continue
+            row_id = str(row[id_index]) if id_index is not None else str(number)
+            yield row_id, str(description).strip()
+    finally:
+        if workbook is not None:
+            workbook.close()
+        else:
+            handle.close()
+
+
+def load_checkpoint(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over the finished rows recorded in a checkpoint file.
+
+    :param path: Path to the JSON-lines checkpoint.
+    :type path: str
+    :return: An iterator over the recorded rows; empty if the file does not exist.
+    :rtype: Iterator[Dict[str, Any]]
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A run killed mid-write leaves a truncated last line; that row is redone.
+                    logger.warning("Skipping truncated checkpoint line in %s", path)
+
+
+class ResultWriter:
+    """
+    Writes assessed rows to an XlsxWriter workbook in constant-memory mode, one row at a
+    time as they finish, and appends each row to the checkpoint file.
+    """
+
+    def __init__(self, target: Union[str, IO[bytes]], checkpoint: Optional[str] = None,
+                 columns: Tuple[Tuple[str, str], ...] = OUTPUT_COLUMNS):
+        self.columns = columns
+        self.workbook = xlsxwriter.Workbook(target, {"constant_memory": True, "in_memory": not isinstance(target, str)})
+        self.sheet = self.workbook.add_worksheet("Assessment")
+        wrap = self.workbook.add_format({"text_wrap": True, "valign": "top"})
+        bold = self.workbook.add_format({"bold": True})
+        self.sheet.write_row(0, 0, ["Row ID"] + [header for header, _ in columns], bold)
+        self.sheet.set_column(0, 0, 10)
+        self.sheet.set_column(1, len(columns), 60, wrap)
+        self.sheet.freeze_panes(1, 0)
+        self.rows = 0
+        self.checkpoint = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+
+    def write(self, row_id: str, state: Dict[str, Any], checkpoint: bool = True) -> None:
+        """
+        Append one assessed control to the workbook (and to the checkpoint).
+
+        :param row_id: The identifier of the input row.
+        :type row_id: str
+        :param state: The assessment state of the row.
+        :type state: Dict[str, Any]
+        :param checkpoint: Whether to record the row in the checkpoint file.
+        :type checkpoint: bool
+        """
+        self.rows += 1
+        self.sheet.write_row(self.rows, 0, [row_id] + [state.get(key, "") for _, key in self.columns])
+        if checkpoint and self.checkpoint is not None:
+            record = {"row_id": row_id}
+            record.update({key: state.get(key) for _, key in self.columns})
+            self.checkpoint.write(json.dumps(record) + "\n")
+            self.checkpoint.flush()
+
+    def close(self) -> None:
+        self.workbook.close()
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+
+
+def write_workbook(states: Iterable[Dict[str, Any]], target: Union[str, IO[bytes]]) -> Union[str, IO[bytes]]:
+    """
+    Write assessment states to a workbook, e.g. an ``io.BytesIO`` download buffer.
+
+    :param states: The assessment states, one per control.
+    :type states: Iterable[Dict[str, Any]]
+    :param target: A file path or a writable binary buffer.
+    :type target: Union[str, IO[bytes]]
+    :return: The target, rewound to the start if it is a buffer.
+    :rtype: Union[str, IO[bytes]]
+    """
+    writer = ResultWriter(target)
+    for number, state in enumerate(states, start=1):
+        writer.write(str(number), state, checkpoint=False)
+    writer.close()
+    if not isinstance(target, str):
+        target.seek(0)
+    return target
+
+
+async def assess_controls(rows: Iterable[Tuple[str, str]], api_key: str, concurrency: int,
+                          on_result: Callable[[str, Dict[str, Any]], None],
+                          on_error: Optional[Callable[[str, BaseException], None]] = None,
+                          dedupe: str = "off", index: Optional[SimilarityIndex] = None) -> None:
+    """
+    Run the assessment pipeline over ``rows`` with at most ``concurrency`` controls in flight.
+
+    Rows are pulled from the iterable only when a slot frees up, so the input is streamed
+    rather than loaded. Each control itself runs its stages concurrently.
+
+    With deduplication, a control within the index threshold of an assessed one (or of one
+    still in flight in this batch, which is then waited for) gets "near_duplicate_of" and
+    "near_duplicate_similarity" in its state, plus "reused" when its results were copied.
+    Assessed controls are added to the index.
+
+    :param rows: ``(row_id, description)`` pairs.
+    :type rows: Iterable[Tuple[str, str]]
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param concurrency: Maximum number of controls assessed at the same time.
+    :type concurrency: int
+    :param on_result: Called with ``(row_id, state)`` for every finished control.
+    :type on_result: Callable[[str, Dict[str, Any]], None]
+    :param on_error: Called with ``(row_id, error)`` for every failed control.
+    :type on_error: Optional[Callable[[str, BaseException], None]]
+    :param dedupe: One of "off", "flag", "seed" or "reuse" (see the module docstring).
+    :type dedupe: str
+    :param index: The near-duplicate index, defaulting to :func:`src.control_similarity.get_index`.
+    :type index: Optional[SimilarityIndex]
+    :raises ValueError: On an unknown dedupe mode.
+    """
+    if dedupe not in DEDUPE_MODES:
+        raise ValueError(f"Unknown dedupe mode {dedupe!r}; expected one of {', '.join(DEDUPE_MODES)}")
+    index = (index or get_index()) if dedupe != "off" else None
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks: Set[asyncio.Future] = set()
+    # Controls of this batch still being assessed: result -> (signature, description)
+    in_flight: Dict[asyncio.Future, Tuple[Any, str]] = {}
+
+    async def nearest(signature: Any) -> Optional[Tuple[float, str, Optional[Dict[str, Any]]]]:
+        matches = index.query(signature, limit=1)
+        best = (matches[0].similarity, matches[0].text, matches[0].state) if matches else None
+        for result, (other, text) in list(in_flight.items()):
+            score = similarity(signature, other)
+            if score >= index.threshold and (best is None or score > best[0]):
+                best = (score, text, result)
+        if best is not None and isinstance(best[2], asyncio.Future):
+            result = best[2]
+            if dedupe == "flag":
+                return best[0], best[1], None
+            try:
+                return best[0], best[1], await asyncio.shield(result)
+            except asyncio.CancelledError:
+                if not result.cancelled():
+                    raise
+            except Exception:
+                pass
+            return best[0], best[1], None
+        return best
+
+    async def assess(row_id: str, description: str) -> None:
+        result: Optional[asyncio.Future] = None
+        try:
+            # Batch calls yield to interactive ones at the rate-limit scheduler
+            state = {"openai_api_key": api_key, "original_input": description, "priority": "batch"}
+            stages = None
+            if index is not None:
+                signature = index.signature(description)
+                match = await nearest(signature)
+                if match is not None:
+                    state["near_duplicate_similarity"], state["near_duplicate_of"], assessed = match
+                    if dedupe == "reuse" and assessed is not None:
+                        state.update({key: value for key, value in assessed.items() if key != "original_input"})
+                        state["reused"] = True
+                        on_result(row_id, state)
+                        return
+                    if dedupe == "seed" and assessed is not None:
+                        state.update({key: assessed[key] for key in SEED_KEYS if assessed.get(key)})
+                        stages = [stage for stage in pipeline_stages() if not set(stage.outputs) <= set(state)]
+                result = asyncio.get_running_loop().create_future()
+                in_flight[result] = (signature, description)
+
+            async for _ in arun_pipeline(state, stages):
+                pass
+            if index is not None:
+                outputs = {key: state.get(key) for _, key in OUTPUT_COLUMNS}
+                index.add(description, outputs, signature)
+                result.set_result(outputs)
+            on_result(row_id, state)
+        except Exception as error:
+            if result is not None and not result.done():
+                result.set_exception(error)
+                # Nobody may be waiting for it
+                result.exception()
+            if on_error is None:
+                raise
+            on_error(row_id, error)
+        finally:
+            if result is not None:
+                if not result.done():
+                    result.cancel()
+                in_flight.pop(result, None)
+            semaphore.release()
+
+    for row_id, description in rows:
+        await semaphore.acquire()
+        task = asyncio.ensure_future(assess(row_id, description))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+
+def run_batch(input_path: str, output_path: str, api_key: str, column: Optional[str] = None,
+              id_column: Optional[str] = None, concurrency: int = 4,
+              checkpoint_path: Optional[str] = None, dedupe: str = "off") -> Dict[str, Any]:
+    """
+    Assess every control of an inventory file and write the results workbook.
+
+    Rows already recorded in the checkpoint are written to the workbook again without being
+    re-assessed; only the remaining rows are sent through the pipeline.
+
+    :param input_path: The .csv or .xlsx inventory.
+    :type input_path: str
+    :param output_path: The .xlsx results workbook to (re)create.
+    :type output_path: str
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param column: Header of the control description column.
+    :type column: Optional[str]
+    :param id_column: Header of the row identifier column.
+    :type id_column: Optional[str]
+    :param concurrency: Maximum number of controls assessed at the same time.
+    :type concurrency: int
+    :param checkpoint_path: The checkpoint file; defaults to ``<output_path>.checkpoint.jsonl``.
+    :type checkpoint_path: Optional[str]
+    :param dedupe: Near-duplicate handling: "off", "flag", "seed" or "reuse".
+    :type dedupe: str
+    :return: Run statistics: resumed, assessed, failed, near-duplicate and reused row counts,
+             the dedupe ratio (near-duplicates per processed row), elapsed seconds and
+             controls per minute.
+    :rtype: Dict[str, Any]
+    """
+    checkpoint_path = checkpoint_path or output_path + ".checkpoint.jsonl"
+    writer = ResultWriter(output_path, checkpoint_path,
+                          OUTPUT_COLUMNS + DEDUPE_COLUMNS if dedupe != "off" else OUTPUT_COLUMNS)
+    stats = {"resumed": 0, "assessed": 0, "failed": 0, "near_duplicates": 0, "reused": 0}
+
+    # Replay finished rows into the new workbook; XlsxWriter cannot append to an existing file.
+    done = set()
+    for record in load_checkpoint(checkpoint_path):
+        if record["row_id"] not in done:
+            done.add(record["row_id"])
+            writer.write(record["row_id"], record, checkpoint=False)
+            stats["resumed"] += 1
+
+    progress = tqdm(desc="Controls", unit="control")
+    store = get_store()
+
+    def on_result(row_id: str, state: Dict[str, Any]) -> None:
+        writer.write(row_id, state)
+        if store is not None:
+            store.save(state, "batch")
+        stats["near_duplicates"] += "near_duplicate_of" in state
+        stats["reused" if state.get("reused") else "assessed"] += 1
+        progress.update()
+
+    def on_error(row_id: str, error: BaseException) -> None:
+        logger.error("Row %s failed: %s", row_id, error)
+        stats["failed"] += 1
+        progress.update()
+
+    rows = ((row_id, text) for row_id, text in read_controls(input_path, column, id_column) if row_id not in done)
+    started = time.perf_counter()
+    try:
+        asyncio.run(assess_controls(rows, api_key, concurrency, on_result, on_error, dedupe))
+    finally:
+        progress.close()
+        writer.close()
+
+    processed = stats["assessed"] + stats["reused"] + stats["failed"]
+    stats["dedupe_ratio"] = stats["near_duplicates"] / processed if processed else 0.0
+    stats["elapsed_seconds"] = time.perf_counter() - started
+    stats["controls_per_minute"] = 60 * stats["assessed"] / stats["elapsed_seconds"] if stats["elapsed_seconds"] else 0.0
+    return stats
+
+
+def main(argv: Optional[Iterable[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Assess a control inventory in bulk.")
+    parser.add_argument("input", help="CSV or XLSX file with one control description per row")
+    parser.add_argument("-o", "--output", help="results workbook (default: <input>_assessment.xlsx)")
+    parser.add_argument("--column", help="header of the control description column (default: first column)")
+    parser.add_argument("--id-column", help="header of a stable row identifier column (default: row number)")
+    parser.add_argument("--concurrency", type=int, default=4, help="controls assessed at the same time")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <output>.checkpoint.jsonl)")
+    parser.add_argument("--dedupe", choices=DEDUPE_MODES, default="off",
+                        help="near-duplicate handling: flag them, seed from or reuse the nearest assessed control")
+    parser.add_argument("--cassette", help="record the LLM calls to, or replay them from, this file")
+    parser.add_argument("--cassette-mode", choices=CASSETTE_MODES, default="replay",
+                        help="record, replay offline, or check which stages no longer match the recording")
+    parser.add_argument("--replay-latency", choices=LATENCIES, default="zero",
+                        help="replay with no latency or the recorded one")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"), help="defaults to $OPENAI_API_KEY")
+    args = parser.parse_args(argv)
+
+    replaying = args.cassette and args.cassette_mode != "record"
+    if not args.api_key and not replaying:
+        parser.error("an OpenAI API key is required (--api-key or $OPENAI_API_KEY)")
+    output = args.output or os.path.splitext(args.input)[0] + "_assessment.xlsx"
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    cassette = use_cassette(args.cassette, args.cassette_mode, args.replay_latency) if args.cassette else None
+    try:
+        stats = run_batch(args.input, output, args.api_key or "replay", args.column, args.id_column,
+                          max(1, args.concurrency), args.checkpoint, args.dedupe)
+    finally:
+        if cassette is not None:
+            cassette.close()
+    logger.info("Wrote %s: %d assessed, %d reused, %d resumed, %d failed, %.1f controls/min",
+                output, stats["assessed"], stats["reused"], stats["resumed"], stats["failed"],
+                stats["controls_per_minute"])
+    if args.dedupe != "off":
+        logger.info("%d near-duplicates, dedupe ratio %.1f%%", stats["near_duplicates"], 100 * stats["dedupe_ratio"])
+    if replaying:
+        report = cassette.report()
+        logger.info("Replayed %d calls from %s, %d missed", report["hits"], args.cassette, report["misses"])
+        for stage, causes in sorted(report["stages"].items()):
+            logger.info("  %s: %s", stage, ", ".join(f"{count} {cause}" for cause, count in sorted(causes.items())))
+
+
+if __name__ == "__main__":
+    main()
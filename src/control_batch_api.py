@@ -0,0 +1,438 @@
+"""
+Re-assessment of a whole control inventory through the OpenAI Batch API.
+
+For nightly and quarterly re-scoring, latency does not matter but throughput and cost do.
+A Batch API run executes the ordinary stage functions in rounds:
+
+- While a stage runs, each of its LLM calls is looked up in the :class:`BatchRun` carried
+  in ``state["batch"]`` (see :func:`src.control_llm.run_chain`). A call without an answer
+  yet is collected as a batch request, and the stage is set aside (:class:`Deferred`).
+- The calls collected from all controls are written to a JSONL file, submitted as one
+  batch (split at ``CONTROL_BATCH_MAX_REQUESTS``) and polled until the batch ends.
+- Then the set-aside stages run again and find their answers. The stages that depend on
+  them start too, e.g. score_reasoning after score, and their calls form the next batch,
+  as do the repairs of answers that broke their output contract (see
+  :mod:`src.control_contracts`).
+
+Requests are built exactly like the interactive calls of the stages, with the same model
+settings, output budget and response schema. Calls already in the response cache are
+answered from it. Batch results are stored in the cache as they arrive, so a restarted run
+does not pay for them twice. Batch requests are billed at half price, which the stage
+metrics reflect. They also count against the Batch API's own queue limits rather than the
+per-minute limits shared with the apps (see :mod:`src.control_ratelimit`).
+
+Configuration (environment variables):
+
+- ``CONTROL_BATCH_POLL_SECONDS``: seconds between status polls of a submitted batch (default 30)
+- ``CONTROL_BATCH_MAX_REQUESTS``: requests per submitted batch (default 50000, the API limit)
+
+Usage::
+
+    python -m src.control_batch_api controls.xlsx --column "Control Description"
+
+Against the local stand-in (``python -m benchmarks.fake_openai --port 8000``), with
+``OPENAI_BASE_URL=http://127.0.0.1:8000/v1``.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple
+from src.control_batch import ResultWriter, load_checkpoint, read_controls
+from src.control_cache import MISSING, get_cache
+from src.control_clients import get_openai_client
+from src.control_contracts import CutOff
+from src.control_metrics import StageRecorder, record_assessment
+from src.control_pipeline import Stage, note_fingerprint, pipeline_stages
+from src.control_prompts import Prompt
+from src.control_store import get_store
+
+logger = logging.getLogger(__name__)
+
+# The endpoint of every batch request
+ENDPOINT = "/v1/chat/completions"
+
+# Batch requests cost half as much as interactive ones
+BATCH_PRICE_FACTOR = 0.5
+
+# Status of a batch that will not change any more
+FINISHED = ("completed", "failed", "expired", "cancelled")
+
+# Rounds after which controls still waiting for answers are given up
+MAX_ROUNDS = 10
+
+# Submissions of a request answered with a rate-limit or server error before it fails
+MAX_ATTEMPTS = 3
+
+
+class Deferred(Exception):
+    """
+    A stage call waits for the next batch of its :class:`BatchRun`.
+    """
+
+    def __init__(self, stage: str):
+        super().__init__(f"The {stage} call waits for its batch")
+        self.stage = stage
+
+
+class BatchRequestFailed(Exception):
+    """
+    The Batch API answered a request with an error.
+    """
+
+
+def _usage(body: Dict[str, Any]) -> Tuple[int, int, int, int]:
+    # (input, cached, output, reasoning) tokens of a chat completion
+    usage = body.get("usage") or {}
+    return (usage.get("prompt_tokens", 0), (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0,
+            usage.get("completion_tokens", 0),
+            (usage.get("completion_tokens_details") or {}).get("reasoning_tokens", 0) or 0)
+
+
+def _generation(body: Dict[str, Any], stage: str, schema: Optional[Dict[str, Any]]) -> Any:
+    # The answer of a chat completion, as the stage's chain would return it; cut off by the
+    # output budget, it fails like an interactive call (see src.control_llm)
+    choice = body["choices"][0]
+    content = choice["message"].get("content") or ""
+    if choice.get("finish_reason") == "length" or (schema is not None and not content):
+        raise CutOff(stage)
+    if schema is None:
+        return content
+    return json.loads(content)
+
+
+class BatchRun:
+    """
+    The calls of a Batch API run: answers of submitted batches, and the calls collected for
+    the next one. Used from one thread.
+
+    :ivar stats: "rounds", "batches", "requests", "failed_requests" and "cache_hits" so far.
+    """
+
+    def __init__(self, api_key: str, poll_seconds: Optional[float] = None, max_requests: Optional[int] = None):
+        self.api_key = api_key
+        self.poll_seconds = poll_seconds if poll_seconds is not None else float(
+            os.environ.get("CONTROL_BATCH_POLL_SECONDS", 30))
+        self.max_requests = max_requests or int(os.environ.get("CONTROL_BATCH_MAX_REQUESTS", 50_000))
+        self.stats = {"rounds": 0, "batches": 0, "requests": 0, "failed_requests": 0, "cache_hits": 0}
+        # Calls collected for the next batch: cache key -> request
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        # Answers: cache key -> (generation, token usage or None if cached) or the error to raise
+        self._answers: Dict[str, Any] = {}
+        # (state, key) pairs whose answer was already recorded in that state's metrics
+        self._used = set()
+        self._attempts: Dict[str, int] = {}
+        self._payloads: Dict[str, Tuple[Any, Optional[Dict[str, Any]]]] = {}
+
+    def answer(self, state: Dict[str, Any], stage: str, key: str, prompt: Prompt, inputs: Dict[str, Any],
+               llm_settings: Dict[str, Any], schema: Optional[Dict[str, Any]], recorder: StageRecorder) -> Any:
+        """
+        The answer of a stage call, from a completed batch or the response cache.
+
+        :param state: The assessment state of the call.
+        :param stage: The stage of the call.
+        :param key: The :func:`src.control_cache.cache_key` of the call.
+        :param prompt: The chat messages of the stage.
+        :param inputs: The prompt input values.
+        :param llm_settings: The ``ChatOpenAI`` settings of the call.
+        :param schema: The response JSON schema, if any.
+        :param recorder: Records the usage of the answer, once per state.
+        :return: The generated text or parsed structured response.
+        :raises Deferred: If the call was added to the next batch.
+        """
+        if key in self._answers:
+            first = (id(state), key) not in self._used
+            if first:
+                self._used.add((id(state), key))
+            else:
+                # Asked again by a stage re-run after a later call of it was deferred
+                recorder.discard()
+            answer = self._answers[key]
+            if isinstance(answer, Exception):
+                raise answer
+            generation, usage = answer
+            if first and usage is None:
+                recorder.cache_hit()
+            elif first:
+                recorder.add_usage(*usage, price_factor=BATCH_PRICE_FACTOR)
+            return generation
+
+        cache = get_cache() if state.get("use_cache", True) else None
+        if cache is not None:
+            cache.invalidate_stale(stage, prompt)
+            generation = cache.get(key)
+            if generation is not MISSING:
+                self._answers[key] = (generation, None)
+                self._used.add((id(state), key))
+                self.stats["cache_hits"] += 1
+                recorder.cache_hit()
+                return generation
+
+        if key not in self.pending:
+            self.pending[key] = {"stage": stage, "prompt": prompt, "inputs": inputs, "llm_settings": llm_settings,
+                                 "schema": schema, "body": self.request_body(prompt, llm_settings, inputs, schema)}
+        recorder.discard()
+        raise Deferred(stage)
+
+    def request_body(self, prompt: Prompt, llm_settings: Dict[str, Any], inputs: Dict[str, Any],
+                     schema: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        The chat completions request of a stage call, as its chain would send it (see
+        :func:`src.control_clients.get_chain`).
+
+        :rtype: Dict[str, Any]
+        """
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain_openai import ChatOpenAI
+
+        settings = json.dumps([llm_settings, schema], sort_keys=True)
+        if settings not in self._payloads:
+            # Never sends anything; only builds payloads
+            llm = ChatOpenAI(api_key=self.api_key, **llm_settings)
+            response_format = None
+            if schema is not None:
+                structured = llm.with_structured_output(schema, method="json_schema", strict=True)
+                response_format = structured.first.kwargs["response_format"]
+            self._payloads[settings] = (llm, response_format)
+        llm, response_format = self._payloads[settings]
+
+        messages = ChatPromptTemplate(list(prompt)).invoke(inputs).to_messages()
+        kwargs = {"response_format": response_format} if response_format is not None else {}
+        body = llm._get_request_payload(messages, **kwargs)
+        body.pop("stream", None)
+        return body
+
+    def submit(self) -> None:
+        """
+        Submit the collected calls as batches, wait for them to end and keep their answers.
+        Calls of a batch that expired or was cancelled, and requests answered with a
+        rate-limit or server error (up to ``MAX_ATTEMPTS`` times), are collected again by
+        the next round.
+        """
+        requests, self.pending = list(self.pending.items()), {}
+        if not requests:
+            return
+        self.stats["rounds"] += 1
+        client = get_openai_client(self.api_key).with_options(max_retries=3)
+        batches = {}
+        for start in range(0, len(requests), self.max_requests):
+            part = dict(requests[start:start + self.max_requests])
+            lines = "".join(json.dumps({"custom_id": key, "method": "POST", "url": ENDPOINT, "body": request["body"]})
+                            + "\n" for key, request in part.items())
+            upload = client.files.create(file=(f"controls-{self.stats['rounds']}.jsonl", lines.encode("utf-8")),
+                                         purpose="batch")
+            batch = client.batches.create(input_file_id=upload.id, endpoint=ENDPOINT, completion_window="24h",
+                                          metadata={"round": str(self.stats["rounds"])})
+            logger.info("Submitted batch %s with %d requests", batch.id, len(part))
+            batches[batch.id] = part
+            for key in part:
+                self._attempts[key] = self._attempts.get(key, 0) + 1
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(part)
+
+        while batches:
+            time.sleep(self.poll_seconds)
+            for batch_id in list(batches):
+                batch = client.batches.retrieve(batch_id)
+                if batch.status not in FINISHED:
+                    continue
+                logger.info("Batch %s %s: %s", batch_id, batch.status, batch.request_counts)
+                part = batches.pop(batch_id)
+                for file_id in (batch.output_file_id, batch.error_file_id):
+                    if file_id:
+                        self._read_results(client.files.content(file_id).text, part)
+                if batch.status == "failed":
+                    # Rejected as a whole, e.g. an invalid input file; resubmitting would not help
+                    errors = "; ".join(error.message or "" for error in (batch.errors.data if batch.errors else []))
+                    for key in part:
+                        self._answers.setdefault(key, BatchRequestFailed(f"Batch {batch_id} failed: {errors}"))
+
+    def _read_results(self, text: str, requests: Dict[str, Dict[str, Any]]) -> None:
+        cache = get_cache()
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            key = result["custom_id"]
+            request = requests.get(key)
+            if request is None:
+                continue
+            response = result.get("response") or {}
+            status = response.get("status_code")
+            if (status == 429 or (status or 0) >= 500) and self._attempts.get(key, 0) < MAX_ATTEMPTS:
+                # Left unanswered, so the next round submits it again
+                continue
+            if result.get("error") or status != 200:
+                error = result.get("error") or (response.get("body") or {}).get("error") or {}
+                self._answers[key] = BatchRequestFailed(f"The {request['stage']} request failed: "
+                                                        f"{error.get('message', response.get('status_code'))}")
+                self.stats["failed_requests"] += 1
+                continue
+            body = response["body"]
+            try:
+                generation = _generation(body, request["stage"], request["schema"])
+            except Exception as error:
+                self._answers[key] = error
+                continue
+            self._answers[key] = (generation, _usage(body))
+            if cache is not None:
+                cache.put(key, request["stage"], request["prompt"], request["llm_settings"], request["inputs"],
+                          generation)
+
+
+def assess_in_batches(rows: Iterable[Tuple[str, str]], api_key: str,
+                      on_result: Callable[[str, Dict[str, Any]], None],
+                      on_error: Optional[Callable[[str, BaseException], None]] = None,
+                      stages: Optional[Sequence[Stage]] = None, run: Optional[BatchRun] = None) -> BatchRun:
+    """
+    Assess controls through the Batch API, one batch per round of stage calls (see the
+    module docstring). Every control's stages are run from one thread; the wait is in the
+    batches.
+
+    :param rows: ``(row_id, description)`` pairs.
+    :type rows: Iterable[Tuple[str, str]]
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param on_result: Called with ``(row_id, state)`` for every assessed control.
+    :type on_result: Callable[[str, Dict[str, Any]], None]
+    :param on_error: Called with ``(row_id, error)`` for every failed control; errors are
+                     raised if it is None.
+    :type on_error: Optional[Callable[[str, BaseException], None]]
+    :param stages: The stages to run, defaulting to :func:`src.control_pipeline.pipeline_stages`.
+    :type stages: Optional[Sequence[Stage]]
+    :param run: The batch run, defaulting to a new :class:`BatchRun`.
+    :type run: Optional[BatchRun]
+    :return: The batch run, with its statistics.
+    :rtype: BatchRun
+    """
+    run = run or BatchRun(api_key)
+    stages = list(stages or pipeline_stages())
+    started = time.perf_counter()
+    controls = {row_id: {"openai_api_key": api_key, "original_input": description, "priority": "batch",
+                         "batch": run} for row_id, description in rows}
+    remaining = {row_id: list(stages) for row_id in controls}
+
+    def finish(row_id: str, error: Optional[BaseException] = None) -> None:
+        state = controls.pop(row_id)
+        state.pop("batch")
+        record_assessment(state, time.perf_counter() - started, "failed" if error else "completed")
+        if error is None:
+            on_result(row_id, state)
+        elif on_error is None:
+            raise error
+        else:
+            on_error(row_id, error)
+
+    for _ in range(MAX_ROUNDS):
+        for row_id, state in list(controls.items()):
+            try:
+                for stage in list(remaining[row_id]):
+                    if not all(key in state for key in stage.inputs):
+                        continue
+                    try:
+                        stage.run(state)
+                    except Deferred:
+                        continue
+                    note_fingerprint(stage, state)
+                    remaining[row_id].remove(stage)
+            except Exception as error:
+                finish(row_id, error)
+                continue
+            if not remaining[row_id]:
+                finish(row_id)
+        if not run.pending:
+            break
+        run.submit()
+
+    for row_id in list(controls):
+        waiting = ", ".join(stage.name for stage in remaining[row_id])
+        finish(row_id, RuntimeError(f"Stages {waiting} still unanswered after {MAX_ROUNDS} batch rounds"))
+    return run
+
+
+def run_batch_api(input_path: str, output_path: str, api_key: str, column: Optional[str] = None,
+                  id_column: Optional[str] = None, checkpoint_path: Optional[str] = None,
+                  poll_seconds: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Assess every control of an inventory file through the Batch API and write the results
+    workbook, like :func:`src.control_batch.run_batch` (including its checkpoint).
+
+    :param input_path: The .csv or .xlsx inventory.
+    :type input_path: str
+    :param output_path: The .xlsx results workbook to (re)create.
+    :type output_path: str
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param column: Header of the control description column.
+    :type column: Optional[str]
+    :param id_column: Header of the row identifier column.
+    :type id_column: Optional[str]
+    :param checkpoint_path: The checkpoint file; defaults to ``<output_path>.checkpoint.jsonl``.
+    :type checkpoint_path: Optional[str]
+    :param poll_seconds: Seconds between batch status polls.
+    :type poll_seconds: Optional[float]
+    :return: Run statistics: resumed, assessed and failed row counts, the batch statistics
+             (see :class:`BatchRun`), elapsed seconds and estimated cost.
+    :rtype: Dict[str, Any]
+    """
+    checkpoint_path = checkpoint_path or output_path + ".checkpoint.jsonl"
+    writer = ResultWriter(output_path, checkpoint_path)
+    stats = {"resumed": 0, "assessed": 0, "failed": 0, "cost_usd": 0.0}
+
+    done = set()
+    for record in load_checkpoint(checkpoint_path):
+        if record["row_id"] not in done:
+            done.add(record["row_id"])
+            writer.write(record["row_id"], record, checkpoint=False)
+            stats["resumed"] += 1
+
+    store = get_store()
+
+    def on_result(row_id: str, state: Dict[str, Any]) -> None:
+        writer.write(row_id, state)
+        if store is not None:
+            store.save(state, "batch_api")
+        stats["assessed"] += 1
+        stats["cost_usd"] += sum(record["cost_usd"] for record in state.get("metrics", {}).values())
+
+    def on_error(row_id: str, error: BaseException) -> None:
+        logger.error("Row %s failed: %s", row_id, error)
+        stats["failed"] += 1
+
+    rows = [(row_id, text) for row_id, text in read_controls(input_path, column, id_column) if row_id not in done]
+    started = time.perf_counter()
+    try:
+        run = assess_in_batches(rows, api_key, on_result, on_error, run=BatchRun(api_key, poll_seconds))
+    finally:
+        writer.close()
+    stats.update(run.stats)
+    stats["elapsed_seconds"] = time.perf_counter() - started
+    return stats
+
+
+def main(argv: Optional[Iterable[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Assess a control inventory through the OpenAI Batch API.")
+    parser.add_argument("input", help="CSV or XLSX file with one control description per row")
+    parser.add_argument("-o", "--output", help="results workbook (default: <input>_assessment.xlsx)")
+    parser.add_argument("--column", help="header of the control description column (default: first column)")
+    parser.add_argument("--id-column", help="header of a stable row identifier column (default: row number)")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <output>.checkpoint.jsonl)")
+    parser.add_argument("--poll", type=float, help="seconds between batch status polls (default: 30)")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"), help="defaults to $OPENAI_API_KEY")
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("an OpenAI API key is required (--api-key or $OPENAI_API_KEY)")
+    output = args.output or os.path.splitext(args.input)[0] + "_assessment.xlsx"
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    stats = run_batch_api(args.input, output, args.api_key, args.column, args.id_column, args.checkpoint, args.poll)
+    logger.info("Wrote %s: %d assessed, %d resumed, %d failed in %d rounds (%d batches, %d requests), "
+                "estimated cost %.4f USD", output, stats["assessed"], stats["resumed"], stats["failed"],
+                stats["rounds"], stats["batches"], stats["requests"], stats["cost_usd"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Persistent, content-addressed cache of LLM responses shared by all assessment stages.
+
+Entries are keyed on a hash of the stage prompt messages, the model settings and the
+prompt input values, so a repeated assessment of the same control is answered from disk.
+Editing a stage prompt changes its key; the entries written with the previous prompt
+are purged the first time the stage runs with the new one.
+
+Configuration (environment variables):
+
+- ``CONTROL_CACHE_PATH``: SQLite file (default ``.cache/control_cache.sqlite``)
+- ``CONTROL_CACHE_TTL_SECONDS``: entry lifetime (default 30 days, ``0`` for no expiry)
+- ``CONTROL_CACHE_MAX_ENTRIES``: entries kept before least-recently-used eviction (default 100000)
+- ``CONTROL_CACHE_DISABLED``: set to ``1`` to bypass the cache
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+from src.control_prompts import Prompt
+
+# Returned by LLMCache.get on a miss, since None is a valid response
+MISSING = object()
+
+# Run eviction after this many writes
+_EVICT_EVERY = 200
+
+
+def prompt_hash(prompt: Prompt) -> str:
+    """
+    Hash of a stage prompt, used to detect prompt edits.
+
+    :param prompt: The chat messages of a stage.
+    :type prompt: Prompt
+    :return: Hex SHA-256 digest of the messages.
+    :rtype: str
+    """
+    return hashlib.sha256(json.dumps(prompt).encode("utf-8")).hexdigest()
+
+
+def cache_key(prompt: Prompt, llm_settings: Dict[str, Any], inputs: Dict[str, Any],
+              schema: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Content address of an LLM call: prompt messages + model settings + input variables
+    (+ the JSON schema of structured-output stages).
+
+    :param prompt: The chat messages of the stage.
+    :type prompt: Prompt
+    :param llm_settings: The ``ChatOpenAI`` settings (model, reasoning_effort, ...).
+    :type llm_settings: Dict[str, Any]
+    :param inputs: The prompt input values.
+    :type inputs: Dict[str, Any]
+    :param schema: The response JSON schema, if any.
+    :type schema: Optional[Dict[str, Any]]
+    :return: Hex SHA-256 digest identifying the call.
+    :rtype: str
+    """
+    parts = [prompt, llm_settings, inputs] + ([schema] if schema is not None else [])
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    SQLite-backed response cache with TTL and least-recently-used size eviction.
+
+    Safe to share between threads; each thread uses its own connection.
+    """
+
+    def __init__(self, path: str, ttl_seconds: Optional[float] = 30 * 24 * 3600,
+                 max_entries: Optional[int] = 100_000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds or None
+        self.max_entries = max_entries or None
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.evicted = 0
+        self._writes = 0
+        self._checked_prompts = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, stage TEXT NOT NULL, prompt_hash TEXT NOT NULL,"
+                " llm_settings TEXT NOT NULL, inputs TEXT NOT NULL, response TEXT NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_stage ON responses (stage, prompt_hash)")
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.evict()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Any:
+        """
+        Look up a response.
+
+        :param key: The :func:`cache_key` of the call.
+        :type key: str
+        :return: The cached response, or ``MISSING`` on a miss.
+        """
+        now = time.time()
+        row = self._connection().execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+            self._connection().execute("DELETE FROM responses WHERE key = ?", (key,))
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+        self._connection().execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key: str, stage: str, prompt: Prompt, llm_settings: Dict[str, Any],
+            inputs: Dict[str, Any], response: Any) -> None:
+        """
+        Store a response.
+
+        :param key: The :func:`cache_key` of the call.
+        :param stage: The stage that made the call.
+        :param prompt: The chat messages of the stage.
+        :param llm_settings: The ``ChatOpenAI`` settings.
+        :param inputs: The prompt input values.
+        :param response: The JSON-serialisable response.
+        """
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, stage, prompt_hash(prompt), json.dumps(llm_settings, sort_keys=True, default=str),
+             json.dumps(inputs, sort_keys=True, default=str), json.dumps(response), now, now),
+        )
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % _EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def invalidate_stale(self, stage: str, prompt: Prompt) -> int:
+        """
+        Drop the entries a stage wrote with a different prompt. Runs once per
+        (stage, prompt) per process.
+
+        :param stage: The stage name.
+        :param prompt: The current chat messages of the stage.
+        :return: The number of entries removed.
+        :rtype: int
+        """
+        current = prompt_hash(prompt)
+        with self._lock:
+            if (stage, current) in self._checked_prompts:
+                return 0
+            self._checked_prompts.add((stage, current))
+        removed = self._connection().execute(
+            "DELETE FROM responses WHERE stage = ? AND prompt_hash != ?", (stage, current)).rowcount
+        with self._lock:
+            self.invalidated += removed
+        return removed
+
+    def evict(self) -> int:
+        """
+        Remove expired entries, then the least recently used ones above ``max_entries``.
+
+        :return: The number of entries removed.
+        :rtype: int
+        """
+        connection = self._connection()
+        removed = 0
+        if self.ttl_seconds is not None:
+            removed += connection.execute("DELETE FROM responses WHERE created < ?",
+                                          (time.time() - self.ttl_seconds,)).rowcount
+        if self.max_entries is not None:
+            removed += connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed DESC"
+                " LIMIT -1 OFFSET ?)", (self.max_entries,)).rowcount
+        with self._lock:
+            self.evicted += removed
+        return removed
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM responses")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Hit/miss counters of this process and the current size of the cache.
+
+        :rtype: Dict[str, Any]
+        """
+        entries = self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidated": self.invalidated,
+                "evicted": self.evicted,
+                "entries": entries,
+            }
+
+
+_default_cache: Any = MISSING
+_default_lock = threading.Lock()
+
+
+def get_cache() -> Optional[LLMCache]:
+    """
+    The process-wide cache configured from the environment, or None when disabled.
+
+    :rtype: Optional[LLMCache]
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is MISSING:
+            if os.environ.get("CONTROL_CACHE_DISABLED", "").lower() in ("1", "true", "yes"):
+                _default_cache = None
+            else:
+                _default_cache = LLMCache(
+                    os.environ.get("CONTROL_CACHE_PATH", os.path.join(".cache", "control_cache.sqlite")),
+                    float(os.environ.get("CONTROL_CACHE_TTL_SECONDS", 30 * 24 * 3600)),
+                    int(os.environ.get("CONTROL_CACHE_MAX_ENTRIES", 100_000)),
+                )
+    return _default_cache
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect or maintain the LLM response cache.")
+    parser.add_argument("command", choices=("stats", "evict", "clear"))
+    args = parser.parse_args()
+
+    cache = get_cache()
+    if cache is None:
+        parser.error("the cache is disabled (CONTROL_CACHE_DISABLED)")
+    if args.command == "evict":
+        print(f"Evicted {cache.evict()} entries")
+    elif args.command == "clear":
+        cache.clear()
+    print(json.dumps(cache.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Cooperative cancellation of assessments.
+
+An assessment carries a :class:`CancelToken` in ``state["cancel_token"]``. The pipeline
+checks it before starting each stage and, when it is cancelled, aborts the stage calls
+in flight (cancelling their tasks closes the HTTP requests, so the model stops
+generating) and raises :class:`Cancelled`. The apps cancel the token of a session's
+running assessment when the session is reset or a newer control description arrives,
+instead of paying for stages nobody will read.
+
+Cancelled runs are reported in their metrics: status "cancelled", the interrupted stage
+calls with outcome "cancelled", and ``state["cancellation"]`` with the reason and the
+stages that were never started (see :func:`src.control_metrics.record_assessment`).
+
+Usage::
+
+    token = CancelToken()
+    state = {"openai_api_key": key, "original_input": text, "cancel_token": token}
+    ...
+    token.cancel("new input")  # from any thread
+"""
+import threading
+from typing import Callable, List, Optional
+
+
+class Cancelled(Exception):
+    """
+    The assessment was cancelled through its token.
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f"Assessment cancelled: {reason}")
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    A one-shot, thread-safe cancellation flag with callbacks.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[str], None]] = []
+        self.reason: Optional[str] = None
+
+    @property
+    def cancelled(self) -> bool:
+        """
+        Whether :meth:`cancel` was called.
+
+        :rtype: bool
+        """
+        return self.reason is not None
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """
+        Cancel the work of the token and run its callbacks; later calls do nothing.
+
+        :param reason: Why, e.g. "new input" or "new conversation"; reported in the metrics.
+        :type reason: str
+        :return: Whether this call cancelled the token.
+        :rtype: bool
+        """
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(reason)
+        return True
+
+    def on_cancel(self, callback: Callable[[str], None]) -> Callable[[], None]:
+        """
+        Call ``callback(reason)`` on cancellation, at once if already cancelled. Callbacks run
+        in the cancelling thread, so they must be thread-safe.
+
+        :param callback: Receives the reason.
+        :type callback: Callable[[str], None]
+        :return: Removes the callback.
+        :rtype: Callable[[], None]
+        """
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback(self.reason)
+        return lambda: None
+
+    def _remove(self, callback: Callable[[str], None]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def raise_if_cancelled(self) -> None:
+        """
+        :raises Cancelled: If the token was cancelled.
+        """
+        if self.reason is not None:
+            raise Cancelled(self.reason)
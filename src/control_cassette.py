@@ -0,0 +1,413 @@
+"""
+Record/replay of LLM calls for deterministic, offline regression runs.
+
+A cassette captures every stage call made through :mod:`src.control_llm` (including
+contract repairs) as one JSON line: the stage, the call's :func:`src.control_cache.cache_key`,
+the hashes of its prompt and inputs, the response (or the streamed chunks with their
+offsets), the wall time and the token usage. Replaying a cassette answers the same calls
+from the file, with their original latency or none, and restores their token usage and
+cost in the stage metrics; nothing is sent to the API and the response cache is not used.
+
+Modes:
+
+- ``record``: call the API as usual and write a fresh cassette.
+- ``replay``: answer every call from the cassette; a call that was not recorded raises
+  :class:`CassetteMiss`.
+- ``check``: like ``replay``, but a call whose prompt or settings changed since the
+  recording is answered with the recording of the same stage and inputs and reported
+  (see :meth:`Cassette.report`), so one offline run lists every stage a prompt edit
+  would send back to the API.
+
+Configuration (environment variables):
+
+- ``CONTROL_CASSETTE``: the cassette file (``.jsonl``, or ``.jsonl.gz`` compressed); unset
+  to disable record/replay
+- ``CONTROL_CASSETTE_MODE``: "record", "replay" (default) or "check"
+- ``CONTROL_CASSETTE_LATENCY``: replay with "zero" (default) or the "original" latency
+
+Usage::
+
+    python -m src.control_batch controls.xlsx --cassette regression.jsonl.gz --cassette-mode record
+    python -m src.control_batch controls.xlsx -o replayed.xlsx --cassette regression.jsonl.gz
+    python -m src.control_batch controls.xlsx -o checked.xlsx --cassette regression.jsonl.gz --cassette-mode check
+    python -m src.control_cassette stats regression.jsonl.gz
+    python -m src.control_cassette budgets regression.jsonl.gz -o budgets.json
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from typing import IO, Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from src.control_cache import MISSING, prompt_hash
+from src.control_metrics import TOKEN_TYPES, StageRecorder, estimate_cost
+from src.control_prompts import Prompt
+
+MODES = ("record", "replay", "check")
+LATENCIES = ("zero", "original")
+
+
+class CassetteMiss(Exception):
+    """
+    A replayed call has no recording.
+    """
+
+    def __init__(self, stage: str, cause: str):
+        super().__init__(f"No recording of the {stage} call ({cause})")
+        self.stage = stage
+        self.cause = cause
+
+
+def inputs_hash(inputs: Dict[str, Any]) -> str:
+    """
+    Hash of the prompt input values of a call.
+
+    :rtype: str
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class Cassette:
+    """
+    The recorded calls of one cassette file. Safe to share between threads and event loops.
+    """
+
+    def __init__(self, path: str, mode: str = "replay", latency: str = "zero"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cassette mode {mode!r}; expected one of {', '.join(MODES)}")
+        if latency not in LATENCIES:
+            raise ValueError(f"Unknown replay latency {latency!r}; expected one of {', '.join(LATENCIES)}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.hits = 0
+        self.misses: List[Dict[str, str]] = []
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        # (stage, inputs hash) -> latest entry, to explain misses
+        self._by_inputs: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._file: Optional[IO[str]] = None
+
+        if mode == "record":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = _open(path, "w")
+        else:
+            for entry in self.entries():
+                self._add(entry)
+
+    @property
+    def replaying(self) -> bool:
+        """
+        Whether calls are answered from the cassette instead of the API.
+
+        :rtype: bool
+        """
+        return self.mode != "record"
+
+    def entries(self) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over the recorded calls of the file, in recording order.
+
+        :rtype: Iterator[Dict[str, Any]]
+        """
+        with _open(self.path, "r") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    def _add(self, entry: Dict[str, Any]) -> None:
+        # A call recorded twice is replayed from its latest recording
+        self._entries[entry["key"]] = entry
+        self._by_inputs[(entry["stage"], entry["inputs_hash"])] = entry
+
+    def record(self, stage: str, key: str, prompt: Prompt, inputs: Dict[str, Any], response: Any,
+               recorder: StageRecorder, seconds: float, chunks: Optional[List[Tuple[float, str]]] = None) -> None:
+        """
+        Append a finished call to the cassette.
+
+        :param stage: The stage of the call.
+        :param key: The :func:`src.control_cache.cache_key` of the call.
+        :param prompt: The chat messages of the stage.
+        :param inputs: The prompt input values.
+        :param response: The generated text or parsed structured response.
+        :param recorder: The recorder of the call, holding its model and token usage.
+        :param seconds: The wall time of the call.
+        :param chunks: ``(offset, text)`` pairs of a streamed call; its response is their text.
+        """
+        entry = {"stage": stage, "key": key, "prompt_hash": prompt_hash(prompt), "inputs_hash": inputs_hash(inputs),
+                 "model": recorder.model, "seconds": round(seconds, 3),
+                 "tokens": {token_type: count for token_type, count in recorder.tokens.items() if count}}
+        if chunks is not None:
+            entry["chunks"] = [[round(offset, 3), text] for offset, text in chunks]
+        else:
+            entry["response"] = response
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._add(entry)
+
+    def lookup(self, stage: str, key: str, prompt: Prompt, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        The recording of a call. In "check" mode, a call whose prompt or settings changed is
+        answered with the recording of the same stage and inputs, and reported.
+
+        :param stage: The stage of the call.
+        :param key: The :func:`src.control_cache.cache_key` of the call.
+        :param prompt: The chat messages of the stage.
+        :param inputs: The prompt input values.
+        :return: The recorded entry.
+        :rtype: Dict[str, Any]
+        :raises CassetteMiss: If the call was not recorded.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+            return entry
+        nearest = self._by_inputs.get((stage, inputs_hash(inputs)))
+        if nearest is None:
+            cause = "not recorded"
+        elif nearest["prompt_hash"] != prompt_hash(prompt):
+            cause = "prompt changed"
+        else:
+            cause = "settings changed"
+        with self._lock:
+            self.misses.append({"stage": stage, "cause": cause, "key": key})
+        if self.mode != "check" or nearest is None:
+            raise CassetteMiss(stage, cause)
+        return nearest
+
+    def _delays(self, entry: Dict[str, Any]) -> Iterator[Tuple[float, str]]:
+        # (seconds to wait, text) of each chunk of a replayed stream
+        chunks = entry.get("chunks")
+        if chunks is None:
+            chunks = [[entry["seconds"], _response(entry)]]
+        previous = 0.0
+        for offset, text in chunks:
+            yield (max(0.0, offset - previous) if self.latency == "original" else 0.0), text
+            previous = offset
+
+    def replay(self, stage: str, key: str, prompt: Prompt, inputs: Dict[str, Any], recorder: StageRecorder) -> Any:
+        """
+        Answer a call from the cassette, with its recorded token usage added to ``recorder``.
+
+        :return: The recorded response.
+        :raises CassetteMiss: If the call was not recorded.
+        """
+        entry = self._replayed(stage, key, prompt, inputs, recorder)
+        if self.latency == "original":
+            time.sleep(entry["seconds"])
+        return _response(entry)
+
+    async def areplay(self, stage: str, key: str, prompt: Prompt, inputs: Dict[str, Any],
+                      recorder: StageRecorder) -> Any:
+        """
+        Async variant of :meth:`replay`.
+        """
+        entry = self._replayed(stage, key, prompt, inputs, recorder)
+        if self.latency == "original":
+            await asyncio.sleep(entry["seconds"])
+        return _response(entry)
+
+    def replay_stream(self, stage: str, key: str, prompt: Prompt, inputs: Dict[str, Any],
+                      recorder: StageRecorder) -> Iterator[str]:
+        """
+        Streaming variant of :meth:`replay`: yields the recorded chunks, at their recorded
+        offsets with the "original" latency.
+        """
+        entry = self._replayed(stage, key, prompt, inputs, recorder)
+        for delay, text in self._delays(entry):
+            if delay:
+                time.sleep(delay)
+            recorder.first_token()
+            yield text
+
+    async def areplay_stream(self, stage: str, key: str, prompt: Prompt, inputs: Dict[str, Any],
+                             recorder: StageRecorder) -> AsyncIterator[str]:
+        """
+        Async variant of :meth:`replay_stream`.
+        """
+        entry = self._replayed(stage, key, prompt, inputs, recorder)
+        for delay, text in self._delays(entry):
+            if delay:
+                await asyncio.sleep(delay)
+            recorder.first_token()
+            yield text
+
+    def _replayed(self, stage: str, key: str, prompt: Prompt, inputs: Dict[str, Any],
+                  recorder: StageRecorder) -> Dict[str, Any]:
+        entry = self.lookup(stage, key, prompt, inputs)
+        tokens = entry.get("tokens", {})
+        recorder.add_usage(*(tokens.get(token_type, 0) for token_type in TOKEN_TYPES))
+        return entry
+
+    def report(self) -> Dict[str, Any]:
+        """
+        The replayed calls and, per stage, the calls that missed the cassette by cause
+        ("prompt changed", "settings changed" or "not recorded").
+
+        :rtype: Dict[str, Any]
+        """
+        with self._lock:
+            stages: Dict[str, Dict[str, int]] = {}
+            for miss in self.misses:
+                causes = stages.setdefault(miss["stage"], {})
+                causes[miss["cause"]] = causes.get(miss["cause"], 0) + 1
+            return {"hits": self.hits, "misses": len(self.misses), "stages": stages}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _response(entry: Dict[str, Any]) -> Any:
+    # The recorded response; the joined text of a streamed call
+    chunks = entry.get("chunks")
+    return "".join(text for _, text in chunks) if chunks is not None else entry["response"]
+
+
+def stats(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Per-stage summary of a cassette: recorded calls, streamed calls, distinct prompts,
+    recorded seconds, tokens and estimated cost.
+
+    :param path: The cassette file.
+    :type path: str
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    summary: Dict[str, Dict[str, Any]] = {}
+    prompts: Dict[str, set] = {}
+    for entry in Cassette(path).entries():
+        row = summary.setdefault(entry["stage"], {"calls": 0, "streamed": 0, "prompts": 0, "seconds": 0.0,
+                                                  **{f"{token_type}_tokens": 0 for token_type in TOKEN_TYPES},
+                                                  "cost_usd": 0.0})
+        tokens = entry.get("tokens", {})
+        row["calls"] += 1
+        row["streamed"] += "chunks" in entry
+        row["seconds"] += entry["seconds"]
+        for token_type in TOKEN_TYPES:
+            row[f"{token_type}_tokens"] += tokens.get(token_type, 0)
+        row["cost_usd"] += estimate_cost(entry["model"], tokens.get("input", 0), tokens.get("cached", 0),
+                                         tokens.get("output", 0))
+        prompts.setdefault(entry["stage"], set()).add(entry["prompt_hash"])
+        row["prompts"] = len(prompts[entry["stage"]])
+    return summary
+
+
+def _percentile(values: List[int], fraction: float) -> int:
+    # Nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def budgets(path: str, headroom: float = 1.25) -> Dict[str, Dict[str, Any]]:
+    """
+    Per-stage output budgets measured from a cassette: the median, 95th percentile and
+    largest output tokens (reasoning included) and reasoning tokens of the recorded calls,
+    and the ``max_completion_tokens`` they call for, the largest output times ``headroom``
+    rounded up to a hundred. Retries of cut-off answers count towards their stage, so a
+    stage whose answers outgrew its budget gets one they fit; so do repairs. The budgets, written as
+    ``{stage: budget}``, are what ``CONTROL_STAGE_BUDGETS`` reads (see
+    :mod:`src.control_contracts`).
+
+    :param path: The cassette file.
+    :type path: str
+    :param headroom: The budget over the largest recorded output.
+    :type headroom: float
+    :rtype: Dict[str, Dict[str, Any]]
+    """
+    usage: Dict[str, Tuple[List[int], List[int]]] = {}
+    for entry in Cassette(path).entries():
+        # Retries and repairs run on their stage's budget
+        stage = re.sub(r"_(?:retry|repair)$", "", entry["stage"])
+        tokens = entry.get("tokens", {})
+        outputs, reasonings = usage.setdefault(stage, ([], []))
+        outputs.append(tokens.get("output", 0))
+        reasonings.append(tokens.get("reasoning", 0))
+    summary: Dict[str, Dict[str, Any]] = {}
+    for stage, (outputs, reasonings) in sorted(usage.items()):
+        summary[stage] = {"calls": len(outputs),
+                          **{f"output_{name}": _percentile(outputs, fraction)
+                             for name, fraction in (("p50", 0.5), ("p95", 0.95), ("max", 1.0))},
+                          **{f"reasoning_{name}": _percentile(reasonings, fraction)
+                             for name, fraction in (("p50", 0.5), ("p95", 0.95), ("max", 1.0))},
+                          "budget": math.ceil(max(max(outputs), 1) * headroom / 100) * 100}
+    return summary
+
+
+_default_cassette: Any = MISSING
+_default_lock = threading.Lock()
+
+
+def use_cassette(path: Optional[str], mode: str = "replay", latency: str = "zero") -> Optional["Cassette"]:
+    """
+    Install the process-wide cassette, replacing the one configured from the environment.
+
+    :param path: The cassette file, or None to disable record/replay.
+    :type path: Optional[str]
+    :param mode: "record", "replay" or "check".
+    :type mode: str
+    :param latency: Replay with "zero" or the "original" latency.
+    :type latency: str
+    :rtype: Optional[Cassette]
+    :raises ValueError: On an unknown mode or latency.
+    """
+    global _default_cassette
+    cassette = Cassette(path, mode, latency) if path else None
+    with _default_lock:
+        previous, _default_cassette = _default_cassette, cassette
+    if isinstance(previous, Cassette):
+        previous.close()
+    return cassette
+
+
+def get_cassette() -> Optional[Cassette]:
+    """
+    The process-wide cassette configured from the environment, or None when record/replay is off.
+
+    :rtype: Optional[Cassette]
+    """
+    global _default_cassette
+    with _default_lock:
+        if _default_cassette is MISSING:
+            path = os.environ.get("CONTROL_CASSETTE")
+            _default_cassette = Cassette(path, os.environ.get("CONTROL_CASSETTE_MODE", "replay").lower(),
+                                         os.environ.get("CONTROL_CASSETTE_LATENCY", "zero").lower()) if path else None
+    return _default_cassette
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect a record/replay cassette.")
+    parser.add_argument("command", choices=("stats", "budgets"))
+    parser.add_argument("cassette", help="the cassette file")
+    parser.add_argument("--headroom", type=float, default=1.25,
+                        help="budgets: the budget over the largest recorded output (default: 1.25)")
+    parser.add_argument("-o", "--output", help="budgets: write {stage: budget} for CONTROL_STAGE_BUDGETS to this file")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print(json.dumps(stats(args.cassette), indent=2))
+        return
+    measured = budgets(args.cassette, args.headroom)
+    print(json.dumps(measured, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({stage: row["budget"] for stage, row in measured.items()}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,37 @@
 import warnings
 import os
-from langchain import hub
-from typing import Any, List, Dict
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from typing import Any, AsyncIterator, Dict, Iterator, List
+from src.control_prompts import CLASSIFICATION_LABELS, stage_prompt
+from src.control_contracts import OutputContract
+from src.control_llm import run_chain, arun_chain
+
+
+CLASSIFICATION_PROMPT = stage_prompt('''
+    # Instructions
+    - Your job is to classify the input control into one of the Control Categories above
+    - Trace back your reasoning to the input
+    - Return only the classification as a string
+    - Make sure you do not return any other information besides the classification
+    ''')
+
+CLASSIFICATION_LLM = {"model": "gpt-4o-mini", "temperature": 0}
+
+# One of the labels, as a strict JSON-schema enum (see src/control_contracts.py)
+CLASSIFICATION_CONTRACT = OutputContract(max_tokens=20, labels=CLASSIFICATION_LABELS)
+
+
+def _classify_locally(state: Dict[str, Any]) -> bool:
+    # Confident local predictions skip the LLM call (see src.control_local_classifier);
+    # imported on first use, as it loads numpy
+    from src.control_local_classifier import local_classify
+    prediction = local_classify(state["original_input"])
+    if prediction is None:
+        state["classification_source"] = "llm"
+        return False
+    state["control_classification"], state["classification_confidence"] = prediction
+    state["classification_source"] = "local"
+    return True
+
 
 def classify(state: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -16,48 +43,45 @@ def classify(state: Dict[str, Any]) -> Dict[str, Any]:
                   control description to be classified.
     :type state: Dict[str, Any]
     :return: The updated state dictionary with the added control classification result
-             under the "control_classification" key.
+             under the "control_classification" key, and "classification_source" set to
+             "local" when the offline classifier was confident enough to skip the LLM.
     :rtype: Dict[str, Any]
     """
-    classification_prompt = '''
-    # Instructions
-    - The input is the description of a control for a financial payement system
-    - Your job is to classify the input into the following categories:
-        -- Validation
-        -- Duplicates
-        -- Sanctions
-        -- Fraud
-        -- Insufficient Funds
-        -- High Dollar Escalation
-        -- Completed Fields
-        -- Travel Rules
-    - Trace back your reasoning to the input
-    - Return only the classification as a string
-    - Make sure you do not return any other information besides the classification
+    if _classify_locally(state):
+        return state
+
+    generation = run_chain("classify", CLASSIFICATION_PROMPT, {"control": state["original_input"]},
+                           state, CLASSIFICATION_LLM, contract=CLASSIFICATION_CONTRACT)
+    state["control_classification"] = generation
+
+    return state
+
 
-    # Context
-    - Validation: Controls that are used to validate the payment account information with OVS
-    - Duplicates: Controls that checks if a payment is a duplicate payment
-    - Sanctions: Controls that checks if a payment is violation a sanction
-    - Control: Controls that checks if a payment is fraudulent
-    - Insufficient Funds: Controls that checks if a payment is from an account with insufficient funds
-    - High-Dollar Escalation: Controls that checks if a payment is greater than $20 million
-    - Completed Fields: Controls that checks if a payment has all fields completed
-    - Travel Rules: Controls that checks if a payment is compliant with the Travel Rules
+async def aclassify(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of :func:`classify` built on ``ainvoke``.
+    """
+    if _classify_locally(state):
+        return state
 
-    # Input
-    {input}
-    '''
+    generation = await arun_chain("classify", CLASSIFICATION_PROMPT, {"control": state["original_input"]},
+                                  state, CLASSIFICATION_LLM, contract=CLASSIFICATION_CONTRACT)
+    state["control_classification"] = generation
 
-    # Create a chat prompt template using the detailed prompt
-    prompt = ChatPromptTemplate(["system", classification_prompt])
+    return state
 
-    # Initialize OpenAI Language Model
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=state["openai_api_key"])
 
-    # Combine the prompt, the language model, and the output parser into a processing chain.
-    rag_chain = prompt | llm | StrOutputParser()
+def stream_classify(state: Dict[str, Any]) -> Iterator[str]:
+    """
+    Streaming variant of :func:`classify`. The answer is a single label, so it is yielded
+    in one piece once known and stored under "control_classification".
+    """
+    yield classify(state)["control_classification"]
 
-    state["control_classification"] = rag_chain.invoke({"input": state["original_input"]})
 
-    return state
\ No newline at end of file
+async def astream_classify(state: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Async variant of :func:`stream_classify`: awaits :func:`aclassify` and yields the final label once,
+    since a label under a strict schema has nothing to stream.
+    """
+    yield (await aclassify(state))["control_classification"]
@@ -0,0 +1,202 @@
+"""
+Shared OpenAI clients and pre-built stage chains.
+
+Chains are built once per (prompt, model settings, API key) and reused by every
+stage call, Streamlit session and batch row of the process. All clients share pooled
+httpx clients, so keep-alive connections (and their TLS sessions) stay warm between calls.
+
+Pool limits (environment variables):
+
+- ``CONTROL_HTTP_MAX_CONNECTIONS``: open connections per pool (default 100)
+- ``CONTROL_HTTP_MAX_KEEPALIVE``: idle keep-alive connections per pool (default 20)
+- ``CONTROL_HTTP_KEEPALIVE_EXPIRY``: seconds an idle connection is kept (default 120)
+"""
+import asyncio
+import json
+import os
+import threading
+import weakref
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+import httpx
+from src.control_prompts import Prompt
+from src.control_metrics import acount_request, count_request
+from src.control_ratelimit import arecord_headers, record_headers
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+# Matches the OpenAI SDK default; o3-mini "high" calls can take minutes
+_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
+_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_async_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_openai_clients: Dict[str, "OpenAI"] = {}
+_sync_chains: Dict[Tuple[Prompt, str, str], Any] = {}
+_async_chains: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[Prompt, str, str], Any]]" = weakref.WeakKeyDictionary()
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def pool_limits() -> httpx.Limits:
+    """
+    The connection pool limits configured from the environment.
+
+    :rtype: httpx.Limits
+    """
+    return httpx.Limits(
+        max_connections=int(os.environ.get("CONTROL_HTTP_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(os.environ.get("CONTROL_HTTP_MAX_KEEPALIVE", 20)),
+        keepalive_expiry=float(os.environ.get("CONTROL_HTTP_KEEPALIVE_EXPIRY", 120)),
+    )
+
+
+def get_http_client() -> httpx.Client:
+    """
+    The process-wide pooled HTTP client used for synchronous calls.
+
+    :rtype: httpx.Client
+    """
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=pool_limits(), timeout=_TIMEOUT,
+                                        event_hooks={"request": [count_request], "response": [record_headers]})
+        return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    The pooled HTTP client of the running event loop. Async connections are bound to the
+    loop that opened them, so each loop gets its own pool; it is released with the loop.
+
+    :rtype: httpx.AsyncClient
+    :raises RuntimeError: If called outside a running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_http_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(limits=pool_limits(), timeout=_TIMEOUT,
+                                       event_hooks={"request": [acount_request], "response": [arecord_headers]})
+            _async_http_clients[loop] = client
+        return client
+
+
+def get_openai_client(api_key: str) -> "OpenAI":
+    """
+    A shared ``OpenAI`` client for direct SDK calls, such as the follow-up chat.
+
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :rtype: OpenAI
+    """
+    from openai import OpenAI
+    http_client = get_http_client()
+    with _lock:
+        client = _openai_clients.get(api_key)
+        if client is None:
+            # Retried by the rate-limit scheduler instead (see src.control_ratelimit)
+            client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+            _openai_clients[api_key] = client
+        return client
+
+
+def _build_chain(prompt: Prompt, llm_settings: Dict[str, Any], api_key: str,
+                 schema: Optional[Dict[str, Any]] = None, http_async_client: Optional[httpx.AsyncClient] = None):
+    # The OpenAI and LangChain packages take about a second to import; see preload()
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_openai import ChatOpenAI
+
+    # Create a chat prompt template from the stage messages
+    chat_prompt = ChatPromptTemplate(list(prompt))
+
+    # Initialize OpenAI Language Model on the shared connection pools; stream_usage reports
+    # token usage on streamed calls too. Retries are left to the rate-limit scheduler
+    # (see src.control_ratelimit), which backs off for all callers of a model at once.
+    llm = ChatOpenAI(api_key=api_key, http_client=get_http_client(), http_async_client=http_async_client,
+                     stream_usage=True, max_retries=0, **llm_settings)
+
+    # Structured stages parse the JSON-schema response into a dict
+    if schema is not None:
+        return chat_prompt | llm.with_structured_output(schema, method="json_schema", strict=True)
+
+    # Combine the prompt, the language model, and the output parser into a processing chain.
+    return chat_prompt | llm | StrOutputParser()
+
+
+def get_chain(prompt: Prompt, llm_settings: Dict[str, Any], api_key: str,
+              schema: Optional[Dict[str, Any]] = None):
+    """
+    The ``prompt | llm | StrOutputParser()`` chain of a stage, built on first use. With a
+    ``schema`` the chain requests a strict JSON-schema response and returns the parsed dict.
+
+    Inside a running event loop the chain is bound to that loop's async connection pool;
+    otherwise it is the process-wide chain for synchronous ``invoke``.
+
+    :param prompt: The chat messages of the stage (see :func:`src.control_prompts.stage_prompt`).
+    :type prompt: Prompt
+    :param llm_settings: Keyword arguments for ``ChatOpenAI`` (model, reasoning_effort, ...).
+    :type llm_settings: Dict[str, Any]
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param schema: The JSON schema of a structured response, with "title" and "description".
+    :type schema: Optional[Dict[str, Any]]
+    :return: The runnable processing chain.
+    """
+    key = (prompt, json.dumps([llm_settings, schema], sort_keys=True), api_key)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    if loop is None:
+        with _lock:
+            chain = _sync_chains.get(key)
+        if chain is None:
+            chain = _build_chain(prompt, llm_settings, api_key, schema)
+            with _lock:
+                chain = _sync_chains.setdefault(key, chain)
+        return chain
+
+    http_async_client = get_async_http_client()
+    with _lock:
+        chains = _async_chains.setdefault(loop, {})
+        chain = chains.get(key)
+    if chain is None:
+        chain = _build_chain(prompt, llm_settings, api_key, schema, http_async_client)
+        with _lock:
+            chain = chains.setdefault(key, chain)
+    return chain
+
+
+def preload() -> None:
+    """
+    Import the OpenAI and LangChain packages and open the shared HTTP client and the
+    background loop, so that the first stage call does not pay for them. Chains are built
+    on first use, as they depend on the API key.
+    """
+    import openai  # noqa: F401
+    import langchain_openai  # noqa: F401
+    from langchain_core.output_parsers import StrOutputParser  # noqa: F401
+    from langchain_core.prompts import ChatPromptTemplate  # noqa: F401
+    get_http_client()
+    get_background_loop()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """
+    A process-wide event loop running on a daemon thread.
+
+    Work submitted with ``asyncio.run_coroutine_threadsafe`` keeps running while the
+    submitting thread (e.g. a Streamlit script run) renders, and its async connection pool
+    stays warm across sessions instead of being torn down with a per-call loop.
+
+    :rtype: asyncio.AbstractEventLoop
+    """
+    global _background_loop
+    with _lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="control-llm-loop", daemon=True).start()
+        return _background_loop
@@ -0,0 +1,219 @@
+"""
+Output contracts of the assessment stages.
+
+Each stage declares what its answer must look like and what it may cost: one of a fixed
+set of labels (classify, score), a range of bullet points (risks, gaps, ...) and the
+output token budget of its call (``max_completion_tokens``, which for reasoning models
+includes the reasoning tokens).
+
+- Label stages request a strict JSON-schema response whose enum the API enforces
+  (see :meth:`OutputContract.schema`). Fused stages answer with their own schema and
+  check the parsed answer with the contract's ``validate`` function.
+- Every answer is also checked locally by :meth:`OutputContract.check`.
+- Only an answer that breaks its contract costs another call: a targeted repair that
+  shows the model its answer and asks for the missing shape, at low reasoning effort
+  (see :func:`src.control_llm.enforce`). An answer cut off by the budget (finish reason
+  "length", raised as :class:`CutOff`) is asked again with twice the budget. Repairs are
+  recorded as the stages ``<stage>_repair`` and ``<stage>_retry`` in the stage metrics
+  and the response cache.
+- An answer that still breaks its contract after the repairs fails the stage with
+  :class:`ContractViolation`; it is never stored.
+
+The budgets below are starting points. Size them from measured usage: record a run with
+a cassette (see :mod:`src.control_cassette`) and write the budgets its output and reasoning
+tokens call for with ``python -m src.control_cassette budgets``; ``CONTROL_STAGE_BUDGETS``
+applies them.
+
+Configuration (environment variables):
+
+- ``CONTROL_STAGE_BUDGETS``: JSON file ``{"stage": max_completion_tokens}`` overriding the
+  budgets of the contracts
+
+Usage::
+
+    RISK_CONTRACT = OutputContract(max_tokens=1500, bullets=(3, 6))
+    generation = run_chain("risks", RISK_PROMPT, inputs, state, RISK_LLM, contract=RISK_CONTRACT)
+"""
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional, Tuple
+from src.control_cache import MISSING
+from src.control_prompts import Prompt
+
+# A bullet point line: "-", "*", "•" or "1." / "1)" followed by text
+BULLET = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+\S")
+
+# Placeholder of the answer shown to the model in a repair
+PREVIOUS_ANSWER = "previous_answer"
+
+
+class CutOff(Exception):
+    """
+    A stage answer was cut off by its output budget (finish reason "length").
+    """
+
+    def __init__(self, stage: str):
+        super().__init__(f"The {stage} answer was cut off by its output budget")
+        self.stage = stage
+
+
+class ContractViolation(ValueError):
+    """
+    A stage answer still breaks its contract after every repair.
+    """
+
+    def __init__(self, stage: str, violation: str):
+        super().__init__(f"The {stage} answer breaks its contract ({violation})")
+        self.stage = stage
+        self.violation = violation
+
+
+_budgets: Any = MISSING
+_budgets_lock = threading.Lock()
+
+
+def stage_budgets() -> Dict[str, int]:
+    """
+    The budget overrides of ``$CONTROL_STAGE_BUDGETS``, loaded once; empty when unset.
+
+    :rtype: Dict[str, int]
+    """
+    global _budgets
+    with _budgets_lock:
+        if _budgets is MISSING:
+            path = os.environ.get("CONTROL_STAGE_BUDGETS")
+            if path:
+                with open(path, encoding="utf-8") as file:
+                    _budgets = {stage: int(tokens) for stage, tokens in json.load(file).items()}
+            else:
+                _budgets = {}
+    return _budgets
+
+
+@dataclass(frozen=True)
+class OutputContract:
+    """
+    The allowed shape and the output budget of a stage answer.
+
+    :ivar max_tokens: ``max_completion_tokens`` of the call.
+    :ivar labels: The allowed answers of a label stage; empty for free text.
+    :ivar bullets: ``(fewest, most)`` bullet points of a list answer.
+    :ivar validate: Checks the parsed answer of a stage with a schema of its own, returning
+                    the violation or None.
+    :ivar retries: Repairs tried before the stage fails with :class:`ContractViolation`.
+    """
+    max_tokens: int
+    labels: Tuple[str, ...] = ()
+    bullets: Optional[Tuple[int, int]] = None
+    # Left out of the repr, which stage fingerprints hash (see src/control_pipeline.py)
+    validate: Optional[Callable[[Dict[str, Any]], Optional[str]]] = field(default=None, repr=False, compare=False)
+    retries: int = 1
+
+    def settings(self, llm_settings: Dict[str, Any], scale: int = 1, stage: Optional[str] = None) -> Dict[str, Any]:
+        """
+        ``llm_settings`` with the output budget, times ``scale``.
+
+        :param stage: Looks up a measured budget in :func:`stage_budgets`.
+        :rtype: Dict[str, Any]
+        """
+        budget = stage_budgets().get(stage, self.max_tokens) if stage else self.max_tokens
+        return {**llm_settings, "max_completion_tokens": budget * scale}
+
+    def schema(self, stage: str) -> Optional[Dict[str, Any]]:
+        """
+        The strict JSON schema of a label answer, or None for free text.
+
+        :param stage: Names the schema.
+        :type stage: str
+        :rtype: Optional[Dict[str, Any]]
+        """
+        if not self.labels:
+            return None
+        return {
+            "title": stage,
+            "description": "The answer, exactly one of the allowed labels.",
+            "type": "object",
+            "properties": {"label": {"type": "string", "enum": list(self.labels)}},
+            "required": ["label"],
+            "additionalProperties": False,
+        }
+
+    def check(self, generation: Any) -> Tuple[Any, Optional[str]]:
+        """
+        Validate an answer and bring it into its final form: the label of a label stage,
+        the text otherwise.
+
+        :param generation: The parsed structured response or the generated text; None if
+                           it was cut off.
+        :return: ``(answer, violation)``; the violation is None when the answer is valid.
+        :rtype: Tuple[Any, Optional[str]]
+        """
+        if self.validate is not None:
+            if not isinstance(generation, dict):
+                return None, "empty answer"
+            return generation, self.validate(generation)
+        text = generation.get("label", "") if isinstance(generation, dict) else str(generation or "")
+        text = text.strip()
+        if not text:
+            return text, "empty answer"
+
+        if self.labels:
+            cleaned = text.strip(" \t\n\"'`*.").lower()
+            for label in self.labels:
+                if cleaned == label.lower():
+                    return label, None
+            # A label wrapped in a sentence is accepted when it is the only one mentioned
+            mentioned = [label for label in self.labels if label.lower() in cleaned]
+            if len(mentioned) == 1:
+                return mentioned[0], None
+            return text, f"not one of {', '.join(self.labels)}"
+
+        if self.bullets is not None:
+            fewest, most = self.bullets
+            count = sum(1 for line in text.splitlines() if BULLET.match(line))
+            if not fewest <= count <= most:
+                return text, f"{count} bullet points instead of {fewest}-{most}"
+        return text, None
+
+    def correction(self) -> str:
+        """
+        The instruction of a repair; the same for every answer, so the repair prompt (and
+        its chain and cache entries) are shared.
+
+        :rtype: str
+        """
+        if self.validate is not None:
+            # A structured answer: its schema fixes the format, the repair the contents
+            if self.bullets is not None:
+                return (f"Answer again in the same format, with {self.bullets[0]}-{self.bullets[1]} succinct bullet "
+                        "points in each list.")
+            return "Answer again in the same format, following the instructions."
+        if self.labels:
+            return f"Answer again with exactly one of: {', '.join(self.labels)}."
+        if self.bullets is not None:
+            return (f"Rewrite your answer as {self.bullets[0]}-{self.bullets[1]} succinct bullet points, one per "
+                    "line starting with \"- \", keeping the most important points. Answer with the bullet points only.")
+        return "Answer again, following the instructions."
+
+    def repair_prompt(self, prompt: Prompt) -> Prompt:
+        """
+        ``prompt`` followed by the broken answer (the ``{previous_answer}`` input) and the correction.
+
+        :rtype: Prompt
+        """
+        return prompt + (("ai", "{" + PREVIOUS_ANSWER + "}"), ("human", self.correction()))
+
+    def repair_settings(self, llm_settings: Dict[str, Any], stage: Optional[str] = None) -> Dict[str, Any]:
+        """
+        The model settings of a repair: reshaping an answer needs little reasoning.
+
+        :param stage: Looks up a measured budget in :func:`stage_budgets`.
+        :rtype: Dict[str, Any]
+        """
+        settings = self.settings(llm_settings, stage=stage)
+        if "reasoning_effort" in settings:
+            settings["reasoning_effort"] = "low"
+        return settings
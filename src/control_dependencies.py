@@ -1,35 +1,58 @@
 import warnings
 import os
 from typing import List
-from langchain import hub
-from typing import Any, List, Dict
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from typing import Any, AsyncIterator, Dict, Iterator, List
+from src.control_prompts import stage_prompt
+from src.control_contracts import OutputContract
+from src.control_llm import run_chain, arun_chain, stream_stage, astream_stage
 
-def dependencies(state: Dict[str, Any]) -> Dict[str, Any]:
-    dependencies_prompt = '''
+
+DEPENDENCIES_PROMPT = stage_prompt('''
     # Instructions
-    - What are the main operational or technical dependencies that this control is solving for? \n
-    - Provide answer in 3-6 succinct bullet points.\n
+    - What are the main operational or technical dependencies that this control is solving for?
+    - Provide answer in 3-6 succinct bullet points.
+    ''')
+
+DEPENDENCIES_LLM = {"model": "o3-mini", "reasoning_effort": "high"}
 
-    # Context
-    - This it analyze the controls placed on a banking payment system
-    
-    # Control
-    {control}
-    '''
+# Answer shape and output budget (including reasoning tokens), see src/control_contracts.py
+DEPENDENCIES_CONTRACT = OutputContract(max_tokens=4000, bullets=(3, 6))
 
-    # Create a chat prompt template using the detailed prompt
-    prompt = ChatPromptTemplate(["system", dependencies_prompt])
 
-    # Initialize OpenAI Language Model
-    llm = ChatOpenAI(model="o3-mini", reasoning_effort="high", api_key=state["openai_api_key"])
+def dependencies(state: Dict[str, Any]) -> Dict[str, Any]:
+    generation = run_chain("dependencies", DEPENDENCIES_PROMPT, {"control": state["original_input"]},
+                           state, DEPENDENCIES_LLM, contract=DEPENDENCIES_CONTRACT)
+    state["control_dependencies"] = generation
+
+    return state
 
-    # Combine the prompt, the language model, and the output parser into a processing chain.
-    rag_chain = prompt | llm | StrOutputParser()
 
-    generation = rag_chain.invoke({"control": state["original_input"]})
+async def adependencies(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of :func:`dependencies` built on ``ainvoke``.
+    """
+    generation = await arun_chain("dependencies", DEPENDENCIES_PROMPT, {"control": state["original_input"]},
+                                  state, DEPENDENCIES_LLM, contract=DEPENDENCIES_CONTRACT)
     state["control_dependencies"] = generation
 
-    return state
\ No newline at end of file
+    return state
+
+
+def stream_dependencies(state: Dict[str, Any]) -> Iterator[str]:
+    """
+    Streaming variant of :func:`dependencies`: yields the text as it is generated and stores the
+    full text under "control_dependencies" once done.
+    """
+    yield from stream_stage("dependencies", DEPENDENCIES_PROMPT,
+                            {"control": state["original_input"]},
+                            state, DEPENDENCIES_LLM, DEPENDENCIES_CONTRACT, "control_dependencies")
+
+
+async def astream_dependencies(state: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Async variant of :func:`stream_dependencies` built on ``astream``.
+    """
+    async for chunk in astream_stage("dependencies", DEPENDENCIES_PROMPT,
+                                     {"control": state["original_input"]},
+                                     state, DEPENDENCIES_LLM, DEPENDENCIES_CONTRACT, "control_dependencies"):
+        yield chunk
@@ -0,0 +1,363 @@
+"""
+Bounded context for follow-up questions about an assessment.
+
+Instead of resending the whole chat (including the combined markdown of all eight
+sections) on every turn, :func:`followup_messages` builds each request within a token
+budget from:
+
+- the system prompt, with the control description and its classification and score;
+- a rolling summary of the older turns (see :func:`compact_history`);
+- the assessment sections relevant to the question, ranked by :func:`rank_sections`;
+- when the question asks about other controls, the most relevant prior assessments from
+  the assessment store (see :func:`related_assessments`);
+- as many of the most recent turns as fit, newest first;
+- the question.
+
+After each answer, :func:`compact_history` folds the turns that no longer fit the recent
+window into the rolling summary with one short call, so the request size, and with it the
+follow-up latency, stays flat however long the session runs.
+
+Configuration (environment variables):
+
+- ``CONTROL_CHAT_TOKEN_BUDGET``: input tokens of a follow-up request (default 4000)
+- ``CONTROL_CHAT_SUMMARY_TOKENS``: length limit of the rolling summary (default 400)
+
+Usage::
+
+    memory = ChatMemory()
+    related = related_assessments(question, get_store(), exclude=assessment_id)
+    stream = stream_followup(conversation, assessment, memory, api_key, related)
+    ...
+    compact_history(conversation, memory, api_key)
+"""
+import math
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+from src.control_clients import get_openai_client
+from src.control_pipeline import SECTIONS
+from src.control_prompts import CLASSIFICATION_LABELS, SCORE_VALUES
+from src.control_ratelimit import count_tokens, get_scheduler, output_estimate
+from src.control_store import AssessmentStore
+
+FOLLOWUP_MODEL = "gpt-4o-mini"
+
+# Always sent: the short, structured results of the assessment
+FIELD_KEYS = ("control_classification", "control_score")
+
+# Words that point a question at a section, in addition to the section's own text
+SECTION_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    "control_classification": ("classification", "classified", "category", "type", "label"),
+    "control_summary": ("summary", "summarise", "summarize", "overview", "describe", "explain"),
+    "control_risk": ("risk", "risks", "threat", "exposure", "impact", "mitigate", "mitigates"),
+    "control_dependencies": ("dependency", "dependencies", "depend", "depends", "relies", "system", "systems",
+                             "team", "teams", "upstream"),
+    "control_gaps": ("gap", "gaps", "weakness", "weaknesses", "missing", "improve", "improvement", "deficiency"),
+    "control_industry_practices": ("industry", "practice", "practices", "benchmark", "standard", "standards",
+                                   "peers", "regulator", "regulators"),
+    "control_score": ("score", "rating", "rated"),
+    "control_score_reasoning": ("why", "reason", "reasoning", "justify", "justification", "score", "rating",
+                                "rated", "higher", "lower"),
+}
+
+# Words that point a question at other controls than the one under discussion
+RELATED_KEYWORDS = ("other", "others", "similar", "previous", "previously", "prior", "earlier", "past", "compare",
+                    "compared", "comparison", "versus", "inventory", "controls")
+
+# Prior assessments sent with a question about other controls
+RELATED_LIMIT = 3
+
+# Fallback when no section matches the question
+DEFAULT_SECTION = "control_summary"
+
+# Share of the budget (after the fixed parts) for sections; the rest is for recent turns
+SECTION_SHARE = 0.5
+
+# Tokens of chat framing per message
+MESSAGE_OVERHEAD = 4
+
+STOPWORDS = frozenset((
+    "the", "and", "for", "are", "was", "were", "this", "that", "with", "what", "which", "how", "does", "did",
+    "can", "could", "would", "should", "about", "from", "into", "there", "their", "they", "you", "your", "its",
+    "has", "have", "had", "not", "but", "any", "all", "more", "most", "some", "than", "then", "them", "these",
+    "those", "control", "please", "tell",
+))
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain the running summary of a conversation between a reviewer and a control assessment "
+    "assistant. Merge the new turns into the summary. Keep the reviewer's questions, the answers' facts, "
+    "conclusions and open points; drop pleasantries and repetition. Answer with the updated summary only, "
+    "in at most {words} words."
+)
+
+
+@dataclass
+class ChatMemory:
+    """
+    The compacted part of a follow-up chat.
+
+    :ivar summary: Rolling summary of the turns before ``summarized``.
+    :ivar summarized: Index of the first conversation message not folded into the summary.
+    """
+    summary: str = ""
+    summarized: int = 1
+
+
+def token_budget() -> int:
+    """
+    The input token budget of a follow-up request.
+
+    :rtype: int
+    """
+    return int(os.environ.get("CONTROL_CHAT_TOKEN_BUDGET", 4000))
+
+
+def _message_tokens(message: Mapping[str, Any]) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def _terms(text: str) -> List[str]:
+    return [word for word in re.findall(r"[a-z][a-z'-]+", text.lower()) if len(word) > 2 and word not in STOPWORDS]
+
+
+def rank_sections(question: str, assessment: Mapping[str, Any]) -> List[str]:
+    """
+    The assessment sections relevant to a question, most relevant first: a match with a
+    section's keywords counts three times as much as a word shared with its text.
+
+    :param question: The follow-up question.
+    :type question: str
+    :param assessment: The assessment results by state key.
+    :type assessment: Mapping[str, Any]
+    :return: Keys of the sections with a positive score, or ``[DEFAULT_SECTION]``.
+    :rtype: List[str]
+    """
+    terms = set(_terms(question))
+    scores = []
+    for title, key in SECTIONS:
+        if key in FIELD_KEYS or not assessment.get(key):
+            continue
+        keywords = set(SECTION_KEYWORDS.get(key, ())) | set(_terms(title))
+        words = _terms(str(assessment[key]))
+        overlap = len(terms & set(words))
+        score = 3 * len(terms & keywords) + overlap / math.sqrt(1 + len(set(words))) * 4
+        if score > 0:
+            scores.append((score, key))
+    ranked = [key for _, key in sorted(scores, key=lambda item: item[0], reverse=True)]
+    return ranked or ([DEFAULT_SECTION] if assessment.get(DEFAULT_SECTION) else [])
+
+
+def question_filters(question: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    The classification label and score a question names, e.g. ("Sanctions", "Low") for
+    "Which other sanctions controls scored low?".
+
+    :param question: The follow-up question.
+    :type question: str
+    :return: The label and the score, each None if the question names none.
+    :rtype: Tuple[Optional[str], Optional[str]]
+    """
+    text = question.lower()
+    label = None
+    for candidate in CLASSIFICATION_LABELS:
+        # Singular or plural, e.g. "duplicate" for "Duplicates" and "travel rule" for "Travel Rules"
+        pattern = r"\b" + r"\s+".join(re.escape(word.rstrip("s")) for word in candidate.lower().split()) + r"s?\b"
+        if re.search(pattern, text):
+            label = candidate
+            text = re.sub(pattern, " ", text)
+            break
+    score = next((value for value in SCORE_VALUES
+                  if re.search(rf"\b{value.lower()}\b", text)), None)
+    return label, score
+
+
+def related_assessments(question: str, store: Optional[AssessmentStore], exclude: Optional[int] = None,
+                        limit: int = RELATED_LIMIT) -> List[Dict[str, Any]]:
+    """
+    Prior assessments of other controls relevant to a question, from the assessment store:
+    the best BM25 matches of the question's words, restricted to the label and score it
+    names (see :func:`question_filters`), topped up with the latest records of that label
+    and score. Only questions that mention other controls (see :data:`RELATED_KEYWORDS`) get any.
+
+    :param question: The follow-up question.
+    :type question: str
+    :param store: The assessment store (see :func:`src.control_store.get_store`), or None.
+    :type store: Optional[AssessmentStore]
+    :param exclude: The record ID of the control under discussion.
+    :type exclude: Optional[int]
+    :param limit: Maximum number of records.
+    :type limit: int
+    :return: Stored records, most relevant first.
+    :rtype: List[Dict[str, Any]]
+    """
+    terms = _terms(question)
+    if store is None or not set(terms) & set(RELATED_KEYWORDS):
+        return []
+    label, score = question_filters(question)
+    words = [term for term in terms if term not in RELATED_KEYWORDS]
+    records = store.search(" ".join(words), label, score, limit, exclude) if words else []
+    if len(records) < limit and (label is not None or score is not None):
+        seen = {record["id"] for record in records}
+        records += [record for record in store.find(label, score, limit + len(records), exclude)
+                    if record["id"] not in seen][:limit - len(records)]
+    return records
+
+
+def _related_text(record: Mapping[str, Any]) -> str:
+    text = (f"- {record['original_input']}\n  Classification: {record.get('control_classification')};"
+            f" Score: {record.get('control_score')}")
+    if record.get("snippet"):
+        text += f"\n  Matching passage: {record['snippet']}"
+    return text
+
+
+def _history(conversation: Sequence[Mapping[str, Any]], memory: ChatMemory) -> List[Mapping[str, Any]]:
+    # The turns not yet summarised, without the question and the combined assessment
+    # message (the assessment is sent by section instead)
+    return [message for message in conversation[memory.summarized:-1] if not message.get("assessment")]
+
+
+def followup_messages(conversation: Sequence[Mapping[str, Any]], assessment: Mapping[str, Any], memory: ChatMemory,
+                      budget: Optional[int] = None,
+                      related: Sequence[Mapping[str, Any]] = ()) -> List[Dict[str, str]]:
+    """
+    The messages of a follow-up request, within the token budget.
+
+    :param conversation: The chat; the first message is the system prompt and the last is the question.
+    :type conversation: Sequence[Mapping[str, Any]]
+    :param assessment: The assessment state: "original_input" and the section results.
+    :type assessment: Mapping[str, Any]
+    :param memory: The compacted history of the chat.
+    :type memory: ChatMemory
+    :param budget: Input tokens (default :func:`token_budget`).
+    :type budget: Optional[int]
+    :param related: Prior assessments of other controls (see :func:`related_assessments`),
+                    sent in the part of the sections' share the sections leave.
+    :type related: Sequence[Mapping[str, Any]]
+    :rtype: List[Dict[str, str]]
+    """
+    budget = token_budget() if budget is None else budget
+    titles = {key: title for title, key in SECTIONS}
+    question = conversation[-1]
+
+    system = conversation[0]["content"]
+    if assessment:
+        fields = "\n".join(f"{titles[key]}: {assessment[key]}" for key in FIELD_KEYS if assessment.get(key))
+        system += f"\n\nControl under assessment:\n{assessment.get('original_input', '')}\n\n{fields}"
+    head = [{"role": "system", "content": system}]
+    if memory.summary:
+        head.append({"role": "system", "content": f"Summary of the earlier conversation:\n{memory.summary}"})
+    tail = [{"role": question["role"], "content": question["content"]}]
+    remaining = budget - sum(_message_tokens(message) for message in head + tail)
+
+    # The most relevant sections that fit their share of the budget
+    sections = []
+    section_budget = int(max(0, remaining) * SECTION_SHARE)
+    for key in rank_sections(question["content"], assessment or {}):
+        text = f"## {titles[key]}\n{assessment[key]}"
+        tokens = count_tokens(text) + 1
+        if tokens <= section_budget:
+            sections.append(text)
+            section_budget -= tokens
+    if sections:
+        head.append({"role": "system", "content": "Relevant sections of the assessment:\n\n" + "\n\n".join(sections)})
+        remaining -= _message_tokens(head[-1])
+    others = []
+    for record in related:
+        text = _related_text(record)
+        tokens = count_tokens(text) + 1
+        if tokens <= section_budget:
+            others.append(text)
+            section_budget -= tokens
+    if others:
+        head.append({"role": "system", "content": "Prior assessments of other controls:\n" + "\n".join(others)})
+        remaining -= _message_tokens(head[-1])
+
+    # The most recent turns that fit the rest
+    recent: List[Dict[str, str]] = []
+    for message in reversed(_history(conversation, memory)):
+        tokens = _message_tokens(message)
+        if tokens > remaining:
+            break
+        recent.insert(0, {"role": message["role"], "content": message["content"]})
+        remaining -= tokens
+    return head + recent + tail
+
+
+def stream_followup(conversation: Sequence[Mapping[str, Any]], assessment: Mapping[str, Any], memory: ChatMemory,
+                    api_key: str, related: Sequence[Mapping[str, Any]] = ()) -> Iterator[Any]:
+    """
+    Stream the answer to the last question of the chat, built by :func:`followup_messages`.
+    The call is admitted and retried by the rate-limit scheduler (see :mod:`src.control_ratelimit`).
+
+    :param conversation: The chat, ending with the question.
+    :type conversation: Sequence[Mapping[str, Any]]
+    :param assessment: The assessment state.
+    :type assessment: Mapping[str, Any]
+    :param memory: The compacted history of the chat.
+    :type memory: ChatMemory
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param related: Prior assessments of other controls (see :func:`related_assessments`).
+    :type related: Sequence[Mapping[str, Any]]
+    :return: The chat completion chunks, e.g. for ``st.write_stream``.
+    :rtype: Iterator[Any]
+    """
+    client = get_openai_client(api_key)
+    messages = followup_messages(conversation, assessment, memory, related=related)
+    return get_scheduler().stream(
+        lambda: client.chat.completions.create(model=FOLLOWUP_MODEL, messages=messages, stream=True),
+        model=FOLLOWUP_MODEL, tokens=sum(_message_tokens(message) for message in messages) + output_estimate({}),
+    )
+
+
+def compact_history(conversation: Sequence[Mapping[str, Any]], memory: ChatMemory, api_key: str,
+                    budget: Optional[int] = None) -> bool:
+    """
+    Fold the turns that no longer fit the recent window (the share of the budget not kept
+    for sections) into the rolling summary. Call it after an answer has been shown.
+
+    :param conversation: The chat, ending with the latest answer.
+    :type conversation: Sequence[Mapping[str, Any]]
+    :param memory: The compacted history, updated in place.
+    :type memory: ChatMemory
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param budget: Input tokens of a follow-up request (default :func:`token_budget`).
+    :type budget: Optional[int]
+    :return: Whether turns were summarised.
+    :rtype: bool
+    """
+    budget = token_budget() if budget is None else budget
+    window = int(budget * (1 - SECTION_SHARE)) // 2
+    kept, end = 0, len(conversation)
+    for index in range(len(conversation) - 1, memory.summarized - 1, -1):
+        if conversation[index].get("assessment"):
+            continue
+        kept += _message_tokens(conversation[index])
+        if kept > window:
+            break
+        end = index
+    # Summarise whole exchanges: the window starts with a question
+    while end < len(conversation) and conversation[end]["role"] != "user":
+        end += 1
+    turns = [message for message in conversation[memory.summarized:end] if not message.get("assessment")]
+    if not turns:
+        memory.summarized = max(memory.summarized, end)
+        return False
+
+    client = get_openai_client(api_key)
+    limit = int(os.environ.get("CONTROL_CHAT_SUMMARY_TOKENS", 400))
+    transcript = "\n\n".join(f"{message['role']}: {message['content']}" for message in turns)
+    messages = [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=int(limit * 0.75))},
+        {"role": "user", "content": f"Summary so far:\n{memory.summary or '(none)'}\n\nNew turns:\n{transcript}"},
+    ]
+    response = get_scheduler().call(
+        lambda: client.chat.completions.create(model=FOLLOWUP_MODEL, messages=messages, max_completion_tokens=limit),
+        model=FOLLOWUP_MODEL, tokens=sum(_message_tokens(message) for message in messages) + limit,
+    )
+    memory.summary = (response.choices[0].message.content or memory.summary).strip()
+    memory.summarized = end
+    return True
@@ -0,0 +1,323 @@
+"""
+Incremental re-assessment: re-run only the stages a change affects.
+
+Every assessment saved to the assessment store (:mod:`src.control_store`) carries the
+fingerprint of each of its stage runs, a hash of the stage's prompt, model settings and
+output contract and of the input values it consumed (see
+:func:`src.control_pipeline.stage_fingerprint`). Re-assessment runs the stage graph as
+usual, but a stage whose fingerprint matches the stored one takes its stored outputs
+instead of calling the model. When a re-run stage answers differently, the fingerprints
+of the stages consuming its output change too (score_reasoning consumes control_score),
+so exactly the affected downstream stages run again.
+
+After editing one stage's prompt, e.g. the rubric of the score stage, re-assessing an
+inventory of N controls makes about N stage calls instead of 8N, plus the downstream
+stages whose inputs changed. Every stage consumes the control description, so a revised
+description re-runs all its stages; whitespace-only changes do not count.
+
+``plan`` estimates the stage runs without calling the model: the stages whose
+fingerprints changed, and the stages downstream of them that may have to run.
+
+Usage::
+
+    python -m src.control_incremental plan
+    python -m src.control_incremental run --concurrency 4 --label Sanctions
+    python -m src.control_incremental run --input controls.xlsx --column "Control Description" -o reassessed.xlsx
+"""
+import argparse
+import asyncio
+import dataclasses
+import logging
+import os
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set
+from tabulate import tabulate
+from tqdm import tqdm
+from src.control_batch import ResultWriter, read_controls
+from src.control_pipeline import Stage, arun_pipeline, pipeline_stages, stage_fingerprint
+from src.control_store import AssessmentStore, get_store
+
+logger = logging.getLogger(__name__)
+
+
+def _reusable(stage: Stage, previous: Mapping[str, Any], state: Mapping[str, Any]) -> bool:
+    # The stored outputs still answer the stage: same fingerprint, and all of them present
+    fingerprint = (previous.get("fingerprints") or {}).get(stage.name)
+    return (fingerprint is not None and fingerprint == stage_fingerprint(stage, state)
+            and all(previous.get(key) is not None for key in stage.outputs))
+
+
+def incremental_stages(stages: Sequence[Stage], previous: Mapping[str, Any], tally: Counter) -> List[Stage]:
+    """
+    The stages, each taking its outputs from the previous assessment of the control
+    instead of running when its fingerprint is unchanged.
+
+    :param stages: The stages to run.
+    :type stages: Sequence[Stage]
+    :param previous: The stored record of the control (see :meth:`AssessmentStore.get`),
+                     or ``{}`` to run every stage.
+    :type previous: Mapping[str, Any]
+    :param tally: Counts ``("run", stage)`` and ``("skipped", stage)``; each control's
+                  lists of run and skipped stages are also kept in ``state["incremental"]``.
+    :type tally: Counter
+    :return: The wrapped stages; they do not stream.
+    :rtype: List[Stage]
+    """
+    def wrap(stage: Stage) -> Stage:
+        def skip(state: Dict[str, Any]) -> bool:
+            outcome = "skipped" if _reusable(stage, previous, state) else "run"
+            tally[outcome, stage.name] += 1
+            state.setdefault("incremental", {"run": [], "skipped": []})[outcome].append(stage.name)
+            if outcome == "skipped":
+                state.update({key: previous[key] for key in stage.outputs})
+                # Carry the stage's provenance forward, so the saved record keeps it for the next plan
+                for field in ("prompt_versions", "fingerprints"):
+                    if stage.name in (previous.get(field) or {}):
+                        state.setdefault(field, {})[stage.name] = previous[field][stage.name]
+            return outcome == "skipped"
+
+        def run(state: Dict[str, Any]) -> Dict[str, Any]:
+            return state if skip(state) else stage.run(state)
+
+        async def arun(state: Dict[str, Any]) -> Dict[str, Any]:
+            return state if skip(state) else await stage.arun(state)
+
+        return dataclasses.replace(stage, run=run, arun=arun, astream=None)
+
+    return [wrap(stage) for stage in stages]
+
+
+def _downstream(stages: Sequence[Stage], changed: Set[str]) -> Set[str]:
+    # Stages consuming, directly or not, an output of a changed stage
+    outputs = {key for stage in stages if stage.name in changed for key in stage.outputs}
+    found: Set[str] = set()
+    grew = True
+    while grew:
+        grew = False
+        for stage in stages:
+            if stage.name not in changed | found and outputs & set(stage.inputs):
+                found.add(stage.name)
+                outputs.update(stage.outputs)
+                grew = True
+    return found
+
+
+def plan(records: Iterable[Mapping[str, Any]], stages: Optional[Sequence[Stage]] = None) -> Dict[str, Any]:
+    """
+    Estimate a re-assessment without calling the model: fingerprints are computed against
+    the stored inputs of each control.
+
+    :param records: Stored records (see :meth:`AssessmentStore.records`).
+    :type records: Iterable[Mapping[str, Any]]
+    :param stages: The stages, defaulting to :func:`src.control_pipeline.pipeline_stages`.
+    :type stages: Optional[Sequence[Stage]]
+    :return: "controls", "stage_runs" (of a full re-assessment), "changed" (stage -> controls
+             whose fingerprint changed), "downstream" (stage -> controls where it runs again
+             if the changed stages answer differently) and "skipped" (stage runs that are
+             skipped at least).
+    :rtype: Dict[str, Any]
+    """
+    stages = list(stages or pipeline_stages())
+    changed: Counter = Counter()
+    downstream: Counter = Counter()
+    controls = 0
+    for record in records:
+        controls += 1
+        stale = {stage.name for stage in stages if not _reusable(stage, record, record)}
+        changed.update(stale)
+        downstream.update(_downstream(stages, stale))
+    runs = controls * len(stages)
+    return {"controls": controls, "stage_runs": runs, "changed": dict(changed), "downstream": dict(downstream),
+            "skipped": runs - sum(changed.values()) - sum(downstream.values())}
+
+
+async def reassess(records: Iterable[Mapping[str, Any]], api_key: str, concurrency: int,
+                   on_result: Callable[[Mapping[str, Any], Dict[str, Any]], None],
+                   on_error: Optional[Callable[[Mapping[str, Any], BaseException], None]] = None,
+                   stages: Optional[Sequence[Stage]] = None, tally: Optional[Counter] = None) -> Counter:
+    """
+    Re-assess controls, running only the stages whose fingerprints changed (see the module
+    docstring), with at most ``concurrency`` controls in flight.
+
+    :param records: Previous records of the controls, or ``{"original_input": ...}`` for
+                    controls assessed for the first time.
+    :type records: Iterable[Mapping[str, Any]]
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param concurrency: Maximum number of controls re-assessed at the same time.
+    :type concurrency: int
+    :param on_result: Called with ``(record, state)`` for every re-assessed control.
+    :type on_result: Callable[[Mapping[str, Any], Dict[str, Any]], None]
+    :param on_error: Called with ``(record, error)`` for every failed control; errors are
+                     raised if it is None.
+    :type on_error: Optional[Callable[[Mapping[str, Any], BaseException], None]]
+    :param stages: The stages, defaulting to :func:`src.control_pipeline.pipeline_stages`.
+    :type stages: Optional[Sequence[Stage]]
+    :param tally: Counter to add the run and skipped stages to (see :func:`incremental_stages`).
+    :type tally: Optional[Counter]
+    :return: The tally.
+    :rtype: Counter
+    """
+    stages = list(stages or pipeline_stages())
+    tally = Counter() if tally is None else tally
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(record: Mapping[str, Any]) -> None:
+        try:
+            # Re-assessment yields to interactive calls at the rate-limit scheduler
+            state = {"openai_api_key": api_key, "original_input": record["original_input"], "priority": "batch"}
+            async for _ in arun_pipeline(state, incremental_stages(stages, record, tally)):
+                pass
+            on_result(record, state)
+        except Exception as error:
+            if on_error is None:
+                raise
+            on_error(record, error)
+        finally:
+            semaphore.release()
+
+    tasks = set()
+    for record in records:
+        await semaphore.acquire()
+        task = asyncio.ensure_future(run(record))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    return tally
+
+
+def stored_records(store: AssessmentStore, input_path: Optional[str] = None, column: Optional[str] = None,
+                   label: Optional[str] = None, score: Optional[str] = None,
+                   limit: Optional[int] = None) -> Iterator[Mapping[str, Any]]:
+    """
+    The previous records of the controls to re-assess (see :func:`run_reassessment`).
+
+    :rtype: Iterator[Mapping[str, Any]]
+    """
+    if input_path:
+        records: Iterable[Mapping[str, Any]] = (store.lookup(text) or {"original_input": text}
+                                                for _, text in read_controls(input_path, column))
+    else:
+        records = store.records(label, score)
+    return (record for number, record in enumerate(records) if limit is None or number < limit)
+
+
+def run_reassessment(api_key: str, store: AssessmentStore, input_path: Optional[str] = None,
+                     column: Optional[str] = None, label: Optional[str] = None, score: Optional[str] = None,
+                     limit: Optional[int] = None, concurrency: int = 4,
+                     output_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Re-assess the controls of the store, or of an inventory file, and save the results to
+    the store.
+
+    :param api_key: The OpenAI API key.
+    :type api_key: str
+    :param store: The assessment store holding the previous assessments.
+    :type store: AssessmentStore
+    :param input_path: A .csv or .xlsx inventory; its descriptions are looked up in the
+                       store, and those never assessed run every stage. Defaults to all
+                       stored records.
+    :type input_path: Optional[str]
+    :param column: Header of the control description column of the inventory.
+    :type column: Optional[str]
+    :param label: Only stored records with this classification label.
+    :type label: Optional[str]
+    :param score: Only stored records with this score.
+    :type score: Optional[str]
+    :param limit: Maximum number of controls.
+    :type limit: Optional[int]
+    :param concurrency: Maximum number of controls re-assessed at the same time.
+    :type concurrency: int
+    :param output_path: An .xlsx workbook to write the results to.
+    :type output_path: Optional[str]
+    :return: "controls", "failed", "stage_runs", "run", "skipped" (stage runs), "by_stage"
+             (stage -> run and skipped counts), "calls" and "cache_hits" (model calls made
+             and answered by the response cache) and "elapsed_seconds".
+    :rtype: Dict[str, Any]
+    """
+    records = stored_records(store, input_path, column, label, score, limit)
+    writer = ResultWriter(output_path) if output_path else None
+    progress = tqdm(desc="Controls", unit="control")
+    stats = {"controls": 0, "failed": 0, "calls": 0, "cache_hits": 0}
+
+    def on_result(record: Mapping[str, Any], state: Dict[str, Any]) -> None:
+        store.save(state, "reassessment")
+        if writer is not None:
+            writer.write(str(record.get("id") or stats["controls"] + 1), state, checkpoint=False)
+        stats["controls"] += 1
+        for metrics in state.get("metrics", {}).values():
+            stats["calls"] += metrics["calls"] - metrics["cache_hits"]
+            stats["cache_hits"] += metrics["cache_hits"]
+        progress.update()
+
+    def on_error(record: Mapping[str, Any], error: BaseException) -> None:
+        logger.error("Re-assessing %r failed: %s", record["original_input"][:60], error)
+        stats["failed"] += 1
+        progress.update()
+
+    started = time.perf_counter()
+    try:
+        tally = asyncio.run(reassess(records, api_key, concurrency, on_result, on_error))
+    finally:
+        progress.close()
+        if writer is not None:
+            writer.close()
+
+    by_stage: Dict[str, Dict[str, int]] = {}
+    for (outcome, stage), count in tally.items():
+        by_stage.setdefault(stage, {"run": 0, "skipped": 0})[outcome] += count
+    stats["run"] = sum(count for (outcome, _), count in tally.items() if outcome == "run")
+    stats["skipped"] = sum(count for (outcome, _), count in tally.items() if outcome == "skipped")
+    stats["stage_runs"] = stats["run"] + stats["skipped"]
+    stats["by_stage"] = by_stage
+    stats["elapsed_seconds"] = time.perf_counter() - started
+    return stats
+
+
+def main(argv: Optional[Iterable[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Re-assess stored controls, re-running only the changed stages.")
+    parser.add_argument("command", choices=("plan", "run"))
+    parser.add_argument("--input", help="CSV or XLSX inventory to re-assess (default: all stored records)")
+    parser.add_argument("--column", help="header of the control description column (default: first column)")
+    parser.add_argument("--label", help="only stored records with this classification label")
+    parser.add_argument("--score", help="only stored records with this score")
+    parser.add_argument("--limit", type=int, help="maximum number of controls")
+    parser.add_argument("--concurrency", type=int, default=4, help="controls re-assessed at the same time")
+    parser.add_argument("-o", "--output", help="also write the results to this workbook")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"), help="defaults to $OPENAI_API_KEY")
+    args = parser.parse_args(argv)
+
+    store = get_store()
+    if store is None:
+        parser.error("the assessment store is disabled (CONTROL_STORE_DISABLED)")
+    if args.command == "plan":
+        estimate = plan(stored_records(store, args.input, args.column, args.label, args.score, args.limit))
+        print(tabulate([[stage.name, estimate["changed"].get(stage.name, 0), estimate["downstream"].get(stage.name, 0)]
+                        for stage in pipeline_stages()], headers=["stage", "changed", "downstream"]))
+        print(f"{estimate['controls']} controls: at least {estimate['skipped']} of {estimate['stage_runs']}"
+              f" stage runs skipped")
+        return
+    if not args.api_key:
+        parser.error("an OpenAI API key is required (--api-key or $OPENAI_API_KEY)")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    stats = run_reassessment(args.api_key, store, args.input, args.column, args.label, args.score, args.limit,
+                             max(1, args.concurrency), args.output)
+    print(tabulate([[stage, counts["run"], counts["skipped"]] for stage, counts in stats["by_stage"].items()],
+                   headers=["stage", "run", "skipped"]))
+    share = 100 * stats["skipped"] / stats["stage_runs"] if stats["stage_runs"] else 0.0
+    logger.info("Re-assessed %d controls (%d failed) in %.1fs: %d of %d stage runs skipped (%.0f%%), "
+                "%d model calls, %d cache hits", stats["controls"], stats["failed"], stats["elapsed_seconds"],
+                stats["skipped"], stats["stage_runs"], share, stats["calls"], stats["cache_hits"])
+    # The saved records must now match the stages: a second plan finds nothing to run
+    remaining = plan(stored_records(store, args.input, args.column, args.label, args.score, args.limit))
+    stale = sum(remaining["changed"].values())
+    if stale:
+        logger.warning("%d stage runs of %d controls still differ from the stored records",
+                       stale, remaining["controls"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,62 @@
 import warnings
 import os
 from typing import List
-from langchain import hub
-from typing import Any, List, Dict
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from typing import Any, AsyncIterator, Dict, Iterator, List
+from src.control_prompts import stage_prompt
+from src.control_contracts import OutputContract
+from src.control_llm import run_chain, arun_chain, stream_stage, astream_stage
 
 
-def industry_practices(state: Dict[str, Any]) -> Dict[str, Any]:
-    industry_practices_prompt = '''
+INDUSTRY_PRACTICES_PROMPT = stage_prompt('''
     # Instructions
-    - What are the main industry best practices for this control?  \n
-    - Provide answer in 3-6 succinct and detailed bullet points. \n
-    - Provide examples where these practices are used. \n
+    - What are the main industry best practices for this control?
+    - Provide answer in 3-6 succinct and detailed bullet points.
+    - Provide examples where these practices are used.
+    ''')
+
+INDUSTRY_PRACTICES_LLM = {"model": "o3-mini", "reasoning_effort": "high"}
 
-    # Context
-    - This it analyze the controls placed on a banking payment system
+# Answer shape and output budget (including reasoning tokens), see src/control_contracts.py
+INDUSTRY_PRACTICES_CONTRACT = OutputContract(max_tokens=5000, bullets=(3, 6))
 
-    # Control
-    {control}
-    '''
 
-    # Create a chat prompt template using the detailed prompt
-    prompt = ChatPromptTemplate(["system", industry_practices_prompt])
+def industry_practices(state: Dict[str, Any]) -> Dict[str, Any]:
+    generation = run_chain("industry_practices", INDUSTRY_PRACTICES_PROMPT,
+                           {"control": state["original_input"]},
+                           state, INDUSTRY_PRACTICES_LLM, contract=INDUSTRY_PRACTICES_CONTRACT)
+    state["control_industry_practices"] = generation
 
-    # Initialize OpenAI Language Model
-    llm = ChatOpenAI(model="o3-mini", reasoning_effort="high", api_key=state["openai_api_key"])
+    return state
 
-    # Combine the prompt, the language model, and the output parser into a processing chain.
-    rag_chain = prompt | llm | StrOutputParser()
 
-    generation = rag_chain.invoke({"control": state["original_input"]})
+async def aindustry_practices(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of :func:`industry_practices` built on ``ainvoke``.
+    """
+    generation = await arun_chain("industry_practices", INDUSTRY_PRACTICES_PROMPT,
+                                  {"control": state["original_input"]},
+                                  state, INDUSTRY_PRACTICES_LLM, contract=INDUSTRY_PRACTICES_CONTRACT)
     state["control_industry_practices"] = generation
 
-    return state
\ No newline at end of file
+    return state
+
+
+def stream_industry_practices(state: Dict[str, Any]) -> Iterator[str]:
+    """
+    Streaming variant of :func:`industry_practices`: yields the text as it is generated and stores the
+    full text under "control_industry_practices" once done.
+    """
+    yield from stream_stage("industry_practices", INDUSTRY_PRACTICES_PROMPT,
+                            {"control": state["original_input"]},
+                            state, INDUSTRY_PRACTICES_LLM, INDUSTRY_PRACTICES_CONTRACT, "control_industry_practices")
+
+
+async def astream_industry_practices(state: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Async variant of :func:`stream_industry_practices` built on ``astream``.
+    """
+    async for chunk in astream_stage("industry_practices", INDUSTRY_PRACTICES_PROMPT,
+                                     {"control": state["original_input"]},
+                                     state, INDUSTRY_PRACTICES_LLM, INDUSTRY_PRACTICES_CONTRACT,
+                                     "control_industry_practices"):
+        yield chunk
@@ -0,0 +1,606 @@
+"""
+Background assessment jobs: a SQLite job queue and a pool of worker processes.
+
+The apps submit an assessment as a job instead of running the pipeline in the Streamlit
+script thread, then follow its progress from the queue. Workers run the stage pipeline
+and write its progress as events: streamed text chunks and completed stages with their
+outputs. A job outlives the browser session that submitted it, so a page that is
+refreshed reattaches by job ID and replays the events so far. Workers scale independently
+of the UI sessions, across processes and hosts sharing the queue file.
+
+A worker claims queued jobs (interactive before batch, oldest first) up to its
+concurrency and heartbeats them. The pool supervisor requeues the jobs of a worker that
+stopped heartbeating and restarts dead workers. Workers read the OpenAI API key from
+``OPENAI_API_KEY``; keys are never stored in the queue.
+
+Configuration (environment variables):
+
+- ``CONTROL_JOBS_PATH``: SQLite file (default ``.cache/control_jobs.sqlite``)
+- ``CONTROL_JOBS_ENABLED``: set to ``1`` for the apps to submit jobs instead of running the
+  pipeline in the script run
+- ``CONTROL_JOBS_STALE_SECONDS``: heartbeat age after which a running job is requeued (default 60)
+- ``CONTROL_JOBS_MAX_ATTEMPTS``: runs of a job before it is failed (default 3)
+
+Usage::
+
+    python -m src.control_jobs worker --processes 4 --concurrency 4
+    python -m src.control_jobs submit "Wires above $20m need a second approver"
+    python -m src.control_jobs follow <job id>
+    python -m src.control_jobs list
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from tabulate import tabulate
+from src.control_cancellation import CancelToken, Cancelled
+from src.control_pipeline import (SCORE_WITH_REASONING_STAGE, SECTIONS_STAGE, STAGES, Stage, StageEvent,
+                                  astream_pipeline)
+from src.control_store import get_store
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ("queued", "running", "completed", "failed", "cancelled")
+FINISHED = ("completed", "failed", "cancelled")
+
+# Every stage a job may report, by name
+STAGES_BY_NAME: Dict[str, Stage] = {stage.name: stage for stage in STAGES + (SECTIONS_STAGE, SCORE_WITH_REASONING_STAGE)}
+
+# Yielded by follow_job when the job was requeued and starts over (it has no stage)
+RESTARTED = StageEvent(None, None)
+
+# Seconds between writes of streamed chunks, between heartbeats and between polls
+FLUSH_INTERVAL = 0.2
+HEARTBEAT_INTERVAL = 10.0
+POLL_INTERVAL = 0.2
+
+# State keys never written to the queue
+PRIVATE_KEYS = ("openai_api_key", "callbacks", "cancel_token")
+
+
+class Job(NamedTuple):
+    """
+    A claimed job. Its worker and attempt identify the run: a job requeued after its worker
+    stopped heartbeating belongs to the next one.
+    """
+    id: str
+    original_input: str
+    options: Dict[str, Any]
+    worker: str
+    attempt: int
+
+
+class JobFailed(RuntimeError):
+    """
+    The followed job failed or was cancelled.
+    """
+
+
+class _Disowned(Exception):
+    """
+    The job was requeued while this run streamed it.
+    """
+
+
+class JobQueue:
+    """
+    SQLite-backed job queue shared by the apps and the workers of a host.
+
+    Safe to share between threads; each thread uses its own connection.
+    """
+
+    def __init__(self, path: str, stale_seconds: float = 60.0, max_attempts: int = 3):
+        self.path = path
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL,"
+                " original_input TEXT NOT NULL, options TEXT NOT NULL, result TEXT, error TEXT,"
+                " worker TEXT, attempts INTEGER NOT NULL DEFAULT 0, cancel_requested INTEGER NOT NULL DEFAULT 0,"
+                " created REAL NOT NULL, started REAL, finished REAL, heartbeat REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, kind TEXT NOT NULL,"
+                " name TEXT NOT NULL, data TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS events_job ON events (job_id, seq)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def submit(self, original_input: str, options: Optional[Dict[str, Any]] = None, priority: str = "interactive") -> str:
+        """
+        Queue an assessment.
+
+        :param original_input: The control description.
+        :type original_input: str
+        :param options: Extra initial state, e.g. ``{"use_cache": False}``.
+        :type options: Optional[Dict[str, Any]]
+        :param priority: "interactive" or "batch"; interactive jobs are claimed first.
+        :type priority: str
+        :return: The job ID.
+        :rtype: str
+        """
+        job_id = uuid.uuid4().hex
+        options = {key: value for key, value in (options or {}).items() if key not in PRIVATE_KEYS}
+        options["priority"] = priority
+        self._connection().execute(
+            "INSERT INTO jobs (id, status, priority, original_input, options, created) VALUES (?, 'queued', ?, ?, ?, ?)",
+            (job_id, int(priority != "interactive"), original_input, json.dumps(options), time.time()),
+        )
+        return job_id
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """
+        Take the next queued job for ``worker``.
+
+        :rtype: Optional[Job]
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, original_input, options, attempts FROM jobs WHERE status = 'queued'"
+                " ORDER BY priority, created LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1,"
+                    " started = ?, heartbeat = ? WHERE id = ?", (worker, now, now, row[0]))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return Job(row[0], row[1], json.loads(row[2]), worker, row[3] + 1)
+
+    def _owned(self, connection: sqlite3.Connection, job: Job) -> bool:
+        # Whether the run of ``job`` still owns it
+        return connection.execute(
+            "SELECT 1 FROM jobs WHERE id = ? AND status = 'running' AND worker = ? AND attempts = ?",
+            (job.id, job.worker, job.attempt)).fetchone() is not None
+
+    def append_events(self, job_id: str, events: List[Tuple[str, str, Any]], owner: Optional[Job] = None) -> bool:
+        """
+        Record progress of a job: ``(kind, name, data)`` with kind "token" (name: stage,
+        data: text chunk), "stage" (name: stage, data: its outputs) or "status" (name: the
+        new status, data: the error, if any). With ``owner``, only while that run still
+        owns the job.
+
+        :return: False if ``owner`` no longer owns the job and nothing was recorded.
+        :rtype: bool
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE" if owner is not None else "BEGIN")
+        try:
+            if owner is not None and not self._owned(connection, owner):
+                connection.execute("ROLLBACK")
+                return False
+            connection.executemany("INSERT INTO events (job_id, kind, name, data, created) VALUES (?, ?, ?, ?, ?)",
+                                   [(job_id, kind, name, json.dumps(data, default=str), now)
+                                    for kind, name, data in events])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return True
+
+    def events(self, job_id: str, after: int = 0) -> List[Tuple[int, str, str, Any]]:
+        """
+        The events of a job after sequence number ``after``: ``(seq, kind, name, data)``.
+
+        :rtype: List[Tuple[int, str, str, Any]]
+        """
+        rows = self._connection().execute(
+            "SELECT seq, kind, name, data FROM events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after)
+        ).fetchall()
+        return [(seq, kind, name, json.loads(data)) for seq, kind, name, data in rows]
+
+    def heartbeat(self, worker: str) -> None:
+        """
+        Mark the running jobs of ``worker`` as alive.
+        """
+        self._connection().execute("UPDATE jobs SET heartbeat = ? WHERE worker = ? AND status = 'running'",
+                                   (time.time(), worker))
+
+    def cancel_requested(self, job_id: str) -> bool:
+        """
+        Whether :meth:`cancel` was called for the job.
+
+        :rtype: bool
+        """
+        row = self._connection().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def finish(self, job: Job, status: str, result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None) -> bool:
+        """
+        Close a running job as "completed" (with its result state), "failed" or "cancelled",
+        unless its run no longer owns it: a job requeued in the meantime keeps running on
+        its next worker.
+
+        :return: Whether the job was closed.
+        :rtype: bool
+        """
+        if not self._connection().execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?"
+                " WHERE id = ? AND status = 'running' AND worker = ? AND attempts = ?",
+                (status, json.dumps(result, default=str) if result is not None else None, error, time.time(),
+                 job.id, job.worker, job.attempt)).rowcount:
+            return False
+        self.append_events(job.id, [("status", status, error)])
+        return True
+
+    def cancel(self, job_id: str) -> None:
+        """
+        Cancel a job: a queued job at once, a running one at its worker's next check.
+        """
+        connection = self._connection()
+        connection.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+        if connection.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'",
+                              (time.time(), job_id)).rowcount:
+            self.append_events(job_id, [("status", "cancelled", None)])
+
+    def requeue_stale(self) -> int:
+        """
+        Requeue running jobs whose worker stopped heartbeating, or fail them after
+        ``max_attempts`` runs.
+
+        :return: The number of jobs requeued or failed.
+        :rtype: int
+        """
+        connection = self._connection()
+        cutoff = time.time() - self.stale_seconds
+        stale = connection.execute("SELECT id, attempts FROM jobs WHERE status = 'running' AND heartbeat < ?",
+                                   (cutoff,)).fetchall()
+        changed = 0
+        for job_id, attempts in stale:
+            # Guarded, so a job its worker finished in the meantime keeps its outcome
+            if attempts >= self.max_attempts:
+                if connection.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, finished = ?"
+                        " WHERE id = ? AND status = 'running' AND heartbeat < ?",
+                        ("The worker running the job stopped", time.time(), job_id, cutoff)).rowcount:
+                    self.append_events(job_id, [("status", "failed", "The worker running the job stopped")])
+                    changed += 1
+            elif connection.execute(
+                    "UPDATE jobs SET status = 'queued', worker = NULL"
+                    " WHERE id = ? AND status = 'running' AND heartbeat < ?", (job_id, cutoff)).rowcount:
+                self.append_events(job_id, [("status", "queued", None)])
+                changed += 1
+        return changed
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        A job's row: "id", "status", "original_input", "options", "result", "error",
+        "worker", "attempts" and the "created", "started" and "finished" times.
+
+        :rtype: Optional[Dict[str, Any]]
+        """
+        cursor = self._connection().execute(
+            "SELECT id, status, original_input, options, result, error, worker, attempts, created, started, finished"
+            " FROM jobs WHERE id = ?", (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        job = dict(zip([column[0] for column in cursor.description], row))
+        job["options"] = json.loads(job["options"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def jobs(self, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        The most recent jobs, optionally of one status.
+
+        :rtype: List[Dict[str, Any]]
+        """
+        query = "SELECT id, status, worker, attempts, created, started, finished, substr(original_input, 1, 60)" \
+                " AS control FROM jobs"
+        cursor = self._connection().execute(
+            query + (" WHERE status = ?" if status else "") + " ORDER BY created DESC LIMIT ?",
+            (status, limit) if status else (limit,))
+        return [dict(zip([column[0] for column in cursor.description], row)) for row in cursor.fetchall()]
+
+
+def follow_job(queue: JobQueue, job_id: str, state: Dict[str, Any], poll: float = POLL_INTERVAL,
+               on_idle: Optional[Callable[[], None]] = None) -> Iterator[StageEvent]:
+    """
+    Follow a job from its first event, like :func:`src.control_pipeline.iter_pipeline_stream`
+    follows a pipeline run: yields the streamed chunks and completed stages, writing the
+    outputs of each completed stage into ``state``. Once the job has completed, its whole
+    result (including "metrics") is merged into ``state``.
+
+    A job requeued after its worker stopped streams its stages again from the start. The
+    follower then yields :data:`RESTARTED` and removes the outputs received so far from
+    ``state``: discard the text shown for every stage, or it would appear twice.
+
+    :param queue: The job queue.
+    :type queue: JobQueue
+    :param job_id: The job to follow.
+    :type job_id: str
+    :param state: Receives the outputs of the job.
+    :type state: Dict[str, Any]
+    :param poll: Seconds between polls of the queue.
+    :type poll: float
+    :param on_idle: Called after each poll without new events, e.g. to let Streamlit interrupt the script run.
+    :type on_idle: Optional[Callable[[], None]]
+    :return: An iterator over token and completion events, and :data:`RESTARTED`.
+    :rtype: Iterator[StageEvent]
+    :raises KeyError: If there is no such job.
+    :raises JobFailed: If the job failed or was cancelled.
+    """
+    job = queue.get(job_id)
+    if job is None:
+        raise KeyError(job_id)
+    state.setdefault("original_input", job["original_input"])
+    after = 0
+    received: List[str] = []
+    while True:
+        events = queue.events(job_id, after)
+        for after, kind, name, data in events:
+            if kind == "token" or kind == "stage":
+                received.append(name)
+            if kind == "token":
+                yield StageEvent(STAGES_BY_NAME[name], data)
+            elif kind == "stage":
+                state.update(data)
+                yield StageEvent(STAGES_BY_NAME[name], None)
+            elif kind == "status" and name == "queued":
+                # Requeued: the next worker runs every stage again
+                if received:
+                    for key in {key for stage in set(received) for key in STAGES_BY_NAME[stage].outputs}:
+                        state.pop(key, None)
+                    received.clear()
+                    yield RESTARTED
+            elif kind == "status" and name == "completed":
+                state.update(queue.get(job_id)["result"] or {})
+                return
+            elif kind == "status" and name in FINISHED:
+                raise JobFailed(f"Job {job_id} {name}" + (f": {data}" if data else ""))
+        if not events:
+            time.sleep(poll)
+            if on_idle is not None:
+                on_idle()
+
+
+async def _run_job(queue: JobQueue, job: Job, api_key: str, token: CancelToken) -> None:
+    state = {**job.options, "openai_api_key": api_key, "original_input": job.original_input, "job_id": job.id,
+             "cancel_token": token}
+    pending: List[Tuple[str, str, Any]] = []
+    flushed = time.monotonic()
+
+    async def flush() -> None:
+        # Adjacent chunks of the same section are written as one event
+        merged: List[Tuple[str, str, Any]] = []
+        for kind, name, data in pending:
+            if merged and kind == "token" and merged[-1][:2] == (kind, name):
+                merged[-1] = (kind, name, merged[-1][2] + data)
+            else:
+                merged.append((kind, name, data))
+        pending.clear()
+        if merged and not await asyncio.to_thread(queue.append_events, job.id, merged, job):
+            raise _Disowned()
+
+    events = astream_pipeline(state)
+    try:
+        async for event in events:
+            if event.token is not None:
+                pending.append(("token", event.stage.name, event.token))
+            else:
+                pending.append(("stage", event.stage.name, {key: state.get(key) for key in event.stage.outputs}))
+            if event.token is None or time.monotonic() - flushed >= FLUSH_INTERVAL:
+                await flush()
+                flushed = time.monotonic()
+                if await asyncio.to_thread(queue.cancel_requested, job.id):
+                    token.cancel("job cancelled")
+        await flush()
+    except _Disowned:
+        # Requeued after this worker missed its heartbeats; the next run streams the job again
+        logger.warning("Job %s was requeued; stopping this run", job.id)
+        await events.aclose()
+        return
+    except Cancelled:
+        # Cancelled through the queue (see JobQueue.cancel)
+        await asyncio.to_thread(queue.finish, job, "cancelled")
+        return
+    except Exception as error:
+        logger.exception("Job %s failed", job.id)
+        await asyncio.to_thread(queue.finish, job, "failed", None, f"{type(error).__name__}: {error}")
+        return
+    result = {key: value for key, value in state.items() if key not in PRIVATE_KEYS}
+    store = get_store()
+    if store is not None:
+        # Kept for follow-up questions and searches even if nobody follows the job (see src/control_store.py)
+        await asyncio.to_thread(store.save, result, "job")
+    await asyncio.to_thread(queue.finish, job, "completed", result)
+
+
+async def work(queue: JobQueue, concurrency: int = 4, worker: Optional[str] = None,
+               stop: Optional[threading.Event] = None) -> None:
+    """
+    Run queued jobs, up to ``concurrency`` at a time, until ``stop`` is set.
+
+    :param queue: The job queue.
+    :type queue: JobQueue
+    :param concurrency: Jobs run at the same time.
+    :type concurrency: int
+    :param worker: Worker name recorded with claimed jobs (default: host and process ID).
+    :type worker: Optional[str]
+    :param stop: Set to stop claiming jobs; running jobs are finished first.
+    :type stop: Optional[threading.Event]
+    :raises KeyError: If ``OPENAI_API_KEY`` is not set.
+    """
+    api_key = os.environ["OPENAI_API_KEY"]
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    stop = stop or threading.Event()
+    slots = asyncio.Semaphore(concurrency)
+    running: Dict[asyncio.Future, Tuple[Job, CancelToken]] = {}
+
+    async def heartbeat() -> None:
+        # Also cancels jobs whose stages run long without streaming
+        while True:
+            await asyncio.to_thread(queue.heartbeat, worker)
+            for job, token in list(running.values()):
+                if await asyncio.to_thread(queue.cancel_requested, job.id):
+                    token.cancel("job cancelled")
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    beating = asyncio.ensure_future(heartbeat())
+    try:
+        while not stop.is_set():
+            await slots.acquire()
+            job = await asyncio.to_thread(queue.claim, worker)
+            if job is None:
+                slots.release()
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            logger.info("%s running job %s", worker, job.id)
+            token = CancelToken()
+            task = asyncio.ensure_future(_run_job(queue, job, api_key, token))
+            running[task] = (job, token)
+            task.add_done_callback(lambda done: (running.pop(done, None), slots.release()))
+        if running:
+            await asyncio.wait(list(running))
+    finally:
+        beating.cancel()
+
+
+def _worker_process(path: str, concurrency: int) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    try:
+        asyncio.run(work(JobQueue(path), concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(path: str, processes: int = 2, concurrency: int = 4) -> None:
+    """
+    Run a pool of worker processes on the queue, restarting workers that die and
+    requeueing the jobs of workers that stopped heartbeating, until interrupted.
+
+    :param path: The queue file.
+    :type path: str
+    :param processes: Worker processes.
+    :type processes: int
+    :param concurrency: Jobs run at the same time by each worker.
+    :type concurrency: int
+    """
+    queue = get_queue(path)
+    context = multiprocessing.get_context("spawn")
+    workers: List[Any] = []
+    try:
+        while True:
+            workers = [process for process in workers if process.is_alive()]
+            while len(workers) < processes:
+                process = context.Process(target=_worker_process, args=(path, concurrency),
+                                          name=f"control-worker-{len(workers) + 1}", daemon=True)
+                process.start()
+                workers.append(process)
+            if queue.requeue_stale():
+                logger.warning("Requeued the jobs of a stopped worker")
+            time.sleep(HEARTBEAT_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+
+
+def jobs_enabled() -> bool:
+    """
+    Whether the apps submit assessments to the job queue.
+
+    :rtype: bool
+    """
+    return os.environ.get("CONTROL_JOBS_ENABLED", "").lower() in ("1", "true", "yes")
+
+
+_queues: Dict[str, JobQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(path: Optional[str] = None) -> JobQueue:
+    """
+    The process-wide job queue configured from the environment.
+
+    :param path: The queue file (default ``$CONTROL_JOBS_PATH``).
+    :type path: Optional[str]
+    :rtype: JobQueue
+    """
+    path = path or os.environ.get("CONTROL_JOBS_PATH", os.path.join(".cache", "control_jobs.sqlite"))
+    with _queues_lock:
+        queue = _queues.get(path)
+        if queue is None:
+            queue = _queues[path] = JobQueue(path, float(os.environ.get("CONTROL_JOBS_STALE_SECONDS", 60)),
+                                             int(os.environ.get("CONTROL_JOBS_MAX_ATTEMPTS", 3)))
+        return queue
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run or inspect background assessment jobs.")
+    parser.add_argument("command", choices=("worker", "submit", "follow", "status", "cancel", "list"))
+    parser.add_argument("argument", nargs="?", help="control description (submit) or job ID")
+    parser.add_argument("--path", help="queue file (default: $CONTROL_JOBS_PATH)")
+    parser.add_argument("--processes", type=int, default=2, help="worker processes")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs per worker process")
+    parser.add_argument("--priority", choices=("interactive", "batch"), default="interactive")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    queue = get_queue(args.path)
+    if args.command == "worker":
+        if not os.environ.get("OPENAI_API_KEY"):
+            parser.error("workers read the OpenAI API key from $OPENAI_API_KEY")
+        serve(queue.path, max(1, args.processes), max(1, args.concurrency))
+    elif args.command == "list":
+        print(tabulate(queue.jobs(), headers="keys"))
+    elif not args.argument:
+        parser.error(f"{args.command} needs an argument")
+    elif args.command == "submit":
+        print(queue.submit(args.argument, priority=args.priority))
+    elif args.command == "status":
+        print(json.dumps(queue.get(args.argument), indent=2))
+    elif args.command == "cancel":
+        queue.cancel(args.argument)
+    else:
+        state: Dict[str, Any] = {}
+        for event in follow_job(queue, args.argument, state):
+            if event is RESTARTED:
+                print("\n[job restarted]")
+            elif event.token is not None:
+                print(event.token, end="", flush=True)
+            else:
+                print(f"\n[{event.stage.name} done]")
+        print(json.dumps({key: state.get(key) for key in ("control_classification", "control_score")}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+from src.control_prompts import Prompt
+from src.control_cache import MISSING, LLMCache, cache_key, get_cache, prompt_hash
+from src.control_cassette import get_cassette
+from src.control_clients import get_chain
+from src.control_contracts import PREVIOUS_ANSWER, ContractViolation, CutOff, OutputContract
+from src.control_metrics import StageRecorder
+from src.control_ratelimit import estimate_tokens, get_scheduler, output_estimate
+from src.control_routing import route
+from src.control_singleflight import get_flights
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_for(stage: str, prompt: Prompt, state: Dict[str, Any]) -> Optional[LLMCache]:
+    # A state may opt out of the response cache, e.g. to force a fresh assessment. Recording
+    # needs the API's answers and replaying must not depend on the cache, so a cassette
+    # (see src/control_cassette.py) bypasses it too.
+    if not state.get("use_cache", True) or get_cassette() is not None:
+        return None
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate_stale(stage, prompt)
+    return cache
+
+
+def _note_prompt(stage: str, prompt: Prompt, state: Dict[str, Any]) -> None:
+    # The prompt version each stage answered with, saved with the assessment (see src/control_store.py)
+    state.setdefault("prompt_versions", {})[stage] = prompt_hash(prompt)[:12]
+
+
+def _config(recorder: StageRecorder, state: Dict[str, Any]) -> Dict[str, Any]:
+    # Stage metrics plus any LangChain callbacks carried by the state
+    return {"callbacks": list(state.get("callbacks") or []) + [recorder.callback]}
+
+
+def _admission(prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any], llm_settings: Dict[str, Any],
+               recorder: StageRecorder) -> Dict[str, Any]:
+    # Rate-limit scheduler arguments of a call; calls of background batch work yield to
+    # interactive ones
+    return {"model": str(llm_settings.get("model", "")),
+            "tokens": estimate_tokens(prompt, inputs) + output_estimate(llm_settings),
+            "priority": state.get("priority", "interactive"), "on_wait": recorder.throttled}
+
+
+def _cut_off(error: Exception) -> bool:
+    # An answer cut off by its output budget: a text answer finishing with "length", or a
+    # structured one that fails to parse
+    from langchain_core.exceptions import OutputParserException
+    from openai import LengthFinishReasonError
+    return isinstance(error, (CutOff, OutputParserException, LengthFinishReasonError))
+
+
+def _check_finish(stage: str, recorder: StageRecorder) -> None:
+    # Text parsers drop the finish reason; the recorder's callback kept it
+    if recorder.finish_reason == "length":
+        raise CutOff(stage)
+
+
+def _repair_call(stage: str, prompt: Prompt, inputs: Dict[str, Any], llm_settings: Dict[str, Any],
+                 contract: OutputContract, answer: Any) -> Tuple[str, Prompt, Dict[str, Any], Dict[str, Any]]:
+    # -> (stage, prompt, inputs, settings) of the call repairing a broken answer; repairs
+    # get stage names of their own, so their metrics and cache entries stay apart
+    if not answer:
+        # Cut off by the output budget: ask again with twice the budget
+        return f"{stage}_retry", prompt, inputs, contract.settings(llm_settings, 2, stage)
+    previous = answer if isinstance(answer, str) else json.dumps(answer)
+    return (f"{stage}_repair", contract.repair_prompt(prompt), {**inputs, PREVIOUS_ANSWER: previous},
+            contract.repair_settings(llm_settings, stage))
+
+
+def enforce(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any], llm_settings: Dict[str, Any],
+            contract: OutputContract, generation: Any, schema: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Check an answer against the contract of its stage and repair it with up to
+    ``contract.retries`` targeted calls if it breaks it (see :mod:`src.control_contracts`).
+    :func:`run_chain` and :func:`stream_stage` do this with the settings they routed.
+
+    :param stage: The name of the stage.
+    :type stage: str
+    :param prompt: The chat messages of the stage.
+    :type prompt: Prompt
+    :param inputs: The values of the prompt placeholders.
+    :type inputs: Dict[str, Any]
+    :param state: The assessment state (see :func:`run_chain`).
+    :type state: Dict[str, Any]
+    :param llm_settings: The stage's keyword arguments for ``ChatOpenAI`` as routed for the
+                         control (see :func:`src.control_routing.route`), without the budget.
+    :type llm_settings: Dict[str, Any]
+    :param contract: The output contract of the stage.
+    :type contract: OutputContract
+    :param generation: The answer: text, a parsed structured response or None if it was cut off.
+    :param schema: The JSON schema of a stage with a structured answer of its own; label
+                   stages use the contract's.
+    :type schema: Optional[Dict[str, Any]]
+    :return: The valid answer (a label for label stages).
+    :rtype: Any
+    :raises ContractViolation: If the answer still breaks the contract after the repairs.
+    """
+    answer, violation = contract.check(generation)
+    for _ in range(contract.retries):
+        if violation is None:
+            return answer
+        logger.info("The %s answer breaks its contract (%s); repairing it", stage, violation)
+        repair_stage, repair_prompt, repair_inputs, settings = _repair_call(stage, prompt, inputs, llm_settings,
+                                                                            contract, answer)
+        try:
+            generation = _run_chain(repair_stage, repair_prompt, repair_inputs, state, settings,
+                                    schema or contract.schema(stage))
+        except Exception as error:
+            if not _cut_off(error):
+                raise
+            generation = None
+        answer, violation = contract.check(generation)
+    if violation is not None:
+        raise ContractViolation(stage, violation)
+    return answer
+
+
+async def aenforce(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+                   llm_settings: Dict[str, Any], contract: OutputContract, generation: Any,
+                   schema: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Async variant of :func:`enforce`.
+    """
+    answer, violation = contract.check(generation)
+    for _ in range(contract.retries):
+        if violation is None:
+            return answer
+        logger.info("The %s answer breaks its contract (%s); repairing it", stage, violation)
+        repair_stage, repair_prompt, repair_inputs, settings = _repair_call(stage, prompt, inputs, llm_settings,
+                                                                            contract, answer)
+        try:
+            generation = await _arun_chain(repair_stage, repair_prompt, repair_inputs, state, settings,
+                                           schema or contract.schema(stage))
+        except Exception as error:
+            if not _cut_off(error):
+                raise
+            generation = None
+        answer, violation = contract.check(generation)
+    if violation is not None:
+        raise ContractViolation(stage, violation)
+    return answer
+
+
+def run_chain(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+              llm_settings: Dict[str, Any], schema: Optional[Dict[str, Any]] = None,
+              contract: Optional[OutputContract] = None) -> Any:
+    """
+    Run a stage prompt synchronously and return the generated text. Responses are served
+    from and stored in the shared response cache (see :mod:`src.control_cache`), and an
+    identical call already in flight in the process is joined rather than repeated (see
+    :mod:`src.control_singleflight`). Calls to the API are admitted and retried by the
+    process-wide rate-limit scheduler (see :mod:`src.control_ratelimit`).
+
+    :param stage: The name of the calling stage.
+    :type stage: str
+    :param prompt: The chat messages of the stage (see :func:`src.control_prompts.stage_prompt`).
+    :type prompt: Prompt
+    :param inputs: The values of the prompt placeholders.
+    :type inputs: Dict[str, Any]
+    :param state: The assessment state; provides "openai_api_key", the optional "use_cache"
+                  flag (default True), the optional rate-limit "priority" ("interactive" by
+                  default, or "batch"), optional LangChain "callbacks" and, in a Batch API run,
+                  the "batch" answering the call (see :mod:`src.control_batch_api`). Wall time, tokens,
+                  retries and cost of the call are added to ``state["metrics"][stage]``
+                  (see :class:`src.control_metrics.StageRecorder`).
+    :type state: Dict[str, Any]
+    :param llm_settings: Keyword arguments for ``ChatOpenAI``, as routed for the control by
+                         the routing policy (see :mod:`src.control_routing`).
+    :type llm_settings: Dict[str, Any]
+    :param schema: JSON schema for a structured response; the parsed dict is returned instead of text.
+    :type schema: Optional[Dict[str, Any]]
+    :param contract: The output contract of the stage: the call gets its output budget (and
+                     label schema), and the answer is checked and, if needed, repaired by
+                     :func:`enforce`; an answer cut off by the budget is asked again with twice
+                     the budget.
+    :type contract: Optional[OutputContract]
+    :return: The generated text, the parsed structured response, or the label of a label contract.
+    :rtype: Any
+    :raises CutOff: If the answer of a call without a contract is cut off by its budget.
+    :raises ContractViolation: If the answer still breaks the contract after the repairs.
+    """
+    llm_settings = route(stage, llm_settings, state)
+    _note_prompt(stage, prompt, state)
+    if contract is None:
+        return _run_chain(stage, prompt, inputs, state, llm_settings, schema)
+    try:
+        generation = _run_chain(stage, prompt, inputs, state, contract.settings(llm_settings, stage=stage),
+                                schema or contract.schema(stage))
+    except Exception as error:
+        if not _cut_off(error):
+            raise
+        generation = None
+    return enforce(stage, prompt, inputs, state, llm_settings, contract, generation, schema)
+
+
+def _run_chain(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+               llm_settings: Dict[str, Any], schema: Optional[Dict[str, Any]] = None) -> Any:
+    with StageRecorder(state, stage, llm_settings) as recorder:
+        key = cache_key(prompt, llm_settings, inputs, schema)
+        if state.get("batch") is not None:
+            # Answered by a Batch API round, or deferred to the next one (see src/control_batch_api.py)
+            return state["batch"].answer(state, stage, key, prompt, inputs, llm_settings, schema, recorder)
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            return cassette.replay(stage, key, prompt, inputs, recorder)
+        cache = _cache_for(stage, prompt, state)
+        if cache is not None:
+            generation = cache.get(key)
+            if generation is not MISSING:
+                recorder.cache_hit()
+                return generation
+
+        rag_chain = get_chain(prompt, llm_settings, state["openai_api_key"], schema)
+
+        def call() -> Any:
+            started = time.perf_counter()
+            try:
+                generation = get_scheduler().call(lambda: rag_chain.invoke(inputs, config=_config(recorder, state)),
+                                                  **_admission(prompt, inputs, state, llm_settings, recorder))
+            except Exception as error:
+                if _cut_off(error) and not isinstance(error, CutOff):
+                    raise CutOff(stage) from error
+                raise
+            _check_finish(stage, recorder)
+            # Stored before the flight lands, so later callers find it
+            if cache is not None:
+                cache.put(key, stage, prompt, llm_settings, inputs, generation)
+            if cassette is not None:
+                cassette.record(stage, key, prompt, inputs, generation, recorder, time.perf_counter() - started)
+            return generation
+
+        return get_flights().run((stage, key), call, recorder.coalesced)
+
+
+async def arun_chain(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+                     llm_settings: Dict[str, Any], schema: Optional[Dict[str, Any]] = None,
+                     contract: Optional[OutputContract] = None) -> Any:
+    """
+    Async variant of :func:`run_chain` built on ``ainvoke``, so that independent stages can
+    run concurrently on one event loop.
+    """
+    llm_settings = route(stage, llm_settings, state)
+    _note_prompt(stage, prompt, state)
+    if contract is None:
+        return await _arun_chain(stage, prompt, inputs, state, llm_settings, schema)
+    try:
+        generation = await _arun_chain(stage, prompt, inputs, state, contract.settings(llm_settings, stage=stage),
+                                       schema or contract.schema(stage))
+    except Exception as error:
+        if not _cut_off(error):
+            raise
+        generation = None
+    return await aenforce(stage, prompt, inputs, state, llm_settings, contract, generation, schema)
+
+
+async def _arun_chain(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+                      llm_settings: Dict[str, Any], schema: Optional[Dict[str, Any]] = None) -> Any:
+    with StageRecorder(state, stage, llm_settings) as recorder:
+        key = cache_key(prompt, llm_settings, inputs, schema)
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            return await cassette.areplay(stage, key, prompt, inputs, recorder)
+        cache = _cache_for(stage, prompt, state)
+        if cache is not None:
+            generation = cache.get(key)
+            if generation is not MISSING:
+                recorder.cache_hit()
+                return generation
+
+        rag_chain = get_chain(prompt, llm_settings, state["openai_api_key"], schema)
+
+        async def call() -> Any:
+            started = time.perf_counter()
+            try:
+                generation = await get_scheduler().acall(
+                    lambda: rag_chain.ainvoke(inputs, config=_config(recorder, state)),
+                    **_admission(prompt, inputs, state, llm_settings, recorder))
+            except Exception as error:
+                if _cut_off(error) and not isinstance(error, CutOff):
+                    raise CutOff(stage) from error
+                raise
+            _check_finish(stage, recorder)
+            if cache is not None:
+                cache.put(key, stage, prompt, llm_settings, inputs, generation)
+            if cassette is not None:
+                cassette.record(stage, key, prompt, inputs, generation, recorder, time.perf_counter() - started)
+            return generation
+
+        return await get_flights().arun((stage, key), call, recorder.coalesced)
+
+
+def stream_chain(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+                 llm_settings: Dict[str, Any], contract: Optional[OutputContract] = None) -> Iterator[str]:
+    """
+    Streaming variant of :func:`run_chain`: yields the text as it is generated, built on the
+    chain's ``stream``. A cached response is yielded in one piece. The time to the first
+    token is recorded in ``state["metrics"][stage]["time_to_first_token"]``. With a
+    ``contract`` the call gets its output budget; :func:`stream_stage` checks the joined text.
+
+    :param stage: The name of the calling stage.
+    :type stage: str
+    :param prompt: The chat messages of the stage (see :func:`src.control_prompts.stage_prompt`).
+    :type prompt: Prompt
+    :param inputs: The values of the prompt placeholders.
+    :type inputs: Dict[str, Any]
+    :param state: The assessment state (see :func:`run_chain`).
+    :type state: Dict[str, Any]
+    :param llm_settings: Keyword arguments for ``ChatOpenAI`` as routed for the control
+                         (:func:`stream_stage` routes them).
+    :type llm_settings: Dict[str, Any]
+    :param contract: The output contract of the stage.
+    :type contract: Optional[OutputContract]
+    :return: An iterator over the generated text chunks.
+    :rtype: Iterator[str]
+    :raises CutOff: After the last chunk, if the answer was cut off by its output budget.
+    """
+    _note_prompt(stage, prompt, state)
+    if contract is not None:
+        llm_settings = contract.settings(llm_settings, stage=stage)
+    with StageRecorder(state, stage, llm_settings) as recorder:
+        key = cache_key(prompt, llm_settings, inputs)
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            yield from cassette.replay_stream(stage, key, prompt, inputs, recorder)
+            return
+        cache = _cache_for(stage, prompt, state)
+        if cache is not None:
+            generation = cache.get(key)
+            if generation is not MISSING:
+                recorder.cache_hit()
+                recorder.first_token()
+                yield generation
+                return
+
+        rag_chain = get_chain(prompt, llm_settings, state["openai_api_key"])
+
+        def call() -> Iterator[str]:
+            started = time.perf_counter()
+            chunks = []
+            for chunk in get_scheduler().stream(lambda: rag_chain.stream(inputs, config=_config(recorder, state)),
+                                                **_admission(prompt, inputs, state, llm_settings, recorder)):
+                if chunk:
+                    chunks.append((time.perf_counter() - started, chunk))
+                    yield chunk
+            # A cut-off answer is neither cached nor recorded
+            _check_finish(stage, recorder)
+            generation = "".join(text for _, text in chunks)
+            if cache is not None:
+                cache.put(key, stage, prompt, llm_settings, inputs, generation)
+            if cassette is not None:
+                cassette.record(stage, key, prompt, inputs, generation, recorder, time.perf_counter() - started, chunks)
+
+        # Followers of a call in flight receive its chunks as they are generated
+        for chunk in get_flights().stream((stage, key), call, recorder.coalesced):
+            recorder.first_token()
+            yield chunk
+
+
+async def astream_chain(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+                        llm_settings: Dict[str, Any], contract: Optional[OutputContract] = None) -> AsyncIterator[str]:
+    """
+    Async variant of :func:`stream_chain` built on ``astream``.
+    """
+    _note_prompt(stage, prompt, state)
+    if contract is not None:
+        llm_settings = contract.settings(llm_settings, stage=stage)
+    with StageRecorder(state, stage, llm_settings) as recorder:
+        key = cache_key(prompt, llm_settings, inputs)
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            async for chunk in cassette.areplay_stream(stage, key, prompt, inputs, recorder):
+                yield chunk
+            return
+        cache = _cache_for(stage, prompt, state)
+        if cache is not None:
+            generation = cache.get(key)
+            if generation is not MISSING:
+                recorder.cache_hit()
+                recorder.first_token()
+                yield generation
+                return
+
+        rag_chain = get_chain(prompt, llm_settings, state["openai_api_key"])
+
+        async def call() -> AsyncIterator[str]:
+            started = time.perf_counter()
+            chunks = []
+            async for chunk in get_scheduler().astream(lambda: rag_chain.astream(inputs, config=_config(recorder, state)),
+                                                       **_admission(prompt, inputs, state, llm_settings, recorder)):
+                if chunk:
+                    chunks.append((time.perf_counter() - started, chunk))
+                    yield chunk
+            # A cut-off answer is neither cached nor recorded
+            _check_finish(stage, recorder)
+            generation = "".join(text for _, text in chunks)
+            if cache is not None:
+                cache.put(key, stage, prompt, llm_settings, inputs, generation)
+            if cassette is not None:
+                cassette.record(stage, key, prompt, inputs, generation, recorder, time.perf_counter() - started, chunks)
+
+        async for chunk in get_flights().astream((stage, key), call, recorder.coalesced):
+            recorder.first_token()
+            yield chunk
+
+
+def stream_stage(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+                 llm_settings: Dict[str, Any], contract: OutputContract, output: str) -> Iterator[str]:
+    """
+    Stream a text stage: yields the text as it is generated (see :func:`stream_chain`), then
+    stores the answer, checked and if needed repaired by :func:`enforce`, under
+    ``state[output]``. An answer cut off by its budget is asked again, without streaming,
+    with twice the budget.
+
+    :param llm_settings: The stage's keyword arguments for ``ChatOpenAI``; routed for the
+                         control here, once for the stream and its repairs.
+    :type llm_settings: Dict[str, Any]
+    :param output: The state key of the answer, e.g. "control_summary".
+    :type output: str
+    :return: An iterator over the generated text chunks.
+    :rtype: Iterator[str]
+    :raises ContractViolation: If the answer still breaks the contract after the repairs.
+    """
+    llm_settings = route(stage, llm_settings, state)
+    generation: Optional[str] = ""
+    try:
+        for chunk in stream_chain(stage, prompt, inputs, state, llm_settings, contract):
+            generation += chunk
+            yield chunk
+    except CutOff:
+        generation = None
+    state[output] = enforce(stage, prompt, inputs, state, llm_settings, contract, generation)
+
+
+async def astream_stage(stage: str, prompt: Prompt, inputs: Dict[str, Any], state: Dict[str, Any],
+                        llm_settings: Dict[str, Any], contract: OutputContract, output: str) -> AsyncIterator[str]:
+    """
+    Async variant of :func:`stream_stage` built on :func:`astream_chain`.
+    """
+    llm_settings = route(stage, llm_settings, state)
+    generation: Optional[str] = ""
+    try:
+        async for chunk in astream_chain(stage, prompt, inputs, state, llm_settings, contract):
+            generation += chunk
+            yield chunk
+    except CutOff:
+        generation = None
+    state[output] = await aenforce(stage, prompt, inputs, state, llm_settings, contract, generation)
@@ -0,0 +1,316 @@
+"""
+Offline fast-path for the classify stage.
+
+A TF-IDF + softmax regression model, written with NumPy only, trained on the labels the
+LLM already produced (read from the assessment store). ``classify`` asks this model first
+and only calls the LLM when the model's confidence is below a threshold.
+
+Configuration (environment variables):
+
+- ``CONTROL_CLASSIFIER_PATH``: model file (default ``.cache/control_classifier.npz``)
+- ``CONTROL_CLASSIFIER_THRESHOLD``: minimum probability to accept a local label (default 0.8)
+- ``CONTROL_CLASSIFIER_DISABLED``: set to ``1`` to always use the LLM
+
+Usage::
+
+    python -m src.control_local_classifier train --test-size 0.2
+    python -m src.control_local_classifier evaluate
+
+The model file records which examples it was trained on; ``evaluate`` scores it only on
+the other stored labels (the held-out split and labels stored since), so the reported
+``accuracy_at_threshold`` is a fair basis for choosing ``CONTROL_CLASSIFIER_THRESHOLD``.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from src.control_prompts import CLASSIFICATION_LABELS
+
+_TOKEN = re.compile(r"[a-z0-9$]+")
+
+
+def normalize_label(text: str) -> Optional[str]:
+    """
+    Map an LLM classification answer onto one of ``CLASSIFICATION_LABELS``.
+
+    :param text: The raw answer, e.g. "Fraud." or "High-Dollar Escalation".
+    :type text: str
+    :return: The matching label, or None if the answer names no single label.
+    :rtype: Optional[str]
+    """
+    cleaned = re.sub(r"[^a-z ]", " ", str(text).lower().replace("-", " "))
+    cleaned = " ".join(cleaned.split())
+    matches = [label for label in CLASSIFICATION_LABELS if label.lower() in cleaned]
+    return matches[0] if len(matches) == 1 else None
+
+
+def text_digest(text: str) -> str:
+    """
+    Short digest identifying a training example in the model file.
+
+    :rtype: str
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _terms(text: str) -> List[str]:
+    tokens = _TOKEN.findall(text.lower())
+    return tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+
+
+class LocalClassifier:
+    """
+    TF-IDF features (word unigrams and bigrams) with a multinomial logistic regression.
+
+    :ivar trained: :func:`text_digest` of every training example; None for model files
+                   saved before they were recorded.
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], idf: np.ndarray, weights: np.ndarray,
+                 bias: np.ndarray, labels: Sequence[str], trained: Optional[Iterable[str]] = None):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.labels = list(labels)
+        self.trained = set(trained) if trained is not None else None
+
+    def _features(self, texts: Sequence[str]) -> np.ndarray:
+        features = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term, count in Counter(_terms(text)).items():
+                column = self.vocabulary.get(term)
+                if column is not None:
+                    features[row, column] = 1.0 + np.log(count)
+        features *= self.idf
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        return features / np.maximum(norms, 1e-12)
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Class probabilities, one row per text, columns in ``self.labels`` order.
+
+        :param texts: Control descriptions.
+        :type texts: Sequence[str]
+        :rtype: np.ndarray
+        """
+        return _softmax(self._features(texts) @ self.weights + self.bias)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """
+        The most likely label of one control and its probability.
+
+        :param text: A control description.
+        :type text: str
+        :rtype: Tuple[str, float]
+        """
+        probabilities = self.predict_proba([text])[0]
+        best = int(np.argmax(probabilities))
+        return self.labels[best], float(probabilities[best])
+
+    @classmethod
+    def fit(cls, texts: Sequence[str], labels: Sequence[str], max_features: int = 5000, min_df: int = 1,
+            epochs: int = 60, learning_rate: float = 5.0, l2: float = 1e-5, batch_size: int = 256,
+            seed: int = 0) -> "LocalClassifier":
+        """
+        Train on labelled control descriptions with mini-batch gradient descent, so memory
+        stays bounded by ``batch_size x max_features``.
+
+        :param texts: Control descriptions.
+        :param labels: Their labels.
+        :param max_features: Vocabulary size cap (most frequent terms are kept).
+        :param min_df: Minimum number of documents a term must appear in.
+        :param epochs: Passes over the training data.
+        :param learning_rate: Gradient step size.
+        :param l2: L2 regularisation strength.
+        :param batch_size: Rows per gradient step.
+        :param seed: Shuffling seed.
+        :rtype: LocalClassifier
+        :raises ValueError: If fewer than two distinct labels are given.
+        """
+        classes = sorted(set(labels))
+        if len(classes) < 2:
+            raise ValueError("At least two distinct labels are needed to train the classifier")
+
+        document_frequency = Counter()
+        for text in texts:
+            document_frequency.update(set(_terms(text)))
+        terms = [term for term, count in document_frequency.most_common(max_features) if count >= min_df]
+        vocabulary = {term: index for index, term in enumerate(terms)}
+        idf = np.array([np.log((1 + len(texts)) / (1 + document_frequency[term])) + 1 for term in terms],
+                       dtype=np.float32)
+
+        model = cls(vocabulary, idf, np.zeros((len(terms), len(classes)), dtype=np.float32),
+                    np.zeros(len(classes), dtype=np.float32), classes, (text_digest(text) for text in texts))
+        targets = np.array([classes.index(label) for label in labels])
+        generator = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = generator.permutation(len(texts))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                features = model._features([texts[index] for index in batch])
+                probabilities = _softmax(features @ model.weights + model.bias)
+                probabilities[np.arange(len(batch)), targets[batch]] -= 1.0
+                model.weights -= learning_rate * (features.T @ probabilities / len(batch) + l2 * model.weights)
+                model.bias -= learning_rate * probabilities.mean(axis=0)
+        return model
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wb") as handle:
+            np.savez_compressed(handle, vocabulary=np.array(json.dumps(self.vocabulary)), idf=self.idf,
+                                weights=self.weights, bias=self.bias, labels=np.array(json.dumps(self.labels)),
+                                trained=np.array(json.dumps(sorted(self.trained or ()))))
+
+    @classmethod
+    def load(cls, path: str) -> "LocalClassifier":
+        with np.load(path) as data:
+            return cls(json.loads(str(data["vocabulary"])), data["idf"], data["weights"], data["bias"],
+                       json.loads(str(data["labels"])),
+                       json.loads(str(data["trained"])) if "trained" in data.files else None)
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    exponentials = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exponentials / exponentials.sum(axis=1, keepdims=True)
+
+
+def model_path() -> str:
+    return os.environ.get("CONTROL_CLASSIFIER_PATH", os.path.join(".cache", "control_classifier.npz"))
+
+
+_loaded: Dict[str, Tuple[float, LocalClassifier]] = {}
+_loaded_lock = threading.Lock()
+
+
+def get_classifier() -> Optional[LocalClassifier]:
+    """
+    The trained model, loaded once and reloaded when the model file changes; None if no
+    model has been trained or the fast path is disabled.
+
+    :rtype: Optional[LocalClassifier]
+    """
+    if os.environ.get("CONTROL_CLASSIFIER_DISABLED", "").lower() in ("1", "true", "yes"):
+        return None
+    path = model_path()
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _loaded_lock:
+        loaded = _loaded.get(path)
+        if loaded is None or loaded[0] != modified:
+            loaded = (modified, LocalClassifier.load(path))
+            _loaded[path] = loaded
+        return loaded[1]
+
+
+def local_classify(text: str, threshold: Optional[float] = None) -> Optional[Tuple[str, float]]:
+    """
+    Classify a control locally if the model is confident enough.
+
+    :param text: The control description.
+    :type text: str
+    :param threshold: Minimum probability, defaulting to ``$CONTROL_CLASSIFIER_THRESHOLD`` or 0.8.
+    :type threshold: Optional[float]
+    :return: ``(label, probability)``, or None when there is no model or it is not confident.
+    :rtype: Optional[Tuple[str, float]]
+    """
+    model = get_classifier()
+    if model is None:
+        return None
+    if threshold is None:
+        threshold = float(os.environ.get("CONTROL_CLASSIFIER_THRESHOLD", 0.8))
+    label, probability = model.predict(text)
+    return (label, probability) if probability >= threshold else None
+
+
+def stored_labels() -> List[Tuple[str, str]]:
+    """
+    ``(control, label)`` pairs from the classifications in the assessment store (see
+    :mod:`src.control_store`), which keeps them whatever the response cache evicts or
+    invalidates. Only labels the LLM gave count: a local prediction has no classify prompt
+    version.
+
+    :rtype: List[Tuple[str, str]]
+    """
+    from src.control_store import get_store
+
+    store = get_store()
+    if store is None:
+        return []
+    examples = []
+    for record in store.records():
+        label = normalize_label(record.get("control_classification") or "")
+        if label and "classify" in record["prompt_versions"]:
+            examples.append((record["original_input"], label))
+    return examples
+
+
+def evaluate(model: LocalClassifier, examples: Iterable[Tuple[str, str]], threshold: float) -> Dict[str, float]:
+    """
+    Agreement of the model with the LLM labels, overall and for the confident predictions
+    that would skip the LLM.
+
+    :param model: The trained model.
+    :param examples: ``(control, LLM label)`` pairs.
+    :param threshold: The confidence threshold of the fast path.
+    :return: "examples", "accuracy", "coverage" (share answered locally) and
+             "accuracy_at_threshold" (agreement among those).
+    :rtype: Dict[str, float]
+    """
+    examples = list(examples)
+    if not examples:
+        return {"examples": 0, "accuracy": 0.0, "coverage": 0.0, "accuracy_at_threshold": 0.0}
+    probabilities = model.predict_proba([text for text, _ in examples])
+    predicted = [model.labels[index] for index in probabilities.argmax(axis=1)]
+    confident = probabilities.max(axis=1) >= threshold
+    correct = np.array([guess == label for guess, (_, label) in zip(predicted, examples)])
+    return {
+        "examples": len(examples),
+        "accuracy": float(correct.mean()),
+        "coverage": float(confident.mean()),
+        "accuracy_at_threshold": float(correct[confident].mean()) if confident.any() else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Train or evaluate the local control classifier.")
+    parser.add_argument("command", choices=("train", "evaluate"))
+    parser.add_argument("--test-size", type=float, default=0.2, help="share of stored labels held out for evaluation")
+    parser.add_argument("--threshold", type=float, default=float(os.environ.get("CONTROL_CLASSIFIER_THRESHOLD", 0.8)))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    examples = stored_labels()
+    print(f"{len(examples)} stored LLM labels: {dict(Counter(label for _, label in examples))}")
+    if args.command == "evaluate":
+        model = get_classifier()
+        if model is None:
+            parser.error(f"no model at {model_path()}; run 'train' first")
+        if model.trained is None:
+            parser.error(f"the model at {model_path()} does not record its training examples; run 'train' again")
+        held_out = [(text, label) for text, label in examples if text_digest(text) not in model.trained]
+        print(f"Evaluating on the {len(held_out)} stored labels the model was not trained on")
+        print(json.dumps(evaluate(model, held_out, args.threshold), indent=2))
+        return
+
+    order = np.random.default_rng(args.seed).permutation(len(examples))
+    held_out = int(len(examples) * args.test_size)
+    test = [examples[index] for index in order[:held_out]]
+    train = [examples[index] for index in order[held_out:]]
+    model = LocalClassifier.fit([text for text, _ in train], [label for _, label in train], seed=args.seed)
+    if test:
+        print("Held-out agreement with LLM labels:")
+        print(json.dumps(evaluate(model, test, args.threshold), indent=2))
+    model.save(model_path())
+    print(f"Saved model trained on {len(train)} examples to {model_path()}")
+
+
+if __name__ == "__main__":
+    main()
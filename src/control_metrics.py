@@ -0,0 +1,544 @@
+"""
+Per-stage instrumentation of the assessment chains.
+
+Every stage call made through :mod:`src.control_llm` is wrapped in a
+:class:`StageRecorder`, a LangChain callback handler that adds to
+``state["metrics"][stage]``: wall time, time to first token, input, cached, output and
+reasoning tokens, HTTP retries, time held back by the rate limiter, errors, answers cut
+off by their output budget, response cache hits, calls coalesced with an identical call in
+flight and the estimated cost.
+Finished assessments are summarised by :func:`record_assessment`, and all calls of the
+process are aggregated into Prometheus counters and histograms.
+
+Configuration (environment variables):
+
+- ``CONTROL_METRICS_JSONL``: append one JSON line per finished assessment to this file
+- ``CONTROL_METRICS_PORT``: serve the Prometheus text exposition on ``:<port>/metrics``
+- ``CONTROL_MODEL_PRICES``: JSON ``{"model": [input, cached input, output]}`` in USD per
+  million tokens, overriding ``MODEL_PRICES``
+
+Usage::
+
+    python -m src.control_metrics summarize metrics.jsonl
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from src.control_contracts import CutOff
+
+# USD per million tokens: (input, cached input, output). Reasoning tokens are billed as output.
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "o3-mini": (1.10, 0.55, 4.40),
+}
+
+TOKEN_TYPES = ("input", "cached", "output", "reasoning")
+
+# Histogram bucket upper bounds, in seconds
+DURATION_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+FIRST_TOKEN_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+# HTTP requests of the stage call running in the current context, counted by the client hooks
+_current_call: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar("control_stage_call",
+                                                                                        default=None)
+
+
+def model_prices() -> Dict[str, Tuple[float, float, float]]:
+    """
+    ``MODEL_PRICES`` with the overrides of ``$CONTROL_MODEL_PRICES``.
+
+    :rtype: Dict[str, Tuple[float, float, float]]
+    """
+    prices = dict(MODEL_PRICES)
+    prices.update({model: tuple(values) for model, values in json.loads(os.environ.get("CONTROL_MODEL_PRICES", "{}")).items()})
+    return prices
+
+
+def estimate_cost(model: str, input_tokens: int, cached_tokens: int, output_tokens: int) -> float:
+    """
+    Estimated cost of a call in USD; 0.0 for models without a known price.
+
+    :param model: The model name; dated snapshots ("o3-mini-2025-01-31") use the base model's price.
+    :type model: str
+    :param input_tokens: Prompt tokens, including the cached ones.
+    :type input_tokens: int
+    :param cached_tokens: Prompt tokens served from the provider's prefix cache.
+    :type cached_tokens: int
+    :param output_tokens: Completion tokens, including reasoning tokens.
+    :type output_tokens: int
+    :rtype: float
+    """
+    prices = model_prices()
+    matches = [name for name in prices if model == name or model.startswith(name + "-")]
+    if not matches:
+        return 0.0
+    input_price, cached_price, output_price = prices[max(matches, key=len)]
+    return ((input_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + output_tokens * output_price) / 1_000_000
+
+
+def count_request(request: Any) -> None:
+    """
+    httpx request hook: counts the request against the stage call in progress, so that
+    requests beyond the first (client retries) show up as ``retries``.
+    """
+    call = _current_call.get()
+    if call is not None:
+        call["requests"] += 1
+
+
+async def acount_request(request: Any) -> None:
+    """
+    Async variant of :func:`count_request` for ``httpx.AsyncClient``.
+    """
+    count_request(request)
+
+
+def _new_stage_record(model: str) -> Dict[str, Any]:
+    return {
+        "model": model, "calls": 0, "cache_hits": 0, "coalesced": 0, "errors": 0, "cancelled": 0, "cut_off": 0,
+        "retries": 0, "throttled_seconds": 0.0, "wall_seconds": 0.0, "time_to_first_token": None,
+        "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "reasoning_tokens": 0, "cost_usd": 0.0,
+    }
+
+
+_callback_type: Optional[type] = None
+
+
+def _usage_callback(recorder: "StageRecorder") -> Any:
+    # LangChain callback handler feeding token usage to a recorder. The class is defined on
+    # first use, so that importing this module does not import LangChain.
+    global _callback_type
+    if _callback_type is None:
+        from langchain_core.callbacks import BaseCallbackHandler
+
+        class UsageCallback(BaseCallbackHandler):
+            # Cheap bookkeeping; run in the calling thread rather than an executor
+            run_inline = True
+
+            def __init__(self, target: "StageRecorder"):
+                self.target = target
+
+            def on_llm_end(self, response, **kwargs: Any) -> None:
+                self.target.on_llm_end(response)
+
+        _callback_type = UsageCallback
+    return _callback_type(recorder)
+
+
+class StageRecorder:
+    """
+    Records one stage call into ``state["metrics"][stage]`` and the process registry.
+
+    Used as a context manager around the call, with its :attr:`callback` passed to the chain::
+
+        with StageRecorder(state, stage, llm_settings) as recorder:
+            chain.invoke(inputs, config={"callbacks": [recorder.callback]})
+    """
+
+    def __init__(self, state: Dict[str, Any], stage: str, llm_settings: Dict[str, Any]):
+        self.stage = stage
+        self.model = str(llm_settings.get("model", ""))
+        self.record = state.setdefault("metrics", {}).setdefault(stage, _new_stage_record(self.model))
+        self.started = 0.0
+        self.tokens = dict.fromkeys(TOKEN_TYPES, 0)
+        self.cost = 0.0
+        self._requests = {"requests": 0}
+        self._first_token: Optional[float] = None
+        self._cache_hit = False
+        self._throttled = 0.0
+        self._coalesced = False
+        self._discarded = False
+        self._callback: Any = None
+        self.finish_reason: Optional[str] = None
+
+    def __enter__(self) -> "StageRecorder":
+        self.started = time.perf_counter()
+        _current_call.set(self._requests)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        # Reset by value: a streamed call may finish in a different context than it started
+        _current_call.set(None)
+        if self._discarded:
+            return False
+        elapsed = time.perf_counter() - self.started
+        if exc_type is None:
+            outcome = "cache_hit" if self._cache_hit else "coalesced" if self._coalesced else "ok"
+        elif issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+            outcome = "cancelled"
+        elif issubclass(exc_type, CutOff):
+            outcome = "cut_off"
+        else:
+            outcome = "error"
+        retries = max(0, self._requests["requests"] - 1)
+
+        record = self.record
+        record["calls"] += 1
+        record["cache_hits"] += outcome == "cache_hit"
+        record["coalesced"] += self._coalesced
+        record["errors"] += outcome == "error"
+        record["cancelled"] += outcome == "cancelled"
+        record["cut_off"] = record.get("cut_off", 0) + (outcome == "cut_off")
+        record["retries"] += retries
+        record["throttled_seconds"] += self._throttled
+        record["wall_seconds"] += elapsed
+        for token_type in TOKEN_TYPES:
+            record[f"{token_type}_tokens"] += self.tokens[token_type]
+        record["cost_usd"] += self.cost
+        get_registry().observe_stage(self.stage, self.model, outcome, elapsed, self._first_token, retries,
+                                     self.tokens, self.cost)
+        return False
+
+    @property
+    def callback(self) -> Any:
+        """
+        The LangChain callback handler recording the token usage of the call.
+        """
+        if self._callback is None:
+            self._callback = _usage_callback(self)
+        return self._callback
+
+    def cache_hit(self) -> None:
+        """
+        Mark the call as answered from the response cache.
+        """
+        self._cache_hit = True
+
+    def coalesced(self) -> None:
+        """
+        Mark the call as answered by an identical call in flight (see :mod:`src.control_singleflight`).
+        """
+        self._coalesced = True
+
+    def discard(self) -> None:
+        """
+        Leave the call out of the metrics, e.g. a call deferred to a Batch API round (see
+        :mod:`src.control_batch_api`), which is recorded when its answer is used.
+        """
+        self._discarded = True
+
+    def throttled(self, seconds: float) -> None:
+        """
+        Add time the call waited for rate-limit admission or in retry backoff.
+        """
+        self._throttled += seconds
+
+    def first_token(self) -> None:
+        """
+        Record the time to the first streamed token; later calls are ignored.
+        """
+        if self._first_token is None:
+            self._first_token = time.perf_counter() - self.started
+            self.record["time_to_first_token"] = self._first_token
+
+    def on_llm_end(self, response) -> None:
+        """
+        Add the token usage and cost of a finished LLM run (a LangChain ``LLMResult``), and
+        note its finish reason ("length" when the output budget cut the answer off).
+        """
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                self.finish_reason = ((generation.generation_info or {}).get("finish_reason")
+                                      or (getattr(message, "response_metadata", None) or {}).get("finish_reason")
+                                      or self.finish_reason)
+                usage = getattr(message, "usage_metadata", None)
+                if not usage:
+                    continue
+                self.add_usage(usage.get("input_tokens", 0),
+                               (usage.get("input_token_details") or {}).get("cache_read", 0) or 0,
+                               usage.get("output_tokens", 0),
+                               (usage.get("output_token_details") or {}).get("reasoning", 0) or 0)
+
+    def add_usage(self, input_tokens: int, cached_tokens: int, output_tokens: int, reasoning_tokens: int = 0,
+                  price_factor: float = 1.0) -> None:
+        """
+        Add the token usage of a request and its estimated cost, e.g. of a replayed one
+        (see :mod:`src.control_cassette`). ``price_factor`` scales the cost, e.g. 0.5 for the
+        discounted Batch API requests.
+        """
+        self.tokens["input"] += input_tokens
+        self.tokens["cached"] += cached_tokens
+        self.tokens["output"] += output_tokens
+        self.tokens["reasoning"] += reasoning_tokens
+        self.cost += estimate_cost(self.model, input_tokens, cached_tokens, output_tokens) * price_factor
+
+
+def assessment_summary(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Totals over the stages of one assessment.
+
+    :param state: The assessment state.
+    :type state: Dict[str, Any]
+    :return: "calls", "cache_hits", "coalesced", "errors", "cancelled", "cut_off", "retries",
+             "throttled_seconds", the four token counts, "cost_usd" and "stage_seconds" (the sum
+             of stage wall times, which exceeds the assessment's wall time when stages run
+             concurrently).
+    :rtype: Dict[str, Any]
+    """
+    stages = state.get("metrics", {}).values()
+    totals = {key: sum(record.get(key, 0) for record in stages)
+              for key in ("calls", "cache_hits", "coalesced", "errors", "cancelled", "cut_off", "retries",
+                          "throttled_seconds", "input_tokens", "cached_tokens", "output_tokens",
+                          "reasoning_tokens", "cost_usd")}
+    totals["stage_seconds"] = sum(record["wall_seconds"] for record in stages)
+    return totals
+
+
+_jsonl_lock = threading.Lock()
+
+
+def record_assessment(state: Dict[str, Any], wall_seconds: float, status: str = "completed") -> Dict[str, Any]:
+    """
+    Close the metrics of a pipeline run: adds it to the registry and, with
+    ``$CONTROL_METRICS_JSONL`` set, appends it to that file as one JSON line.
+
+    :param state: The assessment state.
+    :type state: Dict[str, Any]
+    :param wall_seconds: The wall time of the run.
+    :type wall_seconds: float
+    :param status: "completed", "failed" or "cancelled".
+    :type status: str
+    :return: The JSON-lines record: assessment id, timestamp, status, wall time, totals and
+             the per-stage metrics; for a cancelled run also "cancellation" with the reason and
+             the interrupted and skipped stages (see :mod:`src.control_cancellation`).
+    :rtype: Dict[str, Any]
+    """
+    state.setdefault("assessment_id", uuid.uuid4().hex)
+    summary = assessment_summary(state)
+    entry = {"assessment_id": state["assessment_id"], "timestamp": time.time(), "status": status,
+             "wall_seconds": wall_seconds, **summary, "stages": state.get("metrics", {})}
+    cancellation = state.get("cancellation") if status == "cancelled" else None
+    if cancellation:
+        entry["cancellation"] = cancellation
+    get_registry().observe_assessment(status, wall_seconds, summary["cost_usd"],
+                                      len(cancellation["skipped"]) if cancellation else 0)
+
+    path = os.environ.get("CONTROL_METRICS_JSONL")
+    if path:
+        with _jsonl_lock, open(path, "a", encoding="utf-8") as handle:
+            handle.write(json.dumps(entry, default=str) + "\n")
+    return entry
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and histograms of all stage calls and assessments, and gauges
+    such as the memory of the app sessions (see :mod:`src.control_session`), rendered in
+    the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], _Histogram] = {}
+        self.gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+    def _add(self, name: str, labels: Dict[str, str], value: float = 1) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name: str, labels: Dict[str, str], buckets: Tuple[float, ...], value: float) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = _Histogram(buckets)
+        histogram.observe(value)
+
+    def observe_stage(self, stage: str, model: str, outcome: str, seconds: float, first_token: Optional[float],
+                      retries: int, tokens: Dict[str, int], cost: float) -> None:
+        labels = {"stage": stage, "model": model}
+        with self._lock:
+            self._add("control_stage_calls_total", {**labels, "outcome": outcome})
+            self._add("control_stage_retries_total", labels, retries)
+            for token_type, count in tokens.items():
+                self._add("control_stage_tokens_total", {**labels, "type": token_type}, count)
+            self._add("control_stage_cost_usd_total", labels, cost)
+            self._observe("control_stage_duration_seconds", labels, DURATION_BUCKETS, seconds)
+            if first_token is not None:
+                self._observe("control_stage_time_to_first_token_seconds", labels, FIRST_TOKEN_BUCKETS, first_token)
+
+    def observe_assessment(self, status: str, seconds: float, cost: float, skipped: int = 0) -> None:
+        with self._lock:
+            self._add("control_assessments_total", {"status": status})
+            if skipped:
+                # Stages never started because the assessment was cancelled
+                self._add("control_stages_skipped_total", {}, skipped)
+            self._add("control_assessment_cost_usd_total", {}, cost)
+            self._observe("control_assessment_duration_seconds", {}, DURATION_BUCKETS, seconds)
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        """
+        Set a gauge to its current value.
+        """
+        with self._lock:
+            self.gauges[(name, tuple(sorted((labels or {}).items())))] = value
+
+    def prometheus_text(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format (version 0.0.4).
+
+        :rtype: str
+        """
+        def labels_text(labels: Iterable[Tuple[str, str]]) -> str:
+            labels = list(labels)
+            if not labels:
+                return ""
+            escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                       for name, value in labels)
+            return "{" + ",".join(escaped) + "}"
+
+        lines: List[str] = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{labels_text(labels)} {value:g}")
+            for name in sorted({name for name, _ in self.gauges}):
+                lines.append(f"# TYPE {name} gauge")
+                for (metric, labels), value in sorted(self.gauges.items()):
+                    if metric == name:
+                        lines.append(f"{name}{labels_text(labels)} {value:.15g}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        bucket = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{name}_bucket{labels_text(labels + (('le', bucket),))} {cumulative}")
+                    lines.append(f"{name}_sum{labels_text(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{labels_text(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(port: int, registry: Optional[MetricsRegistry] = None) -> ThreadingHTTPServer:
+    """
+    Serve ``/metrics`` for Prometheus scraping on a daemon thread.
+
+    :param port: The port to listen on (all interfaces).
+    :type port: int
+    :param registry: The registry to expose, defaulting to :func:`get_registry`.
+    :type registry: Optional[MetricsRegistry]
+    :rtype: ThreadingHTTPServer
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = (registry or get_registry()).prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    threading.Thread(target=server.serve_forever, name="control-metrics", daemon=True).start()
+    return server
+
+
+_registry: Optional[MetricsRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> MetricsRegistry:
+    """
+    The process-wide registry; started with ``$CONTROL_METRICS_PORT`` set, it is also served
+    over HTTP.
+
+    :rtype: MetricsRegistry
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+            if os.environ.get("CONTROL_METRICS_PORT"):
+                serve_metrics(int(os.environ["CONTROL_METRICS_PORT"]), _registry)
+        return _registry
+
+
+def stage_table(records: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Per-stage aggregate over assessment records (see :func:`record_assessment`), sorted by
+    cost: where the time and the spend go.
+
+    :param records: Assessment records, e.g. read back from the JSON-lines export.
+    :type records: Iterable[Dict[str, Any]]
+    :return: One row per stage with calls, cache hits, coalesced calls, errors, retries, mean
+             and 95th percentile wall time, mean time to first token, token totals, cost and
+             cost share.
+    :rtype: List[Dict[str, Any]]
+    """
+    stages: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        for stage, metrics in record.get("stages", {}).items():
+            row = stages.setdefault(stage, {"stage": stage, "model": metrics.get("model"), "seconds": [],
+                                            "first_token": [], "calls": 0, "cache_hits": 0, "coalesced": 0,
+                                            "errors": 0, "retries": 0, "throttled_seconds": 0.0, "input_tokens": 0,
+                                            "cached_tokens": 0, "output_tokens": 0, "reasoning_tokens": 0,
+                                            "cost_usd": 0.0})
+            row["seconds"].append(metrics["wall_seconds"])
+            if metrics.get("time_to_first_token") is not None:
+                row["first_token"].append(metrics["time_to_first_token"])
+            for key in ("calls", "cache_hits", "coalesced", "errors", "retries", "throttled_seconds",
+                        "input_tokens", "cached_tokens", "output_tokens", "reasoning_tokens", "cost_usd"):
+                row[key] += metrics.get(key, 0)
+
+    total_cost = sum(row["cost_usd"] for row in stages.values())
+    table = []
+    for row in stages.values():
+        seconds = sorted(row.pop("seconds"))
+        first_token = row.pop("first_token")
+        row["mean_seconds"] = sum(seconds) / len(seconds)
+        row["p95_seconds"] = seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))]
+        row["mean_time_to_first_token"] = sum(first_token) / len(first_token) if first_token else None
+        row["cost_share"] = row["cost_usd"] / total_cost if total_cost else 0.0
+        table.append(row)
+    return sorted(table, key=lambda row: row["cost_usd"], reverse=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Summarise exported assessment metrics per stage.")
+    parser.add_argument("command", choices=("summarize",))
+    parser.add_argument("path", help="JSON-lines file written via CONTROL_METRICS_JSONL")
+    args = parser.parse_args()
+
+    from tabulate import tabulate
+    with open(args.path, encoding="utf-8") as handle:
+        records = [json.loads(line) for line in handle if line.strip()]
+    print(f"{len(records)} assessments, {sum(record['cost_usd'] for record in records):.4f} USD, "
+          f"{sum(record['wall_seconds'] for record in records) / max(1, len(records)):.1f} s mean wall time")
+    print(tabulate(stage_table(records), headers="keys", floatfmt=".4g"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import (Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, Mapping, NamedTuple, Optional,
+                    Sequence, Tuple)
+from src.control_cancellation import CancelToken, Cancelled
+from src.control_clients import get_background_loop
+from src.control_metrics import record_assessment
+from src.control_routing import stage_route
+from src.control_classification import (CLASSIFICATION_CONTRACT, CLASSIFICATION_LLM, CLASSIFICATION_PROMPT, classify,
+                                        aclassify, astream_classify)
+from src.control_summary import SUMMARY_CONTRACT, SUMMARY_LLM, SUMMARY_PROMPT, summary, asummary, astream_summary
+from src.control_risks import RISK_CONTRACT, RISK_LLM, RISK_PROMPT, risks, arisks, astream_risks
+from src.control_dependencies import (DEPENDENCIES_CONTRACT, DEPENDENCIES_LLM, DEPENDENCIES_PROMPT, dependencies,
+                                      adependencies, astream_dependencies)
+from src.control_gaps import GAPS_CONTRACT, GAPS_LLM, GAPS_PROMPT, gaps, agaps, astream_gaps
+from src.control_industry_practices import (INDUSTRY_PRACTICES_CONTRACT, INDUSTRY_PRACTICES_LLM,
+                                            INDUSTRY_PRACTICES_PROMPT, industry_practices, aindustry_practices,
+                                            astream_industry_practices)
+from src.control_score import SCORE_CONTRACT, SCORE_LLM, SCORE_PROMPT, score, ascore, astream_score
+from src.control_score_reasoning import (REASONING_SCORE_CONTRACT, REASONING_SCORE_LLM, REASONING_SCORE_PROMPT,
+                                         score_reasoning, ascore_reasoning, astream_score_reasoning)
+from src.control_sections import SECTIONS_CONTRACT, SECTIONS_LLM, SECTIONS_PROMPT, SECTIONS_SCHEMA, sections, asections
+from src.control_score_combined import (COMBINED_SCORE_CONTRACT, COMBINED_SCORE_LLM, COMBINED_SCORE_PROMPT,
+                                        COMBINED_SCORE_SCHEMA, score_with_reasoning, ascore_with_reasoning)
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A node of the assessment stage graph.
+
+    :ivar name: Unique stage name.
+    :ivar title: Human-readable section title used by the UIs.
+    :ivar inputs: State keys the stage reads; the stage starts once all of them are available.
+    :ivar outputs: State keys the stage writes.
+    :ivar run: Synchronous stage function ``state -> state``.
+    :ivar arun: Asynchronous stage function ``state -> state``.
+    :ivar astream: Streaming stage function yielding text chunks of its single output, if any.
+    :ivar version: What the stage's answer depends on besides its inputs: its prompt, model
+                   settings, output contract and response schema (see :func:`stage_fingerprint`).
+    """
+    name: str
+    title: str
+    inputs: Tuple[str, ...]
+    outputs: Tuple[str, ...]
+    run: Callable[[Dict[str, Any]], Dict[str, Any]]
+    arun: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+    astream: Optional[Callable[[Dict[str, Any]], AsyncIterator[str]]] = None
+    version: Tuple[Any, ...] = ()
+
+
+class StageEvent(NamedTuple):
+    """
+    Progress of a streamed pipeline run: a text chunk of ``stage`` or, when ``token`` is
+    None, the completion of ``stage``.
+    """
+    stage: Stage
+    token: Optional[str]
+
+
+# Sections of an assessment in display order: (title, state key)
+SECTIONS: Tuple[Tuple[str, str], ...] = (
+    ("Classification", "control_classification"),
+    ("Summary", "control_summary"),
+    ("Risks", "control_risk"),
+    ("Dependencies", "control_dependencies"),
+    ("Gaps", "control_gaps"),
+    ("Industry Practices", "control_industry_practices"),
+    ("Score", "control_score"),
+    ("Score Reasoning", "control_score_reasoning"),
+)
+
+# The eight stages in display order. Only score_reasoning depends on another stage.
+STAGES: Tuple[Stage, ...] = (
+    Stage("classify", "Classification", ("original_input",), ("control_classification",),
+          classify, aclassify, astream_classify,
+          (CLASSIFICATION_PROMPT, CLASSIFICATION_LLM, CLASSIFICATION_CONTRACT)),
+    Stage("summary", "Summary", ("original_input",), ("control_summary",),
+          summary, asummary, astream_summary, (SUMMARY_PROMPT, SUMMARY_LLM, SUMMARY_CONTRACT)),
+    Stage("risks", "Risks", ("original_input",), ("control_risk",),
+          risks, arisks, astream_risks, (RISK_PROMPT, RISK_LLM, RISK_CONTRACT)),
+    Stage("dependencies", "Dependencies", ("original_input",), ("control_dependencies",),
+          dependencies, adependencies, astream_dependencies,
+          (DEPENDENCIES_PROMPT, DEPENDENCIES_LLM, DEPENDENCIES_CONTRACT)),
+    Stage("gaps", "Gaps", ("original_input",), ("control_gaps",),
+          gaps, agaps, astream_gaps, (GAPS_PROMPT, GAPS_LLM, GAPS_CONTRACT)),
+    Stage("industry_practices", "Industry Practices", ("original_input",), ("control_industry_practices",),
+          industry_practices, aindustry_practices, astream_industry_practices,
+          (INDUSTRY_PRACTICES_PROMPT, INDUSTRY_PRACTICES_LLM, INDUSTRY_PRACTICES_CONTRACT)),
+    Stage("score", "Score", ("original_input",), ("control_score",),
+          score, ascore, astream_score, (SCORE_PROMPT, SCORE_LLM, SCORE_CONTRACT)),
+    Stage("score_reasoning", "Score Reasoning", ("original_input", "control_score"), ("control_score_reasoning",),
+          score_reasoning, ascore_reasoning, astream_score_reasoning,
+          (REASONING_SCORE_PROMPT, REASONING_SCORE_LLM, REASONING_SCORE_CONTRACT)),
+)
+
+
+# Seconds a synchronous caller waits for the next event before calling its on_idle hook
+IDLE_INTERVAL = 0.5
+
+# Stages replaced by the fused "sections" stage
+FUSED_SECTION_STAGES = ("risks", "dependencies", "gaps", "industry_practices")
+
+SECTIONS_STAGE = Stage("sections", "Risks, Dependencies, Gaps and Industry Practices", ("original_input",),
+                       ("control_risk", "control_dependencies", "control_gaps", "control_industry_practices"),
+                       sections, asections, version=(SECTIONS_PROMPT, SECTIONS_LLM, SECTIONS_CONTRACT, SECTIONS_SCHEMA))
+
+
+# Stages replaced by the combined "score_with_reasoning" stage
+COMBINED_SCORE_STAGES = ("score", "score_reasoning")
+
+SCORE_WITH_REASONING_STAGE = Stage("score_with_reasoning", "Score and Score Reasoning", ("original_input",),
+                                   ("control_score", "control_score_reasoning"),
+                                   score_with_reasoning, ascore_with_reasoning,
+                                   version=(COMBINED_SCORE_PROMPT, COMBINED_SCORE_LLM, COMBINED_SCORE_CONTRACT,
+                                            COMBINED_SCORE_SCHEMA))
+
+
+def pipeline_stages(sections_mode: Optional[str] = None, score_mode: Optional[str] = None) -> Tuple[Stage, ...]:
+    """
+    The stage graph for the configured pipeline mode.
+
+    :param sections_mode: "per_stage" runs risks, dependencies, gaps and industry_practices
+                          as four calls; "fused" answers them in one structured-output call.
+                          Defaults to ``$CONTROL_SECTIONS_MODE`` or "per_stage".
+    :type sections_mode: Optional[str]
+    :param score_mode: "two_step" runs score, then score_reasoning; "combined" returns both
+                       from one structured-output call, removing the only serial dependency.
+                       Defaults to ``$CONTROL_SCORE_MODE`` or "two_step".
+    :type score_mode: Optional[str]
+    :return: The stages to run.
+    :rtype: Tuple[Stage, ...]
+    :raises ValueError: On an unknown mode.
+    """
+    sections_mode = sections_mode or os.environ.get("CONTROL_SECTIONS_MODE", "per_stage")
+    score_mode = score_mode or os.environ.get("CONTROL_SCORE_MODE", "two_step")
+    if sections_mode not in ("per_stage", "fused"):
+        raise ValueError(f"Unknown sections mode {sections_mode!r}; expected 'per_stage' or 'fused'")
+    if score_mode not in ("two_step", "combined"):
+        raise ValueError(f"Unknown score mode {score_mode!r}; expected 'two_step' or 'combined'")
+
+    stages = list(STAGES)
+    if sections_mode == "fused":
+        stages = [stage for stage in stages if stage.name not in FUSED_SECTION_STAGES]
+        stages.insert(2, SECTIONS_STAGE)
+    if score_mode == "combined":
+        stages = [stage for stage in stages if stage.name not in COMBINED_SCORE_STAGES]
+        stages.append(SCORE_WITH_REASONING_STAGE)
+    return tuple(stages)
+
+
+def stage_fingerprint(stage: Stage, state: Mapping[str, Any]) -> str:
+    """
+    Hash of everything a stage's answer depends on: its version (prompt, model settings,
+    output contract), the settings its routing rule for this control overrides, and the
+    values of the inputs it consumes, e.g. "original_input" and "control_score" for
+    score_reasoning. Whitespace in the inputs is normalised, so reflowing a description
+    does not change it.
+
+    :param stage: The stage.
+    :type stage: Stage
+    :param state: The assessment state, with the stage's inputs.
+    :type state: Mapping[str, Any]
+    :return: Hex SHA-256 digest.
+    :rtype: str
+    """
+    inputs = {key: " ".join(value.split()) if isinstance(value, str) else value
+              for key, value in ((key, state.get(key)) for key in stage.inputs)}
+    route = stage_route(stage.name, state)
+    payload = json.dumps([stage.name, stage.version, route and route["use"], inputs],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def note_fingerprint(stage: Stage, state: Dict[str, Any]) -> None:
+    """
+    Record the fingerprint of a stage run in ``state["fingerprints"]``, saved with the
+    assessment for incremental re-assessment (see :mod:`src.control_incremental`).
+    """
+    state.setdefault("fingerprints", {})[stage.name] = stage_fingerprint(stage, state)
+
+
+def run_pipeline(state: Dict[str, Any], stages: Optional[Sequence[Stage]] = None) -> Dict[str, Any]:
+    """
+    Run the stages one after another in display order.
+
+    :param state: The assessment state, with at least "openai_api_key" and "original_input".
+    :type state: Dict[str, Any]
+    :param stages: The stages to run, defaulting to :func:`pipeline_stages`; each stage's inputs
+                   must be produced by an earlier stage.
+    :type stages: Optional[Sequence[Stage]]
+    :return: The state with every stage output filled in.
+    :rtype: Dict[str, Any]
+    :raises Cancelled: If ``state["cancel_token"]`` is cancelled; checked before each stage.
+    """
+    started = time.perf_counter()
+    status = "failed"
+    token: Optional[CancelToken] = state.get("cancel_token")
+    stages = list(stages or pipeline_stages())
+    try:
+        for index, stage in enumerate(stages):
+            if token is not None and token.cancelled:
+                _record_cancellation(state, token.reason, [], stages[index:])
+                token.raise_if_cancelled()
+            note_fingerprint(stage, state)
+            state = stage.run(state)
+        status = "completed"
+    except Cancelled:
+        status = "cancelled"
+        raise
+    finally:
+        record_assessment(state, time.perf_counter() - started, status)
+    return state
+
+
+async def astream_pipeline(state: Dict[str, Any], stages: Optional[Sequence[Stage]] = None,
+                          stream: bool = True) -> AsyncIterator[StageEvent]:
+    """
+    Run the stage graph concurrently, yielding text chunks as they are generated and each
+    stage as soon as it completes.
+
+    A stage is started as soon as all of its inputs are present in the state, so the
+    independent stages run at the same time and dependent stages (score_reasoning) start
+    the moment their inputs are produced. Stages write their outputs into ``state``
+    in place. If a stage fails, the remaining stages are cancelled and the error is raised.
+    The run's metrics are closed with :func:`src.control_metrics.record_assessment`.
+
+    A cancellation token in ``state["cancel_token"]`` (see :mod:`src.control_cancellation`)
+    is checked before stages are started; when it is cancelled, from any thread, the stage
+    calls in flight are aborted at once and :class:`Cancelled` is raised.
+
+    :param state: The assessment state, with at least "openai_api_key" and "original_input".
+    :type state: Dict[str, Any]
+    :param stages: The stages to run, defaulting to :func:`pipeline_stages`.
+    :type stages: Optional[Sequence[Stage]]
+    :param stream: Whether to stream the stages that support it; structured-output stages
+                   and ``stream=False`` runs only report completions.
+    :type stream: bool
+    :return: An async iterator over token and completion events.
+    :rtype: AsyncIterator[StageEvent]
+    :raises ValueError: If some stages can never start because their inputs are never produced.
+    :raises Cancelled: If the cancellation token is cancelled.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    available = set(state)
+    pending = list(stages or pipeline_stages())
+    running: Dict[asyncio.Future, Stage] = {}
+    started = time.perf_counter()
+    status = "failed"
+
+    # Wake the run from the cancelling thread; it then cancels the stages in flight
+    token: Optional[CancelToken] = state.get("cancel_token")
+    loop = asyncio.get_running_loop()
+    forget = token.on_cancel(lambda reason: loop.call_soon_threadsafe(events.put_nowait, (None, None))) \
+        if token is not None else (lambda: None)
+
+    async def run(stage: Stage) -> None:
+        if stream and stage.astream is not None:
+            async for token in stage.astream(state):
+                events.put_nowait((StageEvent(stage, token), None))
+        else:
+            await stage.arun(state)
+
+    try:
+        while pending or running:
+            if token is not None and token.cancelled:
+                _record_cancellation(state, token.reason, running.values(), pending)
+                token.raise_if_cancelled()
+            for stage in list(pending):
+                if all(key in available for key in stage.inputs):
+                    pending.remove(stage)
+                    note_fingerprint(stage, state)
+                    task = asyncio.ensure_future(run(stage))
+                    task.add_done_callback(lambda done, stage=stage: events.put_nowait((StageEvent(stage, None), done)))
+                    running[task] = stage
+            if not running:
+                names = ", ".join(stage.name for stage in pending)
+                raise ValueError(f"Stage inputs are never produced for: {names}")
+
+            event, task = await events.get()
+            if event is None:
+                # Cancelled
+                continue
+            if task is not None:
+                running.pop(task)
+                task.result()
+                available.update(event.stage.outputs)
+            yield event
+        status = "completed"
+    except Cancelled:
+        status = "cancelled"
+        raise
+    except (GeneratorExit, asyncio.CancelledError):
+        status = "cancelled"
+        _record_cancellation(state, "closed", running.values(), pending)
+        raise
+    finally:
+        forget()
+        for task in running:
+            task.cancel()
+        if running:
+            # Let the stage calls record their cancellation before the run is closed
+            await asyncio.wait(list(running))
+        record_assessment(state, time.perf_counter() - started, status)
+
+
+def _record_cancellation(state: Dict[str, Any], reason: str, interrupted: Iterable[Stage],
+                         skipped: Iterable[Stage]) -> None:
+    # Reported with the run's metrics, see src.control_metrics.record_assessment
+    state["cancellation"] = {"reason": reason, "interrupted": [stage.name for stage in interrupted],
+                             "skipped": [stage.name for stage in skipped]}
+
+
+async def arun_pipeline(state: Dict[str, Any], stages: Optional[Sequence[Stage]] = None) -> AsyncIterator[Stage]:
+    """
+    Run the stage graph concurrently (see :func:`astream_pipeline`), yielding each stage as
+    soon as it completes.
+
+    :param state: The assessment state, with at least "openai_api_key" and "original_input".
+    :type state: Dict[str, Any]
+    :param stages: The stages to run, defaulting to :func:`pipeline_stages`.
+    :type stages: Optional[Sequence[Stage]]
+    :return: An async iterator over the completed stages, in completion order.
+    :rtype: AsyncIterator[Stage]
+    """
+    events = astream_pipeline(state, stages, stream=False)
+    try:
+        async for event in events:
+            yield event.stage
+    finally:
+        await events.aclose()
+
+
+def _iterate(events: AsyncIterator[Any], token: CancelToken,
+             on_idle: Optional[Callable[[], None]] = None) -> Iterator[Any]:
+    # Drive an async iterator on the shared background loop from a synchronous caller
+    loop = get_background_loop()
+    step = None
+    try:
+        while True:
+            step = asyncio.run_coroutine_threadsafe(events.__anext__(), loop)
+            try:
+                while True:
+                    try:
+                        event = step.result(timeout=IDLE_INTERVAL if on_idle is not None else None)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        on_idle()
+            except StopAsyncIteration:
+                step = None
+                break
+            step = None
+            yield event
+    finally:
+        if step is not None and not step.done():
+            # Interrupted while waiting, e.g. by on_idle: the cancelled run ends the step
+            token.cancel("interrupted")
+            concurrent.futures.wait([step])
+        asyncio.run_coroutine_threadsafe(events.aclose(), loop).result()
+
+
+def iter_pipeline(state: Dict[str, Any], stages: Optional[Sequence[Stage]] = None,
+                  on_idle: Optional[Callable[[], None]] = None) -> Iterator[Stage]:
+    """
+    Synchronous view of :func:`arun_pipeline` for callers without an event loop, such as
+    the Streamlit script thread. The stages run on the shared background loop, so they keep
+    progressing while the caller renders each completed stage.
+
+    :param state: The assessment state, with at least "openai_api_key" and "original_input".
+                  Gets a "cancel_token" if it has none (see :mod:`src.control_cancellation`).
+    :type state: Dict[str, Any]
+    :param stages: The stages to run, defaulting to :func:`pipeline_stages`.
+    :type stages: Optional[Sequence[Stage]]
+    :param on_idle: Called every ``IDLE_INTERVAL`` seconds without an event. If it raises,
+                    e.g. because Streamlit interrupts the script run, the run is cancelled.
+    :type on_idle: Optional[Callable[[], None]]
+    :return: An iterator over the completed stages, in completion order.
+    :rtype: Iterator[Stage]
+    """
+    token = state.setdefault("cancel_token", CancelToken())
+    return _iterate(arun_pipeline(state, stages), token, on_idle)
+
+
+def iter_pipeline_stream(state: Dict[str, Any], stages: Optional[Sequence[Stage]] = None,
+                         on_idle: Optional[Callable[[], None]] = None) -> Iterator[StageEvent]:
+    """
+    Synchronous view of :func:`astream_pipeline`, for rendering tokens as they arrive.
+
+    :param state: The assessment state, with at least "openai_api_key" and "original_input".
+                  Gets a "cancel_token" if it has none (see :mod:`src.control_cancellation`).
+    :type state: Dict[str, Any]
+    :param stages: The stages to run, defaulting to :func:`pipeline_stages`.
+    :type stages: Optional[Sequence[Stage]]
+    :param on_idle: See :func:`iter_pipeline`.
+    :type on_idle: Optional[Callable[[], None]]
+    :return: An iterator over token and completion events.
+    :rtype: Iterator[StageEvent]
+    """
+    token = state.setdefault("cancel_token", CancelToken())
+    return _iterate(astream_pipeline(state, stages), token, on_idle)
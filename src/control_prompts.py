@@ -0,0 +1,98 @@
+"""
+Static prompt parts shared by the assessment stages.
+
+Every stage prompt starts with the same system prefix (context, control categories and
+scoring rubric), followed by the stage's own instructions, with the per-control input in
+a final human message. Keeping the long static part first and identical lets the
+provider's prompt prefix cache serve it on repeated calls; nothing that varies per
+control may appear before it.
+"""
+from typing import Tuple
+
+# A chat prompt as (role, template) messages, as accepted by ChatPromptTemplate
+Prompt = Tuple[Tuple[str, str], ...]
+
+# Labels a control is classified into
+CLASSIFICATION_LABELS = (
+    "Validation",
+    "Duplicates",
+    "Sanctions",
+    "Fraud",
+    "Insufficient Funds",
+    "High Dollar Escalation",
+    "Completed Fields",
+    "Travel Rules",
+)
+
+# Allowed scores
+SCORE_VALUES = ("Low", "Medium", "High")
+
+# (Category, Sub-Category) rows of the rubric
+RUBRIC_ROWS = (
+    ("Control Design & Risk Coverage", "Risk Coverage"),
+    ("Control Design & Risk Coverage", "Control Design"),
+    ("Control Design & Risk Coverage", "Documentation"),
+    ("Control Design & Risk Coverage", "Transaction Coverage"),
+    ("Implementation & Operation", "Execution"),
+    ("Implementation & Operation", "Ownership"),
+    ("Implementation & Operation", "Dependencies"),
+    ("Monitoring & Reporting", "Testing"),
+    ("Monitoring & Reporting", "Reporting and KPIs"),
+    ("Monitoring & Reporting", "Governance"),
+)
+
+RUBRIC = '''| **Category**                     | **Sub-Category**       | **Low (Below standard¹)** | **Medium (Industry standard²)** | **High (Best practice³)** |
+|----------------------------------|------------------------|-----------------------------|----------------------------------|-----------------------------|
+| **Control Design & Risk Coverage** | **Risk Coverage**       | Control does not address a risk breakpoint | Control addresses a risk breakpoint | Control addresses a risk breakpoint tied to a specific process |
+|                                  | **Control Design**     | Control design lags industry standards | Control design aligns with industry standards | Control design exceeds industry standards |
+|                                  | **Documentation**      | Control documentation is incomplete or non-existent | Documentation exists but lacks depth | Control documentation exists and is comprehensive |
+|                                  | **Transaction Coverage** | Control does not cover all applicable transactions | Control covers all applicable transactions | N/A |
+| **Implementation & Operation**   | **Execution**          | Control is not implemented or executed as expected | Control is generally followed, but there are gaps at times | Control is consistently executed as expected |
+|                                  | **Ownership**          | No clear owner accountable | Clear owner accountable for control | N/A |
+|                                  | **Dependencies**       | Key system integrations (i.e., control dependencies) are missing or broken | Key system integrations (i.e., control dependencies) are partially working | Key system integrations (i.e., control dependencies) are working fully, ensuring control effectiveness |
+| **Monitoring & Reporting**       | **Testing**            | No regular testing or evidence that the control is working as intended | Periodic testing occurs | Suite of controls for a risk breakpoint tested for effectiveness |
+|                                  | **Reporting and KPIs** | No reporting to track control performance | Some reporting to track control performance | Reporting is timely and comprehensive, enabling self-identification of issues |
+|                                  | **Governance**         | No tiered governance mechanism in place | Ad hoc tiered governance mechanism in place to drive continuous improvement | Consistent tiered governance mechanism in place to drive continuous improvement |'''
+
+SHARED_PREFIX = '''
+    # Context
+    - This is to analyze the controls placed on a banking payment system
+    - The input is the description of a control for a financial payment system
+
+    # Control Categories
+    - Validation: Controls that are used to validate the payment account information with OVS
+    - Duplicates: Controls that checks if a payment is a duplicate payment
+    - Sanctions: Controls that checks if a payment is violation a sanction
+    - Fraud: Controls that checks if a payment is fraudulent
+    - Insufficient Funds: Controls that checks if a payment is from an account with insufficient funds
+    - High Dollar Escalation: Controls that checks if a payment is greater than $20 million
+    - Completed Fields: Controls that checks if a payment has all fields completed
+    - Travel Rules: Controls that checks if a payment is compliant with the Travel Rules
+
+    # Rubric
+    - Each control is rated on a three-point maturity scale (Low/Medium/High) with the following rubric
+    - Following is the rubric:
+
+''' + RUBRIC + '''
+
+'''
+
+# Per-control input of most stages
+CONTROL_INPUT = '''
+    # Control
+    {control}
+    '''
+
+
+def stage_prompt(instructions: str, input_template: str = CONTROL_INPUT) -> Prompt:
+    """
+    Lay out a stage prompt as shared prefix + stage instructions, then the per-control input.
+
+    :param instructions: The stage-specific instructions; must not contain placeholders.
+    :type instructions: str
+    :param input_template: The per-control part, with the ``{placeholders}`` of the stage inputs.
+    :type input_template: str
+    :return: The system and human messages of the stage.
+    :rtype: Prompt
+    """
+    return (("system", SHARED_PREFIX + instructions), ("human", input_template))
@@ -0,0 +1,515 @@
+"""
+Process-wide admission control and retries for the OpenAI calls of all stages.
+
+Every chain call of :mod:`src.control_llm` is admitted by the :class:`RateLimitScheduler`
+before it is sent. The scheduler keeps two token buckets per model, requests per minute
+and tokens per minute, charged with a tiktoken estimate of the prompt plus the expected
+completion. The buckets are resized and resynchronised from the ``x-ratelimit-*`` headers
+of every response, so they converge on the account's real quota. Waiting calls are admitted
+in priority order: interactive (Streamlit) calls before batch work.
+
+The OpenAI client's own retries are turned off (``max_retries=0``). Instead the scheduler
+retries 429, 5xx, timeout and connection errors with jittered exponential backoff, honouring
+``retry-after`` headers, and a 429 pauses admission for the whole model rather than letting
+every in-flight caller retry on its own.
+
+Configuration (environment variables):
+
+- ``CONTROL_RATE_LIMITS``: JSON ``{"model": {"rpm": 500, "tpm": 200000}}`` starting limits, used
+  until the API reports the real ones (default ``DEFAULT_LIMITS`` for every model)
+- ``CONTROL_MAX_RETRIES``: retries after the first attempt (default 6)
+- ``CONTROL_OUTPUT_TOKEN_ESTIMATE``: completion tokens charged per call when the stage sets
+  no ``max_completion_tokens`` (default 1000)
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+from src.control_prompts import Prompt
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+# Starting limits of a model until its response headers report the real ones
+DEFAULT_LIMITS = {"rpm": 500, "tpm": 200_000}
+
+# Characters per token when no tiktoken encoding is available (e.g. offline)
+CHARS_PER_TOKEN = 4
+
+# Model whose response headers the current call should feed back, set per call
+_current_model: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("control_rate_limit_model", default=None)
+
+_encoding: Any = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding() -> Any:
+    # tiktoken downloads its encodings on first use; fall back to a character heuristic
+    # when that is impossible (offline hosts), and do not retry on every call
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                _encoding = False
+        return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """
+    Tokens of ``text`` in the o200k encoding of the gpt-4o and o-series models, or an
+    estimate from its length where the encoding is not available.
+
+    :rtype: int
+    """
+    encoding = _get_encoding()
+    return len(encoding.encode(text, disallowed_special=())) if encoding else len(text) // CHARS_PER_TOKEN
+
+
+def estimate_tokens(prompt: Prompt, inputs: Mapping[str, Any]) -> int:
+    """
+    Estimated prompt tokens of a stage call: the message templates plus the input values.
+
+    :param prompt: The chat messages of the stage.
+    :type prompt: Prompt
+    :param inputs: The values of the prompt placeholders.
+    :type inputs: Mapping[str, Any]
+    :rtype: int
+    """
+    text = "".join(content for _, content in prompt) + "".join(str(value) for value in inputs.values())
+    # Plus the per-message framing
+    return count_tokens(text) + 4 * len(prompt)
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """
+    Seconds of a rate-limit reset header such as "1s", "6m0s", "20ms" or "0.5".
+
+    :rtype: Optional[float]
+    """
+    total = 0.0
+    matched = False
+    for number, unit in re.findall(r"([\d.]+)(ms|s|m|h)?", value or ""):
+        matched = True
+        total += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "": 1}[unit]
+    return total if matched else None
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    The server's requested delay of a failed call, from ``retry-after-ms``/``retry-after``.
+
+    :rtype: Optional[float]
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether a failed call may succeed when repeated: rate limits, server errors, timeouts
+    and connection failures.
+
+    :rtype: bool
+    """
+    import openai
+    if isinstance(error, (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+class _Bucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait(self, amount: float, now: float) -> float:
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) * 60 / self.capacity
+
+    def resize(self, per_minute: float) -> None:
+        if per_minute > 0 and per_minute != self.capacity:
+            self.level = self.level * per_minute / self.capacity
+            self.capacity = float(per_minute)
+
+
+class _ModelLimiter:
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = _Bucket(rpm)
+        self.tokens = _Bucket(tpm)
+        self.paused_until = 0.0
+        # Waiting calls: (priority, arrival)
+        self.waiting: List[Tuple[int, int]] = []
+
+
+class Ticket:
+    """
+    An admitted (or waiting) call.
+
+    :ivar waited: Seconds spent waiting for admission.
+    """
+
+    def __init__(self, model: str, tokens: int, priority: int, arrival: int):
+        self.model = model
+        self.tokens = tokens
+        self.key = (priority, arrival)
+        self.waited = 0.0
+
+
+class RateLimitScheduler:
+    """
+    Per-model request and token buckets shared by every thread and event loop of the process.
+
+    :param limits: Starting ``{"model": {"rpm": .., "tpm": ..}}`` limits.
+    :param max_retries: Retries after the first attempt of a call.
+    :param base_delay: Backoff of the first retry, doubled per attempt (full jitter).
+    :param max_delay: Upper bound of a single backoff.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, float]]] = None, max_retries: int = 6,
+                 base_delay: float = 0.5, max_delay: float = 60.0):
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limiters: Dict[str, _ModelLimiter] = {}
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self.stats = {"admitted": 0, "throttled_seconds": 0.0, "retries": 0, "rate_limited": 0}
+
+    def _limiter(self, model: str) -> _ModelLimiter:
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limits = {**DEFAULT_LIMITS, **self.limits.get(model, {})}
+            limiter = self._limiters[model] = _ModelLimiter(limits["rpm"], limits["tpm"])
+        return limiter
+
+    def _enqueue(self, model: str, tokens: int, priority: str, arrival: Optional[int]) -> Ticket:
+        with self._lock:
+            ticket = Ticket(model, tokens, PRIORITIES.get(priority, 0),
+                            next(self._arrivals) if arrival is None else arrival)
+            heapq.heappush(self._limiter(model).waiting, ticket.key)
+            return ticket
+
+    def _try_admit(self, ticket: Ticket) -> float:
+        # Admit the ticket (-> 0.0) or return how long to wait before trying again.
+        # Must be called with the lock held.
+        limiter = self._limiter(ticket.model)
+        now = time.monotonic()
+        if limiter.paused_until > now:
+            return limiter.paused_until - now
+        wait = max(limiter.requests.wait(1, now), limiter.tokens.wait(ticket.tokens, now))
+        if limiter.waiting[0] != ticket.key:
+            # Calls ahead in line (higher priority or earlier) are admitted first
+            return max(wait, 0.01)
+        if wait > 0:
+            return wait
+        heapq.heappop(limiter.waiting)
+        limiter.requests.level -= 1
+        limiter.tokens.level -= min(ticket.tokens, limiter.tokens.capacity)
+        self.stats["admitted"] += 1
+        self._changed.notify_all()
+        return 0.0
+
+    def _abandon(self, ticket: Ticket) -> None:
+        with self._lock:
+            waiting = self._limiter(ticket.model).waiting
+            if ticket.key in waiting:
+                waiting.remove(ticket.key)
+                heapq.heapify(waiting)
+                self._changed.notify_all()
+
+    def acquire(self, model: str, tokens: int, priority: str = "interactive", arrival: Optional[int] = None) -> Ticket:
+        """
+        Block until a call of ``tokens`` estimated tokens to ``model`` may be sent.
+
+        :param model: The model name.
+        :type model: str
+        :param tokens: Estimated prompt plus completion tokens.
+        :type tokens: int
+        :param priority: "interactive" or "batch".
+        :type priority: str
+        :param arrival: The place in line of an earlier attempt, so that a retry keeps it.
+        :type arrival: Optional[int]
+        :rtype: Ticket
+        """
+        ticket = self._enqueue(model, tokens, priority, arrival)
+        started = time.monotonic()
+        try:
+            with self._changed:
+                while True:
+                    wait = self._try_admit(ticket)
+                    if wait == 0:
+                        break
+                    self._changed.wait(min(wait, 1.0))
+        except BaseException:
+            self._abandon(ticket)
+            raise
+        ticket.waited = time.monotonic() - started
+        self.stats["throttled_seconds"] += ticket.waited
+        return ticket
+
+    async def aacquire(self, model: str, tokens: int, priority: str = "interactive",
+                       arrival: Optional[int] = None) -> Ticket:
+        """
+        Async variant of :meth:`acquire`; waits without blocking the event loop.
+        """
+        ticket = self._enqueue(model, tokens, priority, arrival)
+        started = time.monotonic()
+        try:
+            while True:
+                with self._lock:
+                    wait = self._try_admit(ticket)
+                if wait == 0:
+                    break
+                await asyncio.sleep(min(wait, 0.25))
+        except BaseException:
+            self._abandon(ticket)
+            raise
+        ticket.waited = time.monotonic() - started
+        self.stats["throttled_seconds"] += ticket.waited
+        return ticket
+
+    def update_from_headers(self, model: str, headers: Mapping[str, str]) -> None:
+        """
+        Adopt the limits and remaining quota reported by the API in ``x-ratelimit-*`` headers.
+
+        :param model: The model the response belongs to.
+        :type model: str
+        :param headers: The HTTP response headers.
+        :type headers: Mapping[str, str]
+        """
+        with self._lock:
+            limiter = self._limiter(model)
+            now = time.monotonic()
+            for kind, bucket in (("requests", limiter.requests), ("tokens", limiter.tokens)):
+                try:
+                    bucket.resize(float(headers[f"x-ratelimit-limit-{kind}"]))
+                except (KeyError, ValueError):
+                    pass
+                try:
+                    remaining = float(headers[f"x-ratelimit-remaining-{kind}"])
+                except (KeyError, ValueError):
+                    continue
+                # The server's view wins when it has less quota left than we think
+                bucket.refill(now)
+                bucket.level = min(bucket.level, remaining)
+            self._changed.notify_all()
+
+    def pause(self, model: str, seconds: float) -> None:
+        """
+        Stop admitting calls to ``model`` for ``seconds`` (after a 429).
+        """
+        with self._lock:
+            limiter = self._limiter(model)
+            limiter.paused_until = max(limiter.paused_until, time.monotonic() + seconds)
+            self.stats["rate_limited"] += 1
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        """
+        Seconds to wait before retry number ``attempt`` (0-based) of a failed call: the
+        server's ``retry-after`` if given, else full-jitter exponential backoff.
+
+        :rtype: float
+        """
+        requested = retry_after(error)
+        if requested is not None:
+            return min(requested, self.max_delay) + random.uniform(0, self.base_delay / 10)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _should_retry(self, model: str, attempt: int, error: BaseException) -> Optional[float]:
+        # -> backoff seconds, or None to give up
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        delay = self.backoff(attempt, error)
+        if getattr(error, "status_code", None) == 429:
+            self.pause(model, delay)
+        with self._lock:
+            self.stats["retries"] += 1
+        return delay
+
+    def call(self, function: Callable[[], Any], model: str, tokens: int, priority: str = "interactive",
+             on_wait: Optional[Callable[[float], None]] = None) -> Any:
+        """
+        Run ``function`` (one API call) once admitted, retrying transient failures.
+
+        :param function: Makes the call.
+        :type function: Callable[[], Any]
+        :param model: The model name.
+        :type model: str
+        :param tokens: Estimated prompt plus completion tokens.
+        :type tokens: int
+        :param priority: "interactive" or "batch".
+        :type priority: str
+        :param on_wait: Called with the seconds spent waiting for admission and in backoff.
+        :type on_wait: Optional[Callable[[float], None]]
+        :return: The result of ``function``.
+        :raises openai.OpenAIError: When the call fails permanently or runs out of retries.
+        """
+        arrival = None
+        for attempt in itertools.count():
+            ticket = self.acquire(model, tokens, priority, arrival)
+            arrival = ticket.key[1]
+            if on_wait is not None:
+                on_wait(ticket.waited)
+            _current_model.set(model)
+            try:
+                return function()
+            except Exception as error:
+                delay = self._should_retry(model, attempt, error)
+                if delay is None:
+                    raise
+            finally:
+                _current_model.set(None)
+            time.sleep(delay)
+            if on_wait is not None:
+                on_wait(delay)
+
+    async def acall(self, function: Callable[[], Awaitable[Any]], model: str, tokens: int,
+                    priority: str = "interactive", on_wait: Optional[Callable[[float], None]] = None) -> Any:
+        """
+        Async variant of :meth:`call`; ``function`` returns the awaitable of one API call.
+        """
+        arrival = None
+        for attempt in itertools.count():
+            ticket = await self.aacquire(model, tokens, priority, arrival)
+            arrival = ticket.key[1]
+            if on_wait is not None:
+                on_wait(ticket.waited)
+            _current_model.set(model)
+            try:
+                return await function()
+            except Exception as error:
+                delay = self._should_retry(model, attempt, error)
+                if delay is None:
+                    raise
+            finally:
+                _current_model.set(None)
+            await asyncio.sleep(delay)
+            if on_wait is not None:
+                on_wait(delay)
+
+    def stream(self, function: Callable[[], Iterator[Any]], model: str, tokens: int, priority: str = "interactive",
+               on_wait: Optional[Callable[[float], None]] = None) -> Iterator[Any]:
+        """
+        Streaming variant of :meth:`call`: a call is only retried if it failed before its
+        first chunk, so no chunk is yielded twice.
+        """
+        arrival = None
+        for attempt in itertools.count():
+            ticket = self.acquire(model, tokens, priority, arrival)
+            arrival = ticket.key[1]
+            if on_wait is not None:
+                on_wait(ticket.waited)
+            started = False
+            _current_model.set(model)
+            try:
+                for chunk in function():
+                    started = True
+                    yield chunk
+                return
+            except Exception as error:
+                delay = None if started else self._should_retry(model, attempt, error)
+                if delay is None:
+                    raise
+            finally:
+                _current_model.set(None)
+            time.sleep(delay)
+            if on_wait is not None:
+                on_wait(delay)
+
+    async def astream(self, function: Callable[[], AsyncIterator[Any]], model: str, tokens: int,
+                      priority: str = "interactive",
+                      on_wait: Optional[Callable[[float], None]] = None) -> AsyncIterator[Any]:
+        """
+        Async variant of :meth:`stream`.
+        """
+        arrival = None
+        for attempt in itertools.count():
+            ticket = await self.aacquire(model, tokens, priority, arrival)
+            arrival = ticket.key[1]
+            if on_wait is not None:
+                on_wait(ticket.waited)
+            started = False
+            _current_model.set(model)
+            try:
+                async for chunk in function():
+                    started = True
+                    yield chunk
+                return
+            except Exception as error:
+                delay = None if started else self._should_retry(model, attempt, error)
+                if delay is None:
+                    raise
+            finally:
+                _current_model.set(None)
+            await asyncio.sleep(delay)
+            if on_wait is not None:
+                on_wait(delay)
+
+
+def record_headers(response: Any) -> None:
+    """
+    httpx response hook: feeds the rate-limit headers of every response to the scheduler.
+    """
+    model = _current_model.get()
+    if model is not None:
+        get_scheduler().update_from_headers(model, response.headers)
+
+
+async def arecord_headers(response: Any) -> None:
+    """
+    Async variant of :func:`record_headers` for ``httpx.AsyncClient``.
+    """
+    record_headers(response)
+
+
+def output_estimate(llm_settings: Mapping[str, Any]) -> int:
+    """
+    Completion tokens charged to the token bucket for a call with these settings.
+
+    :rtype: int
+    """
+    return int(llm_settings.get("max_completion_tokens") or llm_settings.get("max_tokens")
+               or os.environ.get("CONTROL_OUTPUT_TOKEN_ESTIMATE", 1000))
+
+
+_scheduler: Optional[RateLimitScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RateLimitScheduler:
+    """
+    The process-wide scheduler configured from the environment.
+
+    :rtype: RateLimitScheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RateLimitScheduler(json.loads(os.environ.get("CONTROL_RATE_LIMITS", "{}")),
+                                            int(os.environ.get("CONTROL_MAX_RETRIES", 6)))
+        return _scheduler
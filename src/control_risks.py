@@ -1,10 +1,22 @@
 import warnings
 import os
-from langchain import hub
-from typing import Any, List, Dict
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from typing import Any, AsyncIterator, Dict, Iterator, List
+from src.control_prompts import stage_prompt
+from src.control_contracts import OutputContract
+from src.control_llm import run_chain, arun_chain, stream_stage, astream_stage
+
+
+RISK_PROMPT = stage_prompt('''
+    # Instructions
+    - What are the main risks that this control is solving for?
+    - Provide answer in 3-6 succinct bullet points.
+    ''')
+
+RISK_LLM = {"model": "o3-mini", "reasoning_effort": "low"}
+
+# Answer shape and output budget (including reasoning tokens), see src/control_contracts.py
+RISK_CONTRACT = OutputContract(max_tokens=1500, bullets=(3, 6))
+
 
 def risks(state: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -22,28 +34,41 @@ def risks(state: Dict[str, Any]) -> Dict[str, Any]:
 
     :raises ValueError: If required keys (e.g., openai_api_key, original_input) are missing from the "state" input.
     """
-    risk_prompt = '''
-    # Instructions
-    - What are the main risks that this control is solving for? \n
-    - Provide answer in 3-6 succinct bullet points.\n
+    generation = run_chain("risks", RISK_PROMPT,
+                           {"control": state["original_input"]},
+                           state, RISK_LLM, contract=RISK_CONTRACT)
+    state["control_risk"] = generation
+
+    return state
 
-    # Context
-    - This it analyze the controls placed on a banking payment system
-    
-    # Control
-    {control}
-    '''
 
-    # Create a chat prompt template using the detailed prompt
-    prompt = ChatPromptTemplate(["system", risk_prompt])
+async def arisks(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of :func:`risks` built on ``ainvoke``.
+    """
+    generation = await arun_chain("risks", RISK_PROMPT,
+                                  {"control": state["original_input"]},
+                                  state, RISK_LLM, contract=RISK_CONTRACT)
+    state["control_risk"] = generation
 
-    # Initialize OpenAI Language Model
-    llm = ChatOpenAI(model="o3-mini", reasoning_effort="low", api_key=state["openai_api_key"])
+    return state
 
-    # Combine the prompt, the language model, and the output parser into a processing chain.
-    rag_chain = prompt | llm | StrOutputParser()
 
-    generation = rag_chain.invoke({"control": state["original_input"]})
-    state["control_risk"] = generation
+def stream_risks(state: Dict[str, Any]) -> Iterator[str]:
+    """
+    Streaming variant of :func:`risks`: yields the text as it is generated and stores the
+    full text under "control_risk" once done.
+    """
+    yield from stream_stage("risks", RISK_PROMPT,
+                            {"control": state["original_input"]},
+                            state, RISK_LLM, RISK_CONTRACT, "control_risk")
+
 
-    return state
\ No newline at end of file
+async def astream_risks(state: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Async variant of :func:`stream_risks` built on ``astream``.
+    """
+    async for chunk in astream_stage("risks", RISK_PROMPT,
+                                     {"control": state["original_input"]},
+                                     state, RISK_LLM, RISK_CONTRACT, "control_risk"):
+        yield chunk
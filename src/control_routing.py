@@ -0,0 +1,214 @@
+"""
+Routing of stage calls to a model and reasoning effort by input.
+
+Every stage declares the model settings its hardest inputs need (o3-mini at "high"
+reasoning effort for dependencies, gaps, industry practices, score and score reasoning).
+Most control descriptions are a few lines long and get the same answers at a lower
+effort, much faster. A routing policy lists, per stage, rules that are tried in order;
+the first rule whose conditions all hold overrides the stage's settings, and a stage
+without a matching rule keeps its own. Routing is off unless a policy is configured.
+
+Conditions of a rule (``"when"``):
+
+- ``max_tokens`` / ``min_tokens``: tokens of the control description
+- ``min_similarity``: similarity to the near-duplicate it was seeded from (see :mod:`src.control_batch`)
+
+Conditions only read what is known before the stages start; stage outputs, such as the
+classification, are produced concurrently and would make the route depend on timing.
+
+The overrides (``"use"``) are ``ChatOpenAI`` settings, usually "model" and "reasoning_effort".
+A routed call to a non-reasoning model drops "reasoning_effort", and one to an o-series
+model drops "temperature". Each routed call is noted in ``state["routing"][stage]`` with the
+rule name and the settings used. The route is part of the stage fingerprint (see
+:func:`src.control_pipeline.stage_fingerprint`), so changing the policy re-assesses the
+affected stages. Check a policy with ``benchmarks/routing_eval.py`` before deploying it;
+:data:`EXAMPLE_POLICY` is the one it evaluates by default.
+
+A policy file maps stage names to their rules::
+
+    {"score": [{"name": "short", "when": {"max_tokens": 60}, "use": {"reasoning_effort": "low"}},
+               {"name": "medium", "when": {"max_tokens": 200}, "use": {"reasoning_effort": "medium"}}]}
+
+Configuration (environment variables):
+
+- ``CONTROL_ROUTING_POLICY``: JSON policy file (default: none, every stage runs with its own settings)
+- ``CONTROL_ROUTING_DISABLED``: set to ``1`` to ignore the policy file
+"""
+import json
+import os
+import threading
+from typing import Any, Dict, List, Mapping, Optional
+from src.control_cache import MISSING
+
+# Conditions a rule may use
+CONDITIONS = ("max_tokens", "min_tokens", "min_similarity")
+
+# A candidate policy: lower the effort of the "high" stages for short descriptions and
+# near-duplicates. Not applied unless evaluated and configured.
+_BY_LENGTH = (
+    {"name": "near_duplicate", "when": {"min_similarity": 0.9}, "use": {"reasoning_effort": "low"}},
+    {"name": "short", "when": {"max_tokens": 60}, "use": {"reasoning_effort": "low"}},
+    {"name": "medium", "when": {"max_tokens": 200}, "use": {"reasoning_effort": "medium"}},
+)
+
+EXAMPLE_POLICY: Dict[str, List[Dict[str, Any]]] = {
+    stage: list(_BY_LENGTH)
+    for stage in ("dependencies", "gaps", "industry_practices", "score", "score_reasoning", "sections",
+                  "score_with_reasoning")
+}
+
+
+def route_features(state: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    The input features rules are matched against.
+
+    :param state: The assessment state.
+    :type state: Mapping[str, Any]
+    :return: "tokens" and "similarity" (None when unknown).
+    :rtype: Dict[str, Any]
+    """
+    from src.control_ratelimit import count_tokens
+    return {"tokens": count_tokens(state.get("original_input") or ""),
+            "similarity": state.get("near_duplicate_similarity")}
+
+
+def _matches(when: Mapping[str, Any], features: Mapping[str, Any]) -> bool:
+    if "max_tokens" in when and features["tokens"] > when["max_tokens"]:
+        return False
+    if "min_tokens" in when and features["tokens"] < when["min_tokens"]:
+        return False
+    if "min_similarity" in when and (features["similarity"] or 0) < when["min_similarity"]:
+        return False
+    return True
+
+
+def _apply(llm_settings: Mapping[str, Any], use: Mapping[str, Any]) -> Dict[str, Any]:
+    settings = {**llm_settings, **use}
+    if str(settings.get("model", "")).startswith("o"):
+        settings.pop("temperature", None)
+    else:
+        settings.pop("reasoning_effort", None)
+    return settings
+
+
+class RoutingPolicy:
+    """
+    Ordered routing rules per stage (see the module docstring).
+
+    :ivar stages: Stage name -> rules.
+    """
+
+    def __init__(self, stages: Mapping[str, List[Dict[str, Any]]]):
+        for stage, rules in stages.items():
+            for rule in rules:
+                unknown = set(rule.get("when", {})) - set(CONDITIONS)
+                if unknown:
+                    raise ValueError(f"Unknown routing conditions for {stage}: {', '.join(sorted(unknown))}")
+                if not rule.get("use"):
+                    raise ValueError(f"A routing rule for {stage} has no settings to use")
+        self.stages = {stage: list(rules) for stage, rules in stages.items()}
+
+    @classmethod
+    def from_file(cls, path: str) -> "RoutingPolicy":
+        """
+        Load a policy from a JSON file.
+
+        :rtype: RoutingPolicy
+        :raises ValueError: On an unknown condition or a rule without settings.
+        """
+        with open(path, encoding="utf-8") as file:
+            return cls(json.load(file))
+
+    def match(self, stage: str, state: Mapping[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        The rule of a stage that applies to this control.
+
+        :param stage: The stage name.
+        :type stage: str
+        :param state: The assessment state.
+        :type state: Mapping[str, Any]
+        :return: The first matching rule, with its "name" filled in, or None.
+        :rtype: Optional[Dict[str, Any]]
+        """
+        rules = self.stages.get(stage)
+        if not rules:
+            return None
+        features = route_features(state)
+        for index, rule in enumerate(rules):
+            if _matches(rule.get("when", {}), features):
+                return {"name": rule.get("name", str(index)), **rule}
+        return None
+
+    def route(self, stage: str, llm_settings: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        The settings of a stage call for this control.
+
+        :param stage: The stage name.
+        :type stage: str
+        :param llm_settings: The stage's own settings.
+        :type llm_settings: Dict[str, Any]
+        :param state: The assessment state; a routed call is noted in ``state["routing"]``.
+        :type state: Dict[str, Any]
+        :return: The settings of the first matching rule applied to ``llm_settings``, or
+                 ``llm_settings`` itself.
+        :rtype: Dict[str, Any]
+        """
+        rule = self.match(stage, state)
+        if rule is None:
+            return llm_settings
+        settings = _apply(llm_settings, rule["use"])
+        state.setdefault("routing", {})[stage] = {
+            "rule": rule["name"], "model": settings.get("model"), "reasoning_effort": settings.get("reasoning_effort")}
+        return settings
+
+
+_default_policy: Any = MISSING
+_default_lock = threading.Lock()
+
+
+def get_policy() -> Optional[RoutingPolicy]:
+    """
+    The process-wide policy configured from the environment, or None when no policy is
+    configured or routing is disabled.
+
+    :rtype: Optional[RoutingPolicy]
+    """
+    global _default_policy
+    with _default_lock:
+        if _default_policy is MISSING:
+            if os.environ.get("CONTROL_ROUTING_DISABLED", "").lower() in ("1", "true", "yes"):
+                _default_policy = None
+            elif os.environ.get("CONTROL_ROUTING_POLICY"):
+                _default_policy = RoutingPolicy.from_file(os.environ["CONTROL_ROUTING_POLICY"])
+            else:
+                _default_policy = None
+    return _default_policy
+
+
+def stage_route(stage: str, state: Mapping[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    The rule :func:`route` applies to a stage in an assessment, or None when the stage
+    keeps its own settings.
+
+    :rtype: Optional[Dict[str, Any]]
+    """
+    policy = state["routing_policy"] if "routing_policy" in state else get_policy()
+    return policy.match(stage, state) if policy is not None else None
+
+
+def route(stage: str, llm_settings: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Route a stage call with the state's "routing_policy" if it has one (None disables
+    routing for the assessment), or the process-wide policy.
+
+    :param stage: The stage name.
+    :type stage: str
+    :param llm_settings: The stage's own settings.
+    :type llm_settings: Dict[str, Any]
+    :param state: The assessment state.
+    :type state: Dict[str, Any]
+    :return: The settings to call the model with.
+    :rtype: Dict[str, Any]
+    """
+    policy = state["routing_policy"] if "routing_policy" in state else get_policy()
+    return policy.route(stage, llm_settings, state) if policy is not None else llm_settings
@@ -1,54 +1,55 @@
-import warnings
-import os
-from typing import List
-from langchain import hub
-from typing import Any, List, Dict
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from typing import Any, AsyncIterator, Dict, Iterator
+from src.control_prompts import SCORE_VALUES, stage_prompt
+from src.control_contracts import OutputContract
+from src.control_llm import run_chain, arun_chain
 
 
-def score(state: Dict[str, Any]) -> Dict[str, Any]:
-    score_prompt = '''
+SCORE_PROMPT = stage_prompt('''
     # Instructions
-    - The input is the description of a control for a financial payment system
-    - Your job is to use the following **Rubric** to score the input
+    - Your job is to use the **Rubric** above to score the input control
     - Score should be either "Low", "Medium", or "High"
     - Trace back your reasoning to the input
     - Return only the score as a string
     - Make sure you do not return any other information besides the score
+    ''')
+
+SCORE_LLM = {"model": "o3-mini", "reasoning_effort": "high"}
+
+# One of the scores, as a strict JSON-schema enum; the budget includes the reasoning tokens
+# (see src/control_contracts.py)
+SCORE_CONTRACT = OutputContract(max_tokens=4000, labels=SCORE_VALUES)
+
 
-    # Context
-    Each control is rated on a three-point maturity scale (Low/Medium/High)
-
-| **Category**                     | **Sub-Category**       | **Low (Below standard¹)** | **Medium (Industry standard²)** | **High (Best practice³)** |
-|----------------------------------|------------------------|-----------------------------|----------------------------------|-----------------------------|
-| **Control Design & Risk Coverage** | **Risk Coverage**       | Control does not address a risk breakpoint | Control addresses a risk breakpoint | Control addresses a risk breakpoint tied to a specific process |
-|                                  | **Control Design**     | Control design lags industry standards | Control design aligns with industry standards | Control design exceeds industry standards |
-|                                  | **Documentation**      | Control documentation is incomplete or non-existent | Documentation exists but lacks depth | Control documentation exists and is comprehensive |
-|                                  | **Transaction Coverage** | Control does not cover all applicable transactions | Control covers all applicable transactions | N/A |
-| **Implementation & Operation**   | **Execution**          | Control is not implemented or executed as expected | Control is generally followed, but there are gaps at times | Control is consistently executed as expected |
-|                                  | **Ownership**          | No clear owner accountable | Clear owner accountable for control | N/A |
-|                                  | **Dependencies**       | Key system integrations (i.e., control dependencies) are missing or broken | Key system integrations (i.e., control dependencies) are partially working | Key system integrations (i.e., control dependencies) are working fully, ensuring control effectiveness |
-| **Monitoring & Reporting**       | **Testing**            | No regular testing or evidence that the control is working as intended | Periodic testing occurs | Suite of controls for a risk breakpoint tested for effectiveness |
-|                                  | **Reporting and KPIs** | No reporting to track control performance | Some reporting to track control performance | Reporting is timely and comprehensive, enabling self-identification of issues |
-|                                  | **Governance**         | No tiered governance mechanism in place | Ad hoc tiered governance mechanism in place to drive continuous improvement | Consistent tiered governance mechanism in place to drive continuous improvement |
-
-    # Input
-    {input}
-    '''
-
-    # Create a chat prompt template using the detailed prompt
-    prompt = ChatPromptTemplate(["system", score_prompt])
-
-    # Initialize OpenAI Language Model
-    #llm = ChatOpenAI(model="gpt-4o", temperature=0, api_key=openai_api_key)
-    llm = ChatOpenAI(model="o3-mini", reasoning_effort="high", api_key=state["openai_api_key"])
-
-    # Combine the prompt, the language model, and the output parser into a processing chain.
-    rag_chain = prompt | llm | StrOutputParser()
-
-    generation = rag_chain.invoke({"input": state["original_input"]})
+def score(state: Dict[str, Any]) -> Dict[str, Any]:
+    generation = run_chain("score", SCORE_PROMPT, {"control": state["original_input"]}, state, SCORE_LLM,
+                           contract=SCORE_CONTRACT)
     state["control_score"] = generation
 
-    return state
\ No newline at end of file
+    return state
+
+
+async def ascore(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of :func:`score` built on ``ainvoke``.
+    """
+    generation = await arun_chain("score", SCORE_PROMPT, {"control": state["original_input"]}, state, SCORE_LLM,
+                                  contract=SCORE_CONTRACT)
+    state["control_score"] = generation
+
+    return state
+
+
+def stream_score(state: Dict[str, Any]) -> Iterator[str]:
+    """
+    Streaming variant of :func:`score`. The answer is a single label, so it is yielded in one
+    piece once known and stored under "control_score".
+    """
+    yield score(state)["control_score"]
+
+
+async def astream_score(state: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Async variant of :func:`stream_score`: awaits :func:`ascore` and yields the final label once,
+    since a label under a strict schema has nothing to stream.
+    """
+    yield (await ascore(state))["control_score"]
@@ -0,0 +1,100 @@
+from typing import Any, Dict, Optional
+from src.control_prompts import RUBRIC_ROWS, SCORE_VALUES, stage_prompt
+from src.control_contracts import OutputContract
+from src.control_llm import run_chain, arun_chain
+
+
+COMBINED_SCORE_PROMPT = stage_prompt('''
+    # Instructions
+    - Your job is to use the **Rubric** above to score the input control
+    - Score should be either "Low", "Medium", or "High"
+    - Trace back your reasoning to the input
+    - For each rubric Sub-Category, provide a succinct and detailed positive and negative point explaining the score
+    ''')
+
+COMBINED_SCORE_LLM = {"model": "o3-mini", "reasoning_effort": "high"}
+
+
+def _violation(generation: Dict[str, Any]) -> Optional[str]:
+    if generation.get("score") not in SCORE_VALUES:
+        return f"score {generation.get('score')!r} is not one of {', '.join(SCORE_VALUES)}"
+    reasoning = generation.get("reasoning") or {}
+    missing = [sub_category for _, sub_category in RUBRIC_ROWS if sub_category not in reasoning]
+    if missing:
+        return f"no reasoning for the rubric rows {', '.join(missing)}"
+    return None
+
+
+# Output budget of the call; the score enum and the rubric rows are part of the schema and
+# checked again on the parsed answer, so a cut-off or incomplete answer is asked again, see
+# src/control_contracts.py
+COMBINED_SCORE_CONTRACT = OutputContract(max_tokens=8000, labels=SCORE_VALUES, validate=_violation)
+
+COMBINED_SCORE_SCHEMA = {
+    "title": "control_score",
+    "description": "Rubric score of a payment system control with the reasoning for each rubric row.",
+    "type": "object",
+    "properties": {
+        "score": {"type": "string", "enum": list(SCORE_VALUES)},
+        "reasoning": {
+            # One required key per rubric Sub-Category, so a strict response covers every row
+            "type": "object",
+            "description": "The positive and negative point of every rubric Sub-Category.",
+            "properties": {
+                sub_category: {
+                    "type": "object",
+                    "properties": {"positive": {"type": "string"}, "negative": {"type": "string"}},
+                    "required": ["positive", "negative"],
+                    "additionalProperties": False,
+                }
+                for _, sub_category in RUBRIC_ROWS
+            },
+            "required": [sub_category for _, sub_category in RUBRIC_ROWS],
+            "additionalProperties": False,
+        },
+    },
+    "required": ["score", "reasoning"],
+    "additionalProperties": False,
+}
+
+
+def _update(state: Dict[str, Any], generation: Dict[str, Any]) -> Dict[str, Any]:
+    reasoning = generation["reasoning"]
+    # Render the reasoning in rubric order, grouped by category
+    lines = []
+    for category, sub_category in RUBRIC_ROWS:
+        item = reasoning[sub_category]
+        lines.append(f"**{category} – {sub_category}**")
+        lines.append(f"- Positive: {item['positive']}")
+        lines.append(f"- Negative: {item['negative']}")
+
+    state["control_score"] = generation["score"]
+    state["control_score_reasoning"] = "\n".join(lines)
+    return state
+
+
+def score_with_reasoning(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Score the control against the rubric and explain the score in the same structured-output
+    call, replacing the serial score -> score_reasoning pair with a single request.
+
+    :param state: A dictionary containing "openai_api_key" and "original_input".
+    :type state: Dict[str, Any]
+    :return: The updated state with "control_score" (one of Low/Medium/High) and
+             "control_score_reasoning" (positive and negative points per rubric row).
+    :rtype: Dict[str, Any]
+    :raises ContractViolation: If the returned score is not an allowed value or a rubric row
+                               has no reasoning, after a repair.
+    """
+    generation = run_chain("score_with_reasoning", COMBINED_SCORE_PROMPT, {"control": state["original_input"]},
+                           state, COMBINED_SCORE_LLM, COMBINED_SCORE_SCHEMA, contract=COMBINED_SCORE_CONTRACT)
+    return _update(state, generation)
+
+
+async def ascore_with_reasoning(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of :func:`score_with_reasoning` built on ``ainvoke``.
+    """
+    generation = await arun_chain("score_with_reasoning", COMBINED_SCORE_PROMPT, {"control": state["original_input"]},
+                                  state, COMBINED_SCORE_LLM, COMBINED_SCORE_SCHEMA, contract=COMBINED_SCORE_CONTRACT)
+    return _update(state, generation)
@@ -0,0 +1,91 @@
+from typing import Any, Dict, List, Optional
+from src.control_prompts import stage_prompt
+from src.control_contracts import OutputContract
+from src.control_llm import run_chain, arun_chain
+
+
+SECTIONS_PROMPT = stage_prompt('''
+    # Instructions
+    - Answer each of the following questions about the input control in 3-6 succinct bullet points:
+        -- risks: What are the main risks that this control is solving for?
+        -- dependencies: What are the main operational or technical dependencies that this control is solving for?
+        -- gaps: What are the main operational or technical gaps that this control is solving for?
+        -- industry_practices: What are the main industry best practices for this control? Make these bullet points detailed and provide examples where these practices are used.
+    - Return each bullet point as one string, without a leading bullet marker
+    ''')
+
+SECTIONS_LLM = {"model": "o3-mini", "reasoning_effort": "high"}
+
+# Response field -> state key
+SECTION_KEYS = {
+    "risks": "control_risk",
+    "dependencies": "control_dependencies",
+    "gaps": "control_gaps",
+    "industry_practices": "control_industry_practices",
+}
+
+# Bullet points of each section
+SECTION_BULLETS = (3, 6)
+
+
+def _violation(generation: Dict[str, List[str]]) -> Optional[str]:
+    fewest, most = SECTION_BULLETS
+    for field in SECTION_KEYS:
+        count = sum(1 for item in generation.get(field, []) if item.strip())
+        if not fewest <= count <= most:
+            return f"{field}: {count} bullet points instead of {fewest}-{most}"
+    return None
+
+
+# Output budget of the call, and the bullet range of each section: an answer cut off by the
+# budget or with a section out of range is asked again, see src/control_contracts.py
+SECTIONS_CONTRACT = OutputContract(max_tokens=8000, bullets=SECTION_BULLETS, validate=_violation)
+
+SECTIONS_SCHEMA = {
+    "title": "control_sections",
+    "description": "Risks, dependencies, gaps and industry best practices of a payment system control.",
+    "type": "object",
+    "properties": {
+        field: {"type": "array", "description": "3-6 bullet points", "items": {"type": "string"}}
+        for field in SECTION_KEYS
+    },
+    "required": list(SECTION_KEYS),
+    "additionalProperties": False,
+}
+
+
+def _bullets(items: List[str]) -> str:
+    return "\n".join(f"- {item.strip().lstrip('-*• ').strip()}" for item in items if item.strip())
+
+
+def _update(state: Dict[str, Any], generation: Dict[str, List[str]]) -> Dict[str, Any]:
+    for field, key in SECTION_KEYS.items():
+        state[key] = _bullets(generation[field])
+    return state
+
+
+def sections(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fused replacement for the risks, dependencies, gaps and industry_practices stages:
+    a single structured-output call that answers all four questions at once, so the
+    control text and instructions are paid for (and reasoned over) only once.
+
+    :param state: A dictionary containing "openai_api_key" and "original_input".
+    :type state: Dict[str, Any]
+    :return: The updated state with "control_risk", "control_dependencies", "control_gaps"
+             and "control_industry_practices" filled in as markdown bullet lists.
+    :rtype: Dict[str, Any]
+    :raises ContractViolation: If a section is still out of its bullet range after a repair.
+    """
+    generation = run_chain("sections", SECTIONS_PROMPT, {"control": state["original_input"]},
+                           state, SECTIONS_LLM, SECTIONS_SCHEMA, contract=SECTIONS_CONTRACT)
+    return _update(state, generation)
+
+
+async def asections(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of :func:`sections` built on ``ainvoke``.
+    """
+    generation = await arun_chain("sections", SECTIONS_PROMPT, {"control": state["original_input"]},
+                                  state, SECTIONS_LLM, SECTIONS_SCHEMA, contract=SECTIONS_CONTRACT)
+    return _update(state, generation)
@@ -0,0 +1,416 @@
+"""
+Memory-bounded Streamlit session state.
+
+Each session keeps its chat in ``st.session_state``, including the multi-kilobyte
+combined assessment message, plus the workbook export of its last assessment. With many
+concurrent reviewers the server's memory would only grow. (The OpenAI clients are not
+per session; they are shared by the process, see :mod:`src.control_clients`.)
+
+:class:`SessionMemory` keeps a bounded working set per session:
+
+- :meth:`SessionMemory.bound` moves the content of chat messages the session no longer
+  needs in memory to a local SQLite spill file, oldest first, once the session's messages
+  hold more than ``CONTROL_SESSION_MEMORY_BYTES``. The apps protect the messages still
+  used to build follow-up requests, so only the combined assessment message (follow-ups
+  send its sections from the assessment instead) and turns already folded into the
+  rolling summary spill. A spilled message keeps its role and flags;
+  :meth:`SessionMemory.content` reads its content back when it is rendered.
+- :meth:`SessionMemory.keep_buffer` writes an export, such as the results workbook, to
+  the spill file and returns a loader that ``st.download_button`` calls only when the
+  download is clicked.
+
+:meth:`SessionMemory.measure` records the in-memory size of the session's state;
+:func:`memory_gauges` reports it per session and in total, with the spilled bytes and
+the process RSS, and publishes them as Prometheus gauges (see :mod:`src.control_metrics`).
+Spilled data that was not read for ``CONTROL_SESSION_TTL_SECONDS`` is evicted.
+
+Configuration (environment variables):
+
+- ``CONTROL_SESSION_SPILL_PATH``: SQLite file (default ``.cache/control_sessions.sqlite``)
+- ``CONTROL_SESSION_MEMORY_BYTES``: message content a session keeps in memory (default 32768)
+- ``CONTROL_SESSION_TTL_SECONDS``: lifetime of unread spilled data (default 24 hours)
+- ``CONTROL_SESSION_SPILL_DISABLED``: set to ``1`` to keep everything in memory
+
+Usage::
+
+    session = st.session_state.setdefault('session_memory', SessionMemory())
+    for message in st.session_state['conversation']:
+        st.markdown(session.content(message))
+    st.download_button("Download", data=session.keep_buffer("workbook", buffer), file_name="results.xlsx")
+    session.bound(st.session_state['conversation'], protected=lambda index, message: index == 0)
+    session.measure(st.session_state)
+"""
+import argparse
+import io
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, IO, List, Mapping, MutableSequence, Optional, Set, Union
+from src.control_cache import MISSING
+
+# Shown for a spilled message whose content was evicted
+EVICTED_TEXT = "*(This earlier message is no longer available.)*"
+
+# Run eviction after this many writes
+_EVICT_EVERY = 200
+
+# Sessions not measured for this long are no longer counted as live
+LIVE_SECONDS = 3600.0
+
+# Prometheus gauge of each value of memory_gauges()
+GAUGE_NAMES = {
+    "sessions": "control_sessions",
+    "session_bytes": "control_session_memory_bytes_total",
+    "max_session_bytes": "control_session_memory_bytes_max",
+    "spilled_bytes": "control_session_spilled_bytes",
+    "spilled_items": "control_session_spilled_items",
+    "rss_bytes": "control_process_rss_bytes",
+}
+
+
+class SpillStore:
+    """
+    SQLite-backed spill file of session messages and exports, evicted when unread for the TTL.
+
+    Safe to share between threads; each thread uses its own connection.
+    """
+
+    def __init__(self, path: str, ttl_seconds: Optional[float] = 24 * 3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds or None
+        self._local = threading.local()
+        self._writes = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS spilled ("
+            " session TEXT NOT NULL, key TEXT NOT NULL, kind TEXT NOT NULL, data BLOB NOT NULL,"
+            " size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (session, key))"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS spilled_accessed ON spilled (accessed)")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def put(self, session: str, key: str, kind: str, data: bytes) -> None:
+        """
+        Store (or replace) spilled data of a session.
+
+        :param session: The session ID.
+        :type session: str
+        :param key: The key of the data within the session.
+        :type key: str
+        :param kind: "message" or "buffer".
+        :type kind: str
+        :param data: The content.
+        :type data: bytes
+        """
+        now = time.time()
+        self._connection().execute("INSERT OR REPLACE INTO spilled VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (session, key, kind, sqlite3.Binary(data), len(data), now, now))
+        self._writes += 1
+        if self._writes % _EVICT_EVERY == 0:
+            self.evict()
+
+    def get(self, session: str, key: str) -> Optional[bytes]:
+        """
+        Read spilled data back, or None if it was evicted.
+
+        :rtype: Optional[bytes]
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT data FROM spilled WHERE session = ? AND key = ?", (session, key)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE spilled SET accessed = ? WHERE session = ? AND key = ?", (time.time(), session, key))
+        return bytes(row[0])
+
+    def drop(self, session: str, key: Optional[str] = None) -> None:
+        """
+        Delete one item, or all spilled data of a session.
+        """
+        if key is None:
+            self._connection().execute("DELETE FROM spilled WHERE session = ?", (session,))
+        else:
+            self._connection().execute("DELETE FROM spilled WHERE session = ? AND key = ?", (session, key))
+
+    def evict(self) -> int:
+        """
+        Delete the data not read for the TTL.
+
+        :return: The number of items deleted.
+        :rtype: int
+        """
+        if self.ttl_seconds is None:
+            return 0
+        return self._connection().execute("DELETE FROM spilled WHERE accessed < ?",
+                                          (time.time() - self.ttl_seconds,)).rowcount
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM spilled")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Size of the spill file's contents.
+
+        :return: "sessions", "items" and "bytes".
+        :rtype: Dict[str, Any]
+        """
+        sessions, items, size = self._connection().execute(
+            "SELECT COUNT(DISTINCT session), COUNT(*), COALESCE(SUM(size), 0) FROM spilled").fetchone()
+        return {"sessions": sessions, "items": items, "bytes": size}
+
+
+_default_spill: Any = MISSING
+_default_lock = threading.Lock()
+
+
+def get_spill() -> Optional[SpillStore]:
+    """
+    The process-wide spill store configured from the environment, or None when disabled.
+
+    :rtype: Optional[SpillStore]
+    """
+    global _default_spill
+    with _default_lock:
+        if _default_spill is MISSING:
+            if os.environ.get("CONTROL_SESSION_SPILL_DISABLED", "").lower() in ("1", "true", "yes"):
+                _default_spill = None
+            else:
+                _default_spill = SpillStore(
+                    os.environ.get("CONTROL_SESSION_SPILL_PATH", os.path.join(".cache", "control_sessions.sqlite")),
+                    float(os.environ.get("CONTROL_SESSION_TTL_SECONDS", 24 * 3600)),
+                )
+    return _default_spill
+
+
+def deep_size(value: Any, seen: Optional[Set[int]] = None) -> int:
+    """
+    Approximate memory of an object and everything it references: containers, object
+    attributes and the contents of byte buffers.
+
+    :rtype: int
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, bytearray, int, float, bool, type(None))):
+        return size
+    if isinstance(value, io.BytesIO):
+        with value.getbuffer() as view:
+            return size + view.nbytes
+    if isinstance(value, Mapping):
+        return size + sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(deep_size(item, seen) for item in value)
+    if hasattr(value, "__dict__") and not isinstance(value, type):
+        return size + deep_size(vars(value), seen)
+    return size
+
+
+def process_rss() -> Optional[int]:
+    """
+    Resident set size of the process in bytes: the current one on Linux, the peak elsewhere.
+
+    :rtype: Optional[int]
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Live sessions of the process: session ID -> (bytes in memory, last measured)
+_sessions: Dict[str, tuple] = {}
+_sessions_lock = threading.Lock()
+
+
+class SessionMemory:
+    """
+    The bounded working set of one app session (see the module docstring). Keep one per
+    session in ``st.session_state``.
+
+    :ivar session_id: Identifies the session's spilled data.
+    :ivar memory_bytes: Message content kept in memory before messages spill.
+    """
+
+    def __init__(self, spill: Any = MISSING, memory_bytes: Optional[int] = None):
+        self.session_id = uuid.uuid4().hex
+        self.memory_bytes = memory_bytes if memory_bytes is not None else \
+            int(os.environ.get("CONTROL_SESSION_MEMORY_BYTES", 32768))
+        self._spilled: Dict[str, int] = {}
+        self._spill = spill
+
+    @property
+    def spilled_bytes(self) -> int:
+        """
+        Bytes of this session's data held in the spill file; a replaced export counts once.
+
+        :rtype: int
+        """
+        return sum(self._spilled.values())
+
+    @property
+    def spill(self) -> Optional[SpillStore]:
+        return get_spill() if self._spill is MISSING else self._spill
+
+    def bound(self, conversation: MutableSequence[Dict[str, Any]],
+              protected: Callable[[int, Mapping[str, Any]], bool] = lambda index, message: False) -> int:
+        """
+        Spill the content of the oldest unprotected messages until the messages in memory
+        hold at most ``memory_bytes``. Spilled messages are replaced in place by a copy
+        without "content" and with "spilled" (the key of the content) and "bytes".
+
+        :param conversation: The chat messages.
+        :type conversation: MutableSequence[Dict[str, Any]]
+        :param protected: Whether a message, given its index, must stay in memory.
+        :type protected: Callable[[int, Mapping[str, Any]], bool]
+        :return: The bytes spilled.
+        :rtype: int
+        """
+        spill = self.spill
+        if spill is None:
+            return 0
+        held = sum(len(message["content"].encode("utf-8")) for message in conversation
+                   if isinstance(message.get("content"), str))
+        spilled = 0
+        for index, message in enumerate(conversation):
+            if held <= self.memory_bytes:
+                break
+            if not isinstance(message.get("content"), str) or protected(index, message):
+                continue
+            data = message["content"].encode("utf-8")
+            key = f"message-{uuid.uuid4().hex}"
+            spill.put(self.session_id, key, "message", data)
+            conversation[index] = {**{name: value for name, value in message.items() if name != "content"},
+                                   "spilled": key, "bytes": len(data)}
+            self._spilled[key] = len(data)
+            held -= len(data)
+            spilled += len(data)
+        return spilled
+
+    def content(self, message: Mapping[str, Any]) -> str:
+        """
+        The content of a message, read back from the spill file if it was spilled.
+
+        :rtype: str
+        """
+        if "spilled" not in message:
+            return message["content"]
+        spill = self.spill
+        data = spill.get(self.session_id, message["spilled"]) if spill is not None else None
+        return data.decode("utf-8") if data is not None else EVICTED_TEXT
+
+    def keep_buffer(self, name: str, buffer: Union[bytes, IO[bytes]]) -> Callable[[], bytes]:
+        """
+        Move an export out of memory, replacing the session's previous export of that name.
+
+        :param name: The export's name, e.g. "workbook".
+        :type name: str
+        :param buffer: Its bytes, or a buffer to read them from.
+        :type buffer: Union[bytes, IO[bytes]]
+        :return: A loader of the bytes, for ``st.download_button(data=...)``; it holds them
+                 in memory only when spilling is disabled.
+        :rtype: Callable[[], bytes]
+        """
+        data = buffer if isinstance(buffer, bytes) else buffer.read()
+        spill = self.spill
+        if spill is None:
+            return lambda: data
+        key = f"buffer-{name}"
+        spill.put(self.session_id, key, "buffer", data)
+        self._spilled[key] = len(data)
+        session_id = self.session_id
+        return lambda: spill.get(session_id, key) or b""
+
+    def clear(self) -> None:
+        """
+        Delete the session's spilled data, e.g. when it starts a new conversation.
+        """
+        spill = self.spill
+        if spill is not None:
+            spill.drop(self.session_id)
+        self._spilled.clear()
+
+    def measure(self, session_state: Mapping[str, Any]) -> int:
+        """
+        Record the in-memory size of the session's state for :func:`memory_gauges`; call it
+        at the end of each script run.
+
+        :param session_state: ``st.session_state``.
+        :type session_state: Mapping[str, Any]
+        :return: Approximate bytes held by the session state.
+        :rtype: int
+        """
+        size = deep_size({key: session_state[key] for key in list(session_state.keys())})
+        with _sessions_lock:
+            _sessions[self.session_id] = (size, time.time())
+        return size
+
+
+def memory_gauges(publish: bool = True) -> Dict[str, Any]:
+    """
+    Memory of the live sessions of the process (measured within :data:`LIVE_SECONDS`),
+    spilled data and the process RSS; published as Prometheus gauges by default.
+
+    :param publish: Whether to set the gauges of :func:`src.control_metrics.get_registry`.
+    :type publish: bool
+    :return: "sessions", "session_bytes" (total), "max_session_bytes", "spilled_bytes",
+             "spilled_items" and "rss_bytes".
+    :rtype: Dict[str, Any]
+    """
+    now = time.time()
+    with _sessions_lock:
+        for session_id in [key for key, (_, seen) in _sessions.items() if now - seen > LIVE_SECONDS]:
+            del _sessions[session_id]
+        sizes: List[int] = [size for size, _ in _sessions.values()]
+    spill = get_spill()
+    spilled = spill.stats() if spill is not None else {"items": 0, "bytes": 0}
+    gauges = {"sessions": len(sizes), "session_bytes": sum(sizes), "max_session_bytes": max(sizes, default=0),
+              "spilled_bytes": spilled["bytes"], "spilled_items": spilled["items"], "rss_bytes": process_rss()}
+    if publish:
+        from src.control_metrics import get_registry
+        registry = get_registry()
+        for name, metric in GAUGE_NAMES.items():
+            if gauges[name] is not None:
+                registry.set_gauge(metric, gauges[name])
+    return gauges
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect or maintain the session spill file.")
+    parser.add_argument("command", choices=("stats", "evict", "clear"))
+    args = parser.parse_args()
+
+    spill = get_spill()
+    if spill is None:
+        parser.error("spilling is disabled (CONTROL_SESSION_SPILL_DISABLED)")
+    if args.command == "evict":
+        print(f"Evicted {spill.evict()} items")
+    elif args.command == "clear":
+        spill.clear()
+    print(json.dumps(spill.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
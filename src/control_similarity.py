@@ -0,0 +1,326 @@
+"""
+Near-duplicate detection for control descriptions.
+
+Inventories repeat the same control per region or product with small wording changes,
+which the exact-match response cache cannot see. Each assessed description is reduced to
+a MinHash signature of its character shingles and stored with its results; locality-sensitive
+hashing (LSH) over signature bands finds previously assessed descriptions whose estimated
+Jaccard similarity is above a threshold without comparing against every stored one.
+
+Configuration (environment variables):
+
+- ``CONTROL_SIMILARITY_PATH``: SQLite file (default ``.cache/control_similarity.sqlite``)
+- ``CONTROL_SIMILARITY_THRESHOLD``: minimum estimated Jaccard similarity (default 0.85)
+- ``CONTROL_SIMILARITY_DISABLED``: set to ``1`` to disable the index
+
+Usage::
+
+    python -m src.control_similarity report controls.xlsx --column "Control Description"
+    python -m src.control_similarity stats|clear
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+import numpy as np
+
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+
+# Probability that a pair exactly at the threshold shares at least one LSH band
+LSH_RECALL = 0.99
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_SEPARATORS = re.compile(r"[^a-z0-9]+")
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> Set[str]:
+    """
+    The character ``size``-grams of a lower-cased description with punctuation and runs
+    of spaces collapsed to one space, so a reworded phrase only changes the shingles around it.
+
+    :param text: A control description.
+    :type text: str
+    :param size: Characters per shingle.
+    :type size: int
+    :rtype: Set[str]
+    """
+    normalized = _SEPARATORS.sub(" ", text.lower()).strip()
+    if len(normalized) <= size:
+        return {normalized}
+    return {normalized[index:index + size] for index in range(len(normalized) - size + 1)}
+
+
+def similarity(first: np.ndarray, second: np.ndarray) -> float:
+    """
+    Estimated Jaccard similarity of two MinHash signatures.
+
+    :rtype: float
+    """
+    return float(np.mean(first == second))
+
+
+def lsh_bands(threshold: float, num_perm: int = NUM_PERM) -> Tuple[int, int]:
+    """
+    The ``(bands, rows)`` split of the signature with the most rows per band (the fewest
+    dissimilar candidates) for which a pair exactly at ``threshold`` still shares a band
+    with probability ``LSH_RECALL``. Candidates are then checked against the threshold with
+    the full signature.
+
+    :param threshold: The similarity threshold.
+    :type threshold: float
+    :param num_perm: The signature length.
+    :type num_perm: int
+    :rtype: Tuple[int, int]
+    """
+    for rows in range(num_perm, 0, -1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= LSH_RECALL:
+            return bands, rows
+    return num_perm, 1
+
+
+class Match(NamedTuple):
+    """
+    A previously assessed description similar to the one looked up.
+    """
+    similarity: float
+    text: str
+    state: Dict[str, Any]
+
+
+class SimilarityIndex:
+    """
+    SQLite-backed MinHash/LSH index of assessed control descriptions and their results.
+
+    Safe to share between threads; each thread uses its own connection.
+    """
+
+    def __init__(self, path: str, threshold: float = 0.85, num_perm: int = NUM_PERM, seed: int = 1):
+        self.path = path
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self._b = generator.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " id INTEGER PRIMARY KEY, text_hash TEXT UNIQUE NOT NULL, text TEXT NOT NULL,"
+            " signature BLOB NOT NULL, state TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        connection.execute("CREATE TABLE IF NOT EXISTS bands (band INTEGER NOT NULL, bucket TEXT NOT NULL,"
+                           " document INTEGER NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS bands_bucket ON bands (band, bucket)")
+        connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._check_layout()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _check_layout(self) -> None:
+        # Signatures depend on the shingles and hash family, bands on the threshold: rebuild what is stale
+        connection = self._connection()
+        stored = dict(connection.execute("SELECT name, value FROM settings").fetchall())
+        signatures = json.dumps([SHINGLE_SIZE, self.num_perm, self._a[:4].tolist()])
+        if stored.get("signatures", signatures) != signatures:
+            connection.execute("DELETE FROM documents")
+            connection.execute("DELETE FROM bands")
+        elif stored.get("bands") != json.dumps([self.bands, self.rows]):
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM bands")
+            for document, signature in connection.execute("SELECT id, signature FROM documents").fetchall():
+                self._insert_bands(document, np.frombuffer(signature, dtype=np.uint32))
+            connection.execute("COMMIT")
+        connection.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                               [("signatures", signatures), ("bands", json.dumps([self.bands, self.rows]))])
+
+    def _buckets(self, signature: np.ndarray) -> List[str]:
+        return [hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(), digest_size=8).hexdigest()
+                for band in range(self.bands)]
+
+    def _insert_bands(self, document: int, signature: np.ndarray) -> None:
+        self._connection().executemany("INSERT INTO bands VALUES (?, ?, ?)",
+                                       [(band, bucket, document) for band, bucket in enumerate(self._buckets(signature))])
+
+    def signature(self, text: str) -> np.ndarray:
+        """
+        The MinHash signature of a description's shingles.
+
+        :param text: A control description.
+        :type text: str
+        :return: ``num_perm`` unsigned 32-bit minimum hash values.
+        :rtype: np.ndarray
+        """
+        hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+                           for shingle in shingles(text)], dtype=np.uint64)
+        permuted = (hashes[:, None] * self._a + self._b) % _MERSENNE_PRIME
+        return (permuted & np.uint64(0xFFFFFFFF)).min(axis=0).astype(np.uint32)
+
+    def query(self, text: Union[str, np.ndarray], threshold: Optional[float] = None, limit: int = 5) -> List[Match]:
+        """
+        Previously assessed descriptions similar to ``text``, most similar first.
+
+        :param text: A control description, or its :meth:`signature`.
+        :type text: Union[str, np.ndarray]
+        :param threshold: Minimum estimated similarity, defaulting to the index threshold.
+        :type threshold: Optional[float]
+        :param limit: Maximum number of matches.
+        :type limit: int
+        :rtype: List[Match]
+        """
+        signature = self.signature(text) if isinstance(text, str) else text
+        threshold = self.threshold if threshold is None else threshold
+        connection = self._connection()
+        candidates = set()
+        for band, bucket in enumerate(self._buckets(signature)):
+            candidates.update(row[0] for row in connection.execute(
+                "SELECT document FROM bands WHERE band = ? AND bucket = ?", (band, bucket)))
+
+        matches = []
+        for document in candidates:
+            row = connection.execute("SELECT text, signature, state FROM documents WHERE id = ?", (document,)).fetchone()
+            if row is None:
+                continue
+            score = similarity(signature, np.frombuffer(row[1], dtype=np.uint32))
+            if score >= threshold:
+                matches.append(Match(score, row[0], json.loads(row[2])))
+        matches.sort(key=lambda match: match.similarity, reverse=True)
+        return matches[:limit]
+
+    def add(self, text: str, state: Dict[str, Any], signature: Optional[np.ndarray] = None) -> None:
+        """
+        Store an assessed description and its results; re-adding a description replaces them.
+
+        :param text: The control description.
+        :type text: str
+        :param state: The JSON-serialisable results to reuse for near-duplicates.
+        :type state: Dict[str, Any]
+        :param signature: The precomputed :meth:`signature` of ``text``.
+        :type signature: Optional[np.ndarray]
+        """
+        signature = self.signature(text) if signature is None else signature
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            previous = connection.execute("SELECT id FROM documents WHERE text_hash = ?", (text_hash,)).fetchone()
+            if previous is not None:
+                connection.execute("DELETE FROM bands WHERE document = ?", previous)
+                connection.execute("DELETE FROM documents WHERE id = ?", previous)
+            document = connection.execute(
+                "INSERT INTO documents (text_hash, text, signature, state, created) VALUES (?, ?, ?, ?, ?)",
+                (text_hash, text, signature.tobytes(), json.dumps(state, default=str), time.time())).lastrowid
+            self._insert_bands(document, signature)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM bands")
+        self._connection().execute("DELETE FROM documents")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Size and LSH layout of the index.
+
+        :rtype: Dict[str, Any]
+        """
+        documents = self._connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        return {"documents": documents, "threshold": self.threshold, "num_perm": self.num_perm,
+                "bands": self.bands, "rows": self.rows}
+
+
+def dedupe_report(texts: Iterable[str], index: SimilarityIndex) -> Dict[str, Any]:
+    """
+    Group an inventory into near-duplicate clusters without assessing anything: each
+    description is matched against the ones before it (and against ``index``).
+
+    :param texts: The control descriptions.
+    :type texts: Iterable[str]
+    :param index: The index providing the hash family and threshold; previously assessed
+                  descriptions count as already covered.
+    :type index: SimilarityIndex
+    :return: "controls", "near_duplicates" (controls within the threshold of an earlier or
+             stored one), "unique" and "dedupe_ratio" (near_duplicates / controls).
+    :rtype: Dict[str, Any]
+    """
+    seen: List[np.ndarray] = []
+    controls = near_duplicates = 0
+    for text in texts:
+        controls += 1
+        signature = index.signature(text)
+        if index.query(signature, limit=1) or any(similarity(signature, other) >= index.threshold for other in seen):
+            near_duplicates += 1
+        else:
+            seen.append(signature)
+    return {
+        "controls": controls,
+        "near_duplicates": near_duplicates,
+        "unique": controls - near_duplicates,
+        "dedupe_ratio": near_duplicates / controls if controls else 0.0,
+    }
+
+
+_default_index: Any = None
+_default_loaded = False
+_default_lock = threading.Lock()
+
+
+def get_index() -> Optional[SimilarityIndex]:
+    """
+    The process-wide index configured from the environment, or None when disabled.
+
+    :rtype: Optional[SimilarityIndex]
+    """
+    global _default_index, _default_loaded
+    with _default_lock:
+        if not _default_loaded:
+            _default_loaded = True
+            if os.environ.get("CONTROL_SIMILARITY_DISABLED", "").lower() not in ("1", "true", "yes"):
+                _default_index = SimilarityIndex(
+                    os.environ.get("CONTROL_SIMILARITY_PATH", os.path.join(".cache", "control_similarity.sqlite")),
+                    float(os.environ.get("CONTROL_SIMILARITY_THRESHOLD", 0.85)),
+                )
+    return _default_index
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect the near-duplicate index or report an inventory's dedupe ratio.")
+    parser.add_argument("command", choices=("report", "stats", "clear"))
+    parser.add_argument("input", nargs="?", help="CSV or XLSX inventory (report)")
+    parser.add_argument("--column", help="header of the control description column (default: first column)")
+    args = parser.parse_args()
+
+    index = get_index()
+    if index is None:
+        parser.error("the similarity index is disabled (CONTROL_SIMILARITY_DISABLED)")
+    if args.command == "report":
+        if not args.input:
+            parser.error("report needs an inventory file")
+        from src.control_batch import read_controls
+        print(json.dumps(dedupe_report((text for _, text in read_controls(args.input, args.column)), index), indent=2))
+        return
+    if args.command == "clear":
+        index.clear()
+    print(json.dumps(index.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+Coalescing of identical in-flight stage calls.
+
+When several sessions of the server process (e.g. reviewers pasting the same control
+during a walkthrough) make the same stage call at the same time, only the first one, the
+leader, reaches the API. The others join its flight and receive its result; the followers
+of a streamed call receive every chunk as the leader's stream produces it. Unlike the
+response cache this also covers the cold first call, and it shares nothing once the call
+has finished.
+
+Calls are keyed on the stage name and the content address of the call (prompt, model
+settings and inputs, see :func:`src.control_cache.cache_key`). Leaders and followers may be
+on different threads (Streamlit script runs) or event loops; an error of the leader is
+raised in its followers too. If the leader is cancelled, a follower that has not received
+anything yet makes the call itself.
+
+Coalesced calls are counted per stage in ``state["metrics"][stage]["coalesced"]`` and as
+``control_stage_calls_total{outcome="coalesced"}`` (see :mod:`src.control_metrics`), and
+process-wide in ``get_flights().stats``.
+
+Configuration (environment variables):
+
+- ``CONTROL_SINGLEFLIGHT_DISABLED``: set to ``1`` to send every call on its own
+"""
+import asyncio
+import os
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional, Set, Tuple
+
+# The leader's outcome before it has one, since None is a valid result
+_PENDING = object()
+
+
+class Abandoned(RuntimeError):
+    """
+    The leader of a flight was cancelled before it finished.
+    """
+
+
+class Flight:
+    """
+    One in-flight call: the chunks streamed so far and, once done, its result or error.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._async_waiters: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        self.chunks: List[Any] = []
+        self.result: Any = _PENDING
+        self.error: Optional[BaseException] = None
+        self.done = False
+
+    def _wake(self) -> None:
+        # With the lock held
+        self._changed.notify_all()
+        for loop, event in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The waiter's loop has been closed
+                pass
+
+    def publish(self, chunk: Any) -> None:
+        """
+        Hand a streamed chunk of the leader to the followers.
+        """
+        with self._lock:
+            self.chunks.append(chunk)
+            self._wake()
+
+    def finish(self, result: Any) -> None:
+        """
+        Complete the flight with the leader's result.
+        """
+        with self._lock:
+            self.result, self.done = result, True
+            self._wake()
+
+    def fail(self, error: BaseException) -> None:
+        """
+        Complete the flight with the leader's error.
+        """
+        with self._lock:
+            self.error, self.done = error, True
+            self._wake()
+
+    def _outcome(self) -> Any:
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _tail(self, streamed: int) -> List[Any]:
+        # What a stream follower has yet to yield at the end: a flight without chunks
+        # (a non-streaming leader) is yielded in one piece, like a cached response
+        if self.chunks or self.result in (None, "", _PENDING):
+            return self.chunks[streamed:]
+        return [self.result]
+
+    def wait(self) -> Any:
+        """
+        Block until the flight is done and return its result (or raise its error).
+        """
+        with self._changed:
+            while not self.done:
+                self._changed.wait()
+        return self._outcome()
+
+    async def await_result(self) -> Any:
+        """
+        Async variant of :meth:`wait`; waits without blocking the event loop.
+        """
+        async for _ in self._aupdates():
+            pass
+        return self._outcome()
+
+    def follow(self) -> Iterator[Any]:
+        """
+        Yield the chunks of the flight as they are published, then raise its error if any.
+        """
+        streamed = 0
+        while True:
+            with self._changed:
+                while len(self.chunks) == streamed and not self.done:
+                    self._changed.wait()
+                done = self.done
+                new = self._tail(streamed) if done else self.chunks[streamed:]
+            streamed += len(new)
+            yield from new
+            if done:
+                self._outcome()
+                return
+
+    async def _aupdates(self) -> AsyncIterator[Tuple[List[Any], bool]]:
+        # -> (new chunks, done) whenever the flight changes
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._async_waiters.add(waiter)
+        try:
+            streamed = 0
+            while True:
+                with self._lock:
+                    # Cleared under the lock, so a wake-up after this read is not lost
+                    waiter[1].clear()
+                    done = self.done
+                    new = self._tail(streamed) if done else self.chunks[streamed:]
+                streamed += len(new)
+                if new or done:
+                    yield new, done
+                if done:
+                    return
+                await waiter[1].wait()
+        finally:
+            with self._lock:
+                self._async_waiters.discard(waiter)
+
+    async def afollow(self) -> AsyncIterator[Any]:
+        """
+        Async variant of :meth:`follow`.
+        """
+        async for new, done in self._aupdates():
+            for chunk in new:
+                yield chunk
+            if done:
+                self._outcome()
+
+
+class FlightGroup:
+    """
+    The in-flight calls of the process, by key.
+
+    :ivar stats: "leaders" (calls sent) and "coalesced" (calls that joined a flight).
+    """
+
+    def __init__(self, disabled: bool = False):
+        self.disabled = disabled
+        self._flights: Dict[Hashable, Flight] = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def _join(self, key: Hashable) -> Tuple[Flight, bool]:
+        # -> (flight, whether the caller leads it)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.stats["coalesced"] += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.stats["leaders"] += 1
+            return flight, True
+
+    def _land(self, key: Hashable, flight: Flight, error: Optional[BaseException] = None, result: Any = None) -> None:
+        # Later calls start a new flight (or hit the response cache)
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if error is None:
+            flight.finish(result)
+        elif isinstance(error, Exception):
+            flight.fail(error)
+        else:
+            # Cancellation of the leader is not the followers' error
+            flight.fail(Abandoned("The coalesced call was cancelled"))
+
+    def in_flight(self) -> int:
+        """
+        The number of calls currently in flight.
+
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._flights)
+
+    def run(self, key: Hashable, function: Callable[[], Any], on_follow: Optional[Callable[[], None]] = None) -> Any:
+        """
+        Call ``function``, or wait for the result of an identical call in flight.
+
+        :param key: Identifies identical calls.
+        :type key: Hashable
+        :param function: Makes the call.
+        :type function: Callable[[], Any]
+        :param on_follow: Called when the call joins a flight instead of being sent.
+        :type on_follow: Optional[Callable[[], None]]
+        :return: The result of ``function`` or of the flight.
+        """
+        if self.disabled:
+            return function()
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            if on_follow is not None:
+                on_follow()
+            try:
+                return flight.wait()
+            except Abandoned:
+                continue
+        try:
+            result = function()
+        except BaseException as error:
+            self._land(key, flight, error)
+            raise
+        self._land(key, flight, result=result)
+        return result
+
+    async def arun(self, key: Hashable, function: Callable[[], Awaitable[Any]],
+                   on_follow: Optional[Callable[[], None]] = None) -> Any:
+        """
+        Async variant of :meth:`run`; ``function`` returns the awaitable of the call.
+        """
+        if self.disabled:
+            return await function()
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            if on_follow is not None:
+                on_follow()
+            try:
+                return await flight.await_result()
+            except Abandoned:
+                continue
+        try:
+            result = await function()
+        except BaseException as error:
+            self._land(key, flight, error)
+            raise
+        self._land(key, flight, result=result)
+        return result
+
+    def stream(self, key: Hashable, function: Callable[[], Iterator[str]],
+               on_follow: Optional[Callable[[], None]] = None) -> Iterator[str]:
+        """
+        Streaming variant of :meth:`run`: yields the text chunks of ``function``, or those
+        of an identical streamed call in flight as it produces them.
+        """
+        if self.disabled:
+            yield from function()
+            return
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            if on_follow is not None:
+                on_follow()
+            streamed = False
+            try:
+                for chunk in flight.follow():
+                    streamed = True
+                    yield chunk
+                return
+            except Abandoned:
+                if streamed:
+                    raise
+        try:
+            for chunk in function():
+                flight.publish(chunk)
+                yield chunk
+        except BaseException as error:
+            self._land(key, flight, error)
+            raise
+        self._land(key, flight, result="".join(flight.chunks))
+
+    async def astream(self, key: Hashable, function: Callable[[], AsyncIterator[str]],
+                      on_follow: Optional[Callable[[], None]] = None) -> AsyncIterator[str]:
+        """
+        Async variant of :meth:`stream`.
+        """
+        if self.disabled:
+            async for chunk in function():
+                yield chunk
+            return
+        while True:
+            flight, leader = self._join(key)
+            if leader:
+                break
+            if on_follow is not None:
+                on_follow()
+            streamed = False
+            try:
+                async for chunk in flight.afollow():
+                    streamed = True
+                    yield chunk
+                return
+            except Abandoned:
+                if streamed:
+                    raise
+        try:
+            async for chunk in function():
+                flight.publish(chunk)
+                yield chunk
+        except BaseException as error:
+            self._land(key, flight, error)
+            raise
+        self._land(key, flight, result="".join(flight.chunks))
+
+
+_flights: Optional[FlightGroup] = None
+_flights_lock = threading.Lock()
+
+
+def get_flights() -> FlightGroup:
+    """
+    The process-wide flight group configured from the environment.
+
+    :rtype: FlightGroup
+    """
+    global _flights
+    with _flights_lock:
+        if _flights is None:
+            _flights = FlightGroup(os.environ.get("CONTROL_SINGLEFLIGHT_DISABLED", "").lower() in ("1", "true", "yes"))
+        return _flights
@@ -0,0 +1,363 @@
+"""
+Persistent store of structured assessment records.
+
+Every finished assessment (from the apps, background jobs and bulk runs) is saved as one
+record per control description: the description, the eight section results, the
+classification label and score, the prompt version of each stage (see
+:func:`src.control_cache.prompt_hash`), the fingerprint of each stage run (see
+:func:`src.control_pipeline.stage_fingerprint`) and when it was first and last assessed.
+Re-assessing a description replaces its results; :mod:`src.control_incremental` re-runs
+only the stages whose fingerprints changed.
+
+Records are indexed for lookups that take milliseconds instead of a new assessment:
+
+- by classification label and score (B-tree indexes), e.g. all "Sanctions" controls scored "Low";
+- by the words of the description and the text sections, in an SQLite FTS5 full-text
+  index ranked by BM25, e.g. the prior assessments relevant to a follow-up question.
+
+Configuration (environment variables):
+
+- ``CONTROL_STORE_PATH``: SQLite file (default ``.cache/control_store.sqlite``)
+- ``CONTROL_STORE_DISABLED``: set to ``1`` to stop saving and retrieving assessments
+
+Usage::
+
+    python -m src.control_store search "OFAC screening of beneficiaries" --score Low
+    python -m src.control_store list --label Sanctions
+    python -m src.control_store stats|clear
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+from tabulate import tabulate
+from src.control_cache import MISSING
+from src.control_pipeline import SECTIONS
+
+# State keys of a record, in display order
+FIELDS = ("original_input",) + tuple(key for _, key in SECTIONS)
+
+# Free-text fields in the full-text index, with their BM25 weights: words of the
+# description itself count most
+TEXT_FIELDS = (("original_input", 3.0), ("control_summary", 1.5), ("control_risk", 1.0),
+               ("control_dependencies", 1.0), ("control_gaps", 1.0), ("control_industry_practices", 1.0),
+               ("control_score_reasoning", 1.0))
+
+# Tokens of a snippet around the best matching words
+SNIPPET_TOKENS = 24
+
+_WORD = re.compile(r"\w+")
+
+
+def match_query(text: str) -> Optional[str]:
+    """
+    An FTS5 query matching any word of free text, e.g. a question.
+
+    :param text: The text to search for.
+    :type text: str
+    :return: The quoted words joined with OR, or None if there are none.
+    :rtype: Optional[str]
+    """
+    words = dict.fromkeys(word.lower() for word in _WORD.findall(text))
+    return " OR ".join(f'"{word}"' for word in words) or None
+
+
+def _input_hash(original_input: str) -> str:
+    return hashlib.sha256(" ".join(original_input.split()).encode("utf-8")).hexdigest()
+
+
+class AssessmentStore:
+    """
+    SQLite-backed assessment records with label/score and full-text indexes.
+
+    Safe to share between threads; each thread uses its own connection.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        columns = ", ".join(f"{key} TEXT" for key in FIELDS[1:])
+        text_columns = ", ".join(key for key, _ in TEXT_FIELDS)
+        new_values = ", ".join(f"new.{key}" for key, _ in TEXT_FIELDS)
+        old_values = ", ".join(f"old.{key}" for key, _ in TEXT_FIELDS)
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS assessments ("
+            " id INTEGER PRIMARY KEY, input_hash TEXT UNIQUE NOT NULL, original_input TEXT NOT NULL,"
+            f" {columns}, prompt_versions TEXT NOT NULL, source TEXT NOT NULL,"
+            " created REAL NOT NULL, updated REAL NOT NULL, fingerprints TEXT NOT NULL DEFAULT '{}')"
+        )
+        if "fingerprints" not in {row[1] for row in connection.execute("PRAGMA table_info(assessments)")}:
+            # Stores created before stage fingerprints were recorded
+            connection.execute("ALTER TABLE assessments ADD COLUMN fingerprints TEXT NOT NULL DEFAULT '{}'")
+        connection.execute("CREATE INDEX IF NOT EXISTS assessments_label ON assessments"
+                           " (control_classification, control_score, updated)")
+        connection.execute("CREATE INDEX IF NOT EXISTS assessments_score ON assessments (control_score, updated)")
+        connection.execute("CREATE INDEX IF NOT EXISTS assessments_updated ON assessments (updated)")
+        # External-content full-text index, kept in step with the table by triggers
+        connection.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS assessments_text USING fts5({text_columns},"
+            " content='assessments', content_rowid='id', tokenize='porter unicode61')"
+        )
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS assessments_insert AFTER INSERT ON assessments BEGIN"
+            f" INSERT INTO assessments_text (rowid, {text_columns}) VALUES (new.id, {new_values}); END"
+        )
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS assessments_delete AFTER DELETE ON assessments BEGIN"
+            f" INSERT INTO assessments_text (assessments_text, rowid, {text_columns})"
+            f" VALUES ('delete', old.id, {old_values}); END"
+        )
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS assessments_update AFTER UPDATE ON assessments BEGIN"
+            f" INSERT INTO assessments_text (assessments_text, rowid, {text_columns})"
+            f" VALUES ('delete', old.id, {old_values});"
+            f" INSERT INTO assessments_text (rowid, {text_columns}) VALUES (new.id, {new_values}); END"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def save(self, state: Mapping[str, Any], source: str = "interactive") -> int:
+        """
+        Save the results of an assessment, replacing the earlier record of the same
+        description (ignoring whitespace differences).
+
+        :param state: The assessment state: "original_input", the section results, the
+                      "prompt_versions" recorded by the stage calls and the "fingerprints"
+                      recorded by the pipeline.
+        :type state: Mapping[str, Any]
+        :param source: Where the assessment was run, e.g. "interactive", "job" or "batch".
+        :type source: str
+        :return: The record ID.
+        :rtype: int
+        """
+        now = time.time()
+        values = [state.get(key) for key in FIELDS]
+        values = [value if value is None or isinstance(value, str) else json.dumps(value, default=str)
+                  for value in values]
+        assignments = ", ".join(f"{key} = excluded.{key}" for key in FIELDS[1:])
+        return self._connection().execute(
+            f"INSERT INTO assessments (input_hash, {', '.join(FIELDS)}, prompt_versions, fingerprints, source,"
+            f" created, updated) VALUES (?, {', '.join('?' for _ in FIELDS)}, ?, ?, ?, ?, ?)"
+            f" ON CONFLICT (input_hash) DO UPDATE SET {assignments}, prompt_versions = excluded.prompt_versions,"
+            " fingerprints = excluded.fingerprints, source = excluded.source, updated = excluded.updated"
+            " RETURNING id",
+            (_input_hash(state["original_input"]), *values,
+             json.dumps(state.get("prompt_versions") or {}, sort_keys=True),
+             json.dumps(state.get("fingerprints") or {}, sort_keys=True), source, now, now),
+        ).fetchone()[0]
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> Dict[str, Any]:
+        record = {key: row[key] for key in row.keys() if key != "input_hash"}
+        record["prompt_versions"] = json.loads(record["prompt_versions"])
+        record["fingerprints"] = json.loads(record["fingerprints"])
+        return record
+
+    def get(self, record_id: int) -> Optional[Dict[str, Any]]:
+        """
+        A record: "id", the state keys of :data:`FIELDS`, "prompt_versions", "fingerprints",
+        "source", "created" and "updated" (epoch seconds).
+
+        :rtype: Optional[Dict[str, Any]]
+        """
+        row = self._connection().execute("SELECT * FROM assessments WHERE id = ?", (record_id,)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def lookup(self, original_input: str) -> Optional[Dict[str, Any]]:
+        """
+        The record of a control description, if it was assessed before.
+
+        :rtype: Optional[Dict[str, Any]]
+        """
+        row = self._connection().execute("SELECT * FROM assessments WHERE input_hash = ?",
+                                         (_input_hash(original_input),)).fetchone()
+        return self._record(row) if row is not None else None
+
+    def find(self, label: Optional[str] = None, score: Optional[str] = None, limit: int = 20,
+             exclude: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        The most recently assessed records with a classification label and/or score.
+
+        :param label: The classification label, or None for any.
+        :type label: Optional[str]
+        :param score: The score ("Low", "Medium" or "High"), or None for any.
+        :type score: Optional[str]
+        :param limit: Maximum number of records.
+        :type limit: int
+        :param exclude: A record ID to leave out, e.g. the one under discussion.
+        :type exclude: Optional[int]
+        :rtype: List[Dict[str, Any]]
+        """
+        where, parameters = self._filters(label, score, exclude, "")
+        rows = self._connection().execute(f"SELECT * FROM assessments {where} ORDER BY updated DESC LIMIT ?",
+                                          (*parameters, limit)).fetchall()
+        return [self._record(row) for row in rows]
+
+    def records(self, label: Optional[str] = None, score: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        All records, oldest first, optionally with a classification label and/or score. They
+        are read one at a time, so records may be saved while iterating.
+
+        :rtype: Iterator[Dict[str, Any]]
+        """
+        where, parameters = self._filters(label, score, None, "")
+        ids = [row[0] for row in self._connection().execute(f"SELECT id FROM assessments {where} ORDER BY id",
+                                                            parameters)]
+        for record_id in ids:
+            record = self.get(record_id)
+            if record is not None:
+                yield record
+
+    def search(self, text: str, label: Optional[str] = None, score: Optional[str] = None, limit: int = 5,
+               exclude: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        The records most relevant to free text, ranked by BM25 over the description and the
+        text sections, optionally restricted to a label and/or score.
+
+        :param text: The text to search for, e.g. a question; any of its words may match.
+        :type text: str
+        :param label: The classification label, or None for any.
+        :type label: Optional[str]
+        :param score: The score, or None for any.
+        :type score: Optional[str]
+        :param limit: Maximum number of records.
+        :type limit: int
+        :param exclude: A record ID to leave out.
+        :type exclude: Optional[int]
+        :return: Records, best first, each with "rank" (BM25, lower is better) and "snippet"
+                 (the best matching passage, matches in bold).
+        :rtype: List[Dict[str, Any]]
+        """
+        query = match_query(text)
+        if query is None:
+            return []
+        where, parameters = self._filters(label, score, exclude, "AND")
+        weights = ", ".join(str(weight) for _, weight in TEXT_FIELDS)
+        rows = self._connection().execute(
+            f"SELECT assessments.*, bm25(assessments_text, {weights}) AS rank,"
+            f" snippet(assessments_text, -1, '**', '**', '…', {SNIPPET_TOKENS}) AS snippet"
+            " FROM assessments_text JOIN assessments ON assessments.id = assessments_text.rowid"
+            f" WHERE assessments_text MATCH ? {where} ORDER BY rank LIMIT ?",
+            (query, *parameters, limit),
+        ).fetchall()
+        return [self._record(row) for row in rows]
+
+    @staticmethod
+    def _filters(label: Optional[str], score: Optional[str], exclude: Optional[int],
+                 joiner: str) -> Tuple[str, List[Any]]:
+        # -> (SQL condition, parameters); joiner is "" to open a WHERE clause or "AND" to extend one
+        conditions, parameters = [], []
+        for column, value in (("control_classification", label), ("control_score", score)):
+            if value is not None:
+                conditions.append(f"assessments.{column} = ?")
+                parameters.append(value)
+        if exclude is not None:
+            conditions.append("assessments.id != ?")
+            parameters.append(exclude)
+        if not conditions:
+            return "", parameters
+        return f"{joiner or 'WHERE'} {' AND '.join(conditions)}", parameters
+
+    def counts(self) -> List[Dict[str, Any]]:
+        """
+        Number of records per classification label and score.
+
+        :return: Rows with "label", "score" and "records".
+        :rtype: List[Dict[str, Any]]
+        """
+        rows = self._connection().execute(
+            "SELECT control_classification, control_score, COUNT(*) FROM assessments"
+            " GROUP BY control_classification, control_score").fetchall()
+        return [{"label": label, "score": score, "records": count} for label, score, count in rows]
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM assessments")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Size of the store.
+
+        :rtype: Dict[str, Any]
+        """
+        records, first, last = self._connection().execute(
+            "SELECT COUNT(*), MIN(created), MAX(updated) FROM assessments").fetchone()
+        return {"records": records, "first_assessed": first, "last_assessed": last,
+                "bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0}
+
+
+_default_store: Any = MISSING
+_default_lock = threading.Lock()
+
+
+def get_store() -> Optional[AssessmentStore]:
+    """
+    The process-wide store configured from the environment, or None when disabled.
+
+    :rtype: Optional[AssessmentStore]
+    """
+    global _default_store
+    with _default_lock:
+        if _default_store is MISSING:
+            if os.environ.get("CONTROL_STORE_DISABLED", "").lower() in ("1", "true", "yes"):
+                _default_store = None
+            else:
+                _default_store = AssessmentStore(
+                    os.environ.get("CONTROL_STORE_PATH", os.path.join(".cache", "control_store.sqlite")))
+    return _default_store
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search or maintain the assessment store.")
+    parser.add_argument("command", choices=("search", "list", "show", "stats", "clear"))
+    parser.add_argument("text", nargs="?", help="words to search for (search) or a record ID (show)")
+    parser.add_argument("--label", help="only records with this classification label")
+    parser.add_argument("--score", help="only records with this score")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    store = get_store()
+    if store is None:
+        parser.error("the assessment store is disabled (CONTROL_STORE_DISABLED)")
+    if args.command in ("search", "list"):
+        if args.command == "search" and not args.text:
+            parser.error("search needs the words to search for")
+        started = time.perf_counter()
+        records = (store.search(args.text, args.label, args.score, args.limit) if args.command == "search"
+                   else store.find(args.label, args.score, args.limit))
+        elapsed = time.perf_counter() - started
+        column = "match" if args.command == "search" else "control"
+        print(tabulate([[record["id"], record["control_classification"], record["control_score"],
+                         time.strftime("%Y-%m-%d %H:%M", time.localtime(record["updated"])),
+                         record.get("snippet") or record["original_input"][:80]] for record in records],
+                       headers=["id", "label", "score", "assessed", column]))
+        print(f"{len(records)} records in {1000 * elapsed:.1f} ms")
+        return
+    if args.command == "show":
+        record = store.get(int(args.text)) if args.text and args.text.isdigit() else None
+        if record is None:
+            parser.error("show needs the ID of a stored record")
+        print(json.dumps(record, indent=2))
+        return
+    if args.command == "clear":
+        store.clear()
+    print(json.dumps({**store.stats(), "by_label_and_score": store.counts()}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,23 @@
 import warnings
 import os
-from langchain import hub
-from typing import Any, List, Dict
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from typing import Any, AsyncIterator, Dict, Iterator, List
+from src.control_prompts import stage_prompt
+from src.control_contracts import OutputContract
+from src.control_llm import run_chain, arun_chain, stream_stage, astream_stage
+
+
+SUMMARY_PROMPT = stage_prompt('''
+    # Instructions
+    - Create a succinct summary of the input control
+    - Summary should be succinct and concise
+    - Summary should not have more than 1 sentence
+    ''')
+
+SUMMARY_LLM = {"model": "o3-mini", "reasoning_effort": "low"}
+
+# Answer shape and output budget (including reasoning tokens), see src/control_contracts.py
+SUMMARY_CONTRACT = OutputContract(max_tokens=1000)
+
 
 def summary(state: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -19,27 +32,39 @@ def summary(state: Dict[str, Any]) -> Dict[str, Any]:
     :return: The updated state dictionary with the generated control summary added under the key "control_summary".
     :rtype: Dict[str, Any]
     """
-    summary_prompt = '''
-    # Instructions
-    - The input is the description of a control for a financial payment system
-    - Create a succinct summary of the control
-    - Summary should be succinct and concise
-    - Summary should not have more than 1 sentence
+    generation = run_chain("summary", SUMMARY_PROMPT, {"control": state["original_input"]}, state, SUMMARY_LLM,
+                           contract=SUMMARY_CONTRACT)
+    state["control_summary"] = generation
 
-    # Input
-    {input}
-    '''
+    return state
 
-    # Create a chat prompt template using the detailed prompt
-    prompt = ChatPromptTemplate(["system", summary_prompt])
 
-    # Initialize OpenAI Language Model
-    llm = ChatOpenAI(model="o3-mini", reasoning_effort="low", api_key=state["openai_api_key"])
+async def asummary(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async variant of :func:`summary` built on ``ainvoke``.
+    """
+    generation = await arun_chain("summary", SUMMARY_PROMPT, {"control": state["original_input"]},
+                                  state, SUMMARY_LLM, contract=SUMMARY_CONTRACT)
+    state["control_summary"] = generation
 
-    # Combine the prompt, the language model, and the output parser into a processing chain.
-    rag_chain = prompt | llm | StrOutputParser()
+    return state
 
-    generation = rag_chain.invoke({"input": state["original_input"]})
-    state["control_summary"] = generation
 
-    return state
\ No newline at end of file
+def stream_summary(state: Dict[str, Any]) -> Iterator[str]:
+    """
+    Streaming variant of :func:`summary`: yields the text as it is generated and stores the
+    full text under "control_summary" once done.
+    """
+    yield from stream_stage("summary", SUMMARY_PROMPT,
+                            {"control": state["original_input"]},
+                            state, SUMMARY_LLM, SUMMARY_CONTRACT, "control_summary")
+
+
+async def astream_summary(state: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Async variant of :func:`stream_summary` built on ``astream``.
+    """
+    async for chunk in astream_stage("summary", SUMMARY_PROMPT,
+                                     {"control": state["original_input"]},
+                                     state, SUMMARY_LLM, SUMMARY_CONTRACT, "control_summary"):
+        yield chunk
@@ -0,0 +1,128 @@
+"""
+Startup and rerun timing of the Streamlit apps.
+
+Streamlit executes an app script top to bottom on every interaction, so both the cost of
+its imports (paid once per server process) and the time of each script run matter.
+
+- :func:`import_times` measures the import time of modules, and of everything they pull
+  in, in a fresh interpreter (``python -X importtime``)
+- :class:`ScriptTimer` records each script run of a session: the time to named marks such
+  as the first render, the total, and whether it was the first (cold) run of the process
+
+Usage::
+
+    python -m src.control_timing imports
+    python -m src.control_timing imports streamlit src.control_pipeline --top 30
+"""
+import argparse
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, MutableMapping, Optional, Sequence
+from tabulate import tabulate
+
+# Imported by the apps before their first render
+APP_MODULES = ("streamlit", "src.control_pipeline", "src.control_batch", "src.control_followup")
+
+# Whether a script run has finished in this process; the first one pays for the imports
+_warm = False
+
+
+def import_times(modules: Sequence[str] = APP_MODULES, python: str = sys.executable) -> List[Dict[str, Any]]:
+    """
+    Import time of each module in a fresh interpreter, slowest first. The modules are
+    imported in order, so the time of each excludes what the ones before it already imported.
+
+    :param modules: The modules to import, in order.
+    :type modules: Sequence[str]
+    :param python: The interpreter to measure.
+    :type python: str
+    :return: One row per imported module: "module", "self_ms" and "cumulative_ms" (including
+             the modules it imported first), and "depth" in the import tree.
+    :rtype: List[Dict[str, Any]]
+    """
+    output = subprocess.run([python, "-X", "importtime", "-c", "; ".join(f"import {name}" for name in modules)],
+                            capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        rows.append({"module": name.strip(), "self_ms": int(own) / 1000, "cumulative_ms": int(cumulative) / 1000,
+                     "depth": (len(name) - len(name.lstrip())) // 2})
+    return sorted(rows, key=lambda row: row["cumulative_ms"], reverse=True)
+
+
+class ScriptTimer:
+    """
+    Times one run of a Streamlit script and keeps the timings of the session's runs.
+
+    Create it at the top of the script, mark points of interest and finish it at the end::
+
+        timer = ScriptTimer(st.session_state, started)
+        ...
+        timer.mark("first render")
+        ...
+        timer.finish()
+
+    :param session_state: Where the runs are kept (``st.session_state``).
+    :type session_state: MutableMapping[str, Any]
+    :param started: ``time.perf_counter()`` at the start of the script (default: now).
+    :type started: Optional[float]
+    :param keep: Runs kept per session.
+    :type keep: int
+    """
+
+    def __init__(self, session_state: MutableMapping[str, Any], started: Optional[float] = None, keep: int = 50):
+        self.session_state = session_state
+        self.started = time.perf_counter() if started is None else started
+        self.keep = keep
+        self.cold = not _warm
+        self.marks: Dict[str, float] = {}
+
+    def mark(self, name: str) -> None:
+        """
+        Record the seconds from the start of the script to now under ``name``.
+        """
+        self.marks[name] = time.perf_counter() - self.started
+
+    def finish(self) -> Dict[str, Any]:
+        """
+        Record the run in the session.
+
+        :return: "run" (number within the session), "cold", the marks and "total" in seconds.
+        :rtype: Dict[str, Any]
+        """
+        global _warm
+        _warm = True
+        runs = self.session_state.setdefault("script_timings", [])
+        record = {"run": runs[-1]["run"] + 1 if runs else 1, "cold": self.cold, **self.marks,
+                  "total": time.perf_counter() - self.started}
+        runs.append(record)
+        del runs[:-self.keep]
+        return record
+
+    def runs(self) -> List[Dict[str, Any]]:
+        """
+        The recorded runs of the session, oldest first.
+
+        :rtype: List[Dict[str, Any]]
+        """
+        return list(self.session_state.get("script_timings", []))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Report the import time of the app modules.")
+    parser.add_argument("command", choices=("imports",))
+    parser.add_argument("modules", nargs="*", default=list(APP_MODULES))
+    parser.add_argument("--top", type=int, default=20, help="slowest modules shown")
+    args = parser.parse_args()
+
+    rows = import_times(args.modules)
+    print(tabulate([row for row in rows if row["module"] in args.modules], headers="keys", floatfmt=".1f"))
+    print()
+    print(tabulate(rows[:args.top], headers="keys", floatfmt=".1f"))
+
+
+if __name__ == "__main__":
+    main()